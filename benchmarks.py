@@ -0,0 +1,400 @@
+"""
+Micro-benchmarks of the per-second hot paths of obs_now_playing_widget_windows_media_api.
+
+Runs without the Windows media API: sessions come from the fake media source. Usage:
+
+    python benchmarks.py                              run all benchmarks, print a table
+    python benchmarks.py --json results.json          also write the results as JSON
+    python benchmarks.py --compare baseline.json      run and compare against earlier results
+    python benchmarks.py --compare old.json new.json  compare two result files without running
+    python benchmarks.py --filter extract_cover       run only benchmarks whose name contains this
+
+With --compare the exit code is 1 if a benchmark got slower than --threshold.
+"""
+import argparse
+import asyncio
+import io
+import json
+import os
+import platform
+import random
+import statistics
+import sys
+import time
+
+import obs_now_playing_widget_windows_media_api as widget
+
+RESULTS_FORMAT_VERSION = 1
+MIN_RUN_SECONDS = 0.05  # loops per run are raised until one run takes at least this long
+COVER_SIZES = (('100KB', 100 * 1024), ('500KB', 500 * 1024), ('2MB', 2 * 1024 * 1024))
+
+benchmarks = {}  # name -> setup function returning a callable(loops)
+
+
+def benchmark(name):
+    def register(setup):
+        benchmarks[name] = setup
+        return setup
+    return register
+
+
+def run_async(coroutine_function):
+    #print("DEBUG: run_async")
+    """
+    Wrap `coroutine_function(loops)` into a plain callable(loops) running on one event loop.
+    """
+    loop = asyncio.new_event_loop()
+    return lambda loops: loop.run_until_complete(coroutine_function(loops))
+
+
+def make_thumbnail(target_bytes, image_format='JPEG', seed=1):
+    #print("DEBUG: make_thumbnail")
+    """
+    A noisy square image encoded to at least `target_bytes`, like a high quality album cover.
+    """
+    from PIL import Image
+
+    rng = random.Random(seed)
+    side = 200
+    while True:
+        img = Image.frombytes('RGB', (side, side), rng.randbytes(side * side * 3))
+        img = img.resize((side * 2, side * 2))  # soften the noise a bit, like a photo
+        output = io.BytesIO()
+        img.save(output, image_format, **({'quality': 92} if image_format == 'JPEG' else {}))
+        data = output.getvalue()
+        if len(data) >= target_bytes or side >= 2000:
+            return data
+        side = int(side * max(1.1, (target_bytes / len(data)) ** 0.5))
+
+
+def reset_cover_store():
+    with widget.cover_store_lock:
+        widget.cover_store.clear()
+        widget.cover_store_bytes = 0
+
+
+def use_fake_source(**fields):
+    source = widget.FakeMediaSource()
+    source.set_session(**fields)
+    widget.media_source = source
+    return source
+
+
+# ---------------------------------------------------------------------------
+# Benchmarks
+# ---------------------------------------------------------------------------
+
+def get_media_info_benchmark(playback_status):
+    thumbnail = make_thumbnail(100 * 1024)
+    source = use_fake_source(title='Title', artist='Artist', thumbnail=thumbnail,
+                             playback_status=playback_status, position=42, duration=240)
+    session = source.sessions[source.current_app_id]
+    state = widget.new_app_state()
+
+    async def run(loops):
+        await widget.get_media_info(session, state)  # cover extracted once, like a running track
+        for _ in range(loops):
+            await widget.get_media_info(session, state)
+    return run_async(run)
+
+
+@benchmark('get_media_info.playing')
+def bench_get_media_info_playing():
+    return get_media_info_benchmark(4)
+
+
+@benchmark('get_media_info.paused')
+def bench_get_media_info_paused():
+    return get_media_info_benchmark(5)
+
+
+@benchmark('get_all_media_info.4_sessions')
+def bench_get_all_media_info():
+    source = use_fake_source(app_id='Player.0', title='Title 0', artist='Artist', position=10, duration=240)
+    for index in range(1, 4):
+        source.set_session(app_id=f'Player.{index}', make_current=False, title=f'Title {index}',
+                           artist='Artist', position=10, duration=240)
+
+    async def run(loops):
+        for _ in range(loops):
+            await widget.get_all_media_info()
+    return run_async(run)
+
+
+def significant_change_benchmark(seek):
+    now = time.monotonic()
+    old_info = dict(widget.DEFAULT_MEDIA_INFO, title='Title', artist='Artist', status='Playing',
+                    position=42.0, duration=240, position_time=now, cover='/cover/abc')
+    new_info = dict(old_info, position=(90.0 if seek else 43.0), position_time=now + 1)
+
+    def run(loops):
+        for _ in range(loops):
+            widget.is_significant_change(new_info, old_info)
+    return run
+
+
+@benchmark('is_significant_change.unchanged')
+def bench_significant_change_unchanged():
+    return significant_change_benchmark(seek=False)
+
+
+@benchmark('is_significant_change.seek')
+def bench_significant_change_seek():
+    return significant_change_benchmark(seek=True)
+
+
+def extract_cover_benchmark(target_bytes, image_format='JPEG'):
+    thumbnail = make_thumbnail(target_bytes, image_format)
+    use_fake_source(thumbnail=thumbnail)
+
+    async def run(loops):
+        for _ in range(loops):
+            reset_cover_store()  # a new cover every time
+            await widget.extract_cover(thumbnail)
+    return run_async(run)
+
+
+for size_name, size_bytes in COVER_SIZES:
+    benchmark(f'extract_cover.jpeg_{size_name}')(
+        lambda size_bytes=size_bytes: extract_cover_benchmark(size_bytes)
+    )
+benchmark('extract_cover.png_1MB')(lambda: extract_cover_benchmark(1024 * 1024, 'PNG'))
+
+
+def media_benchmark(delta):
+    widget.apply_media_update(dict(widget.DEFAULT_MEDIA_INFO, title='Title', artist='Artist',
+                                   status='Playing', position=42.0, duration=240,
+                                   position_time=time.monotonic(), cover='/cover/abc'))
+    path = '/media'
+    if delta:
+        # A client one seek behind gets only the changed fields
+        path = f'/media?since={widget.get_media_snapshot().version}'
+        widget.apply_media_update(dict(widget.media_info, position=90.0, position_time=time.monotonic()))
+    client = widget.create_flask_app().test_client()
+
+    def run(loops):
+        for _ in range(loops):
+            client.get(path)
+    return run
+
+
+@benchmark('media.flask_full')
+def bench_media_full():
+    return media_benchmark(delta=False)
+
+
+@benchmark('media.flask_delta')
+def bench_media_delta():
+    return media_benchmark(delta=True)
+
+
+@benchmark('media.async_route')
+def bench_media_async_route():
+    def run(loops):
+        for _ in range(loops):
+            widget.async_route('GET', '/media', {}, {'accept-encoding': 'gzip'})
+    return run
+
+
+@benchmark('media.snapshot_encode')
+def bench_media_snapshot_encode():
+    snapshot = widget.get_media_snapshot()
+    new_info = dict(widget.media_info, position=120.0)
+
+    def run(loops):
+        for _ in range(loops):
+            snapshot.with_changes(new_info).delta_json(snapshot.version)
+    return run
+
+
+def render_benchmark(layout):
+    def run(loops):
+        for _ in range(loops):
+            widget.rendered_layouts.clear()  # render and compress again every time
+            widget.get_rendered_layout(layout)
+    return run
+
+
+@benchmark('render_template.horizontal')
+def bench_render_horizontal():
+    return render_benchmark('horizontal')
+
+
+@benchmark('render_template.vertical')
+def bench_render_vertical():
+    return render_benchmark('vertical')
+
+
+@benchmark('gui_cover.decode_resize')
+def bench_gui_cover_decode_resize():
+    from PIL import Image
+
+    thumbnail = make_thumbnail(500 * 1024)
+
+    def run(loops):
+        for _ in range(loops):
+            img = Image.open(io.BytesIO(thumbnail))
+            img.load()  # decoded like in process_cover
+            widget.make_gui_cover(img)
+    return run
+
+
+@benchmark('gui_cover.paused_overlay')
+def bench_gui_cover_paused_overlay():
+    from PIL import Image
+
+    img = widget.make_gui_cover(Image.open(io.BytesIO(make_thumbnail(100 * 1024))))
+
+    def run(loops):
+        for _ in range(loops):
+            widget.make_paused_image(img)
+    return run
+
+
+@benchmark('cover_palette')
+def bench_cover_palette():
+    import numpy  # noqa: F401, skipped without NumPy
+    from PIL import Image
+
+    img = widget.make_gui_cover(Image.open(io.BytesIO(make_thumbnail(100 * 1024))))
+
+    def run(loops):
+        for _ in range(loops):
+            widget.compute_cover_palette(img)
+    return run
+
+
+# ---------------------------------------------------------------------------
+# Runner
+# ---------------------------------------------------------------------------
+
+def measure(run, repeat):
+    #print("DEBUG: measure")
+    """
+    Time `run(loops)`, raising loops until one run takes MIN_RUN_SECONDS, then `repeat` runs.
+    Returns seconds per loop of every run and the loops per run.
+    """
+    loops = 1
+    while True:
+        start = time.perf_counter()
+        run(loops)
+        elapsed = time.perf_counter() - start
+        if elapsed >= MIN_RUN_SECONDS:
+            break
+        loops *= 10 if elapsed < MIN_RUN_SECONDS / 10 else 2
+
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        run(loops)
+        timings.append((time.perf_counter() - start) / loops)
+    return timings, loops
+
+
+def run_benchmarks(name_filter=None, repeat=5):
+    #print("DEBUG: run_benchmarks")
+    results = {}
+    for name, setup in benchmarks.items():
+        if name_filter and name_filter not in name:
+            continue
+        try:
+            run = setup()
+        except ImportError as e:
+            print(f"{name:<36} skipped, {e}")
+            continue
+        timings, loops = measure(run, repeat)
+        results[name] = {
+            'median_us': statistics.median(timings) * 1e6,
+            'min_us': min(timings) * 1e6,
+            'stdev_us': statistics.stdev(timings) * 1e6 if len(timings) > 1 else 0.0,
+            'loops': loops,
+            'repeat': repeat
+        }
+        print(f"{name:<36} {format_us(results[name]['median_us']):>12}  (min {format_us(results[name]['min_us'])})")
+    reset_cover_store()
+    return {
+        'format': RESULTS_FORMAT_VERSION,
+        'created': time.time(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'machine': platform.machine(),
+        'results': results
+    }
+
+
+def format_us(microseconds):
+    if microseconds >= 1000:
+        return f"{microseconds / 1000:.2f} ms"
+    return f"{microseconds:.2f} us"
+
+
+def compare(baseline, current, threshold):
+    #print("DEBUG: compare")
+    """
+    Print the median of every benchmark in both result sets and return the names of those
+    that got slower by more than `threshold` (0.1 = 10%).
+    """
+    regressions = []
+    print(f"\n{'benchmark':<36} {'baseline':>12} {'current':>12} {'change':>9}")
+    for name in sorted(set(baseline['results']) | set(current['results'])):
+        old = baseline['results'].get(name)
+        new = current['results'].get(name)
+        if old is None or new is None:
+            print(f"{name:<36} {format_us(old['median_us']) if old else '-':>12} "
+                  f"{format_us(new['median_us']) if new else '-':>12} {'':>9}")
+            continue
+        change = new['median_us'] / old['median_us'] - 1
+        flag = ""
+        if change > threshold:
+            flag = "  slower"
+            regressions.append(name)
+        elif change < -threshold:
+            flag = "  faster"
+        print(f"{name:<36} {format_us(old['median_us']):>12} {format_us(new['median_us']):>12} {change:>+8.1%}{flag}")
+    return regressions
+
+
+def load_results(path):
+    with open(path, "r") as f:
+        return json.load(f)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Micro-benchmarks of the widget's hot paths.")
+    parser.add_argument("--json", metavar="FILE", help="write the results to this JSON file")
+    parser.add_argument("--compare", metavar="FILE", nargs="+",
+                        help="baseline results to compare against, or two result files to compare without running")
+    parser.add_argument("--threshold", type=float, default=0.1,
+                        help="relative slowdown reported as regression (default: %(default)s)")
+    parser.add_argument("--filter", metavar="TEXT", help="run only benchmarks whose name contains TEXT")
+    parser.add_argument("--repeat", type=int, default=5, help="timed runs per benchmark (default: %(default)s)")
+    args = parser.parse_args(argv)
+
+    if args.compare and len(args.compare) > 2:
+        parser.error("--compare takes one baseline or two result files")
+
+    if args.compare and len(args.compare) == 2:
+        baseline, current = load_results(args.compare[0]), load_results(args.compare[1])
+    else:
+        widget.template_name = 'horizontal'
+        current = run_benchmarks(args.filter, args.repeat)
+        baseline = load_results(args.compare[0]) if args.compare else None
+        if baseline is not None and args.filter:
+            baseline['results'] = {name: result for name, result in baseline['results'].items() if args.filter in name}
+        if args.json:
+            temp_file = f"{args.json}.tmp"
+            with open(temp_file, "w") as f:
+                json.dump(current, f, indent=2)
+            os.replace(temp_file, args.json)
+            print(f"Saved results: {args.json}")
+
+    if baseline is not None:
+        regressions = compare(baseline, current, args.threshold)
+        if regressions:
+            print(f"\n{len(regressions)} benchmark(s) slower than {args.threshold:.0%}: {', '.join(regressions)}")
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,679 @@
+"""
+Load test of the widget server with many simulated overlay clients (OBS browser sources, remote viewers).
+
+Starts the server headless against a replayed stub trace, no Windows needed, and runs N clients
+doing what the layouts do: load / once, follow /media/stream (or, in poll mode, GET /media every
+second like the layouts without EventSource) and fetch every new cover once. Reports throughput,
+latency percentiles per route, stream events and their delay, bytes per client per minute and the
+server's CPU and memory. Usage:
+
+    python loadtest.py --clients 200                              one run with the async server and streaming clients
+    python loadtest.py --server async flask --mode stream poll    every combination, side by side
+    python loadtest.py --mode poll --payload delta full           polling clients with and without ?since=
+    python loadtest.py --clients 500 --json results.json          also write the reports as JSON
+    python loadtest.py --compare before.json after.json           compare saved reports without running
+
+Server CPU and memory are read with psutil if it is installed, else from /proc (Linux only).
+The clients run in this process: for thousands of clients, check that this process is not the bottleneck.
+"""
+import argparse
+import asyncio
+import base64
+import gzip
+import hashlib
+import json
+import os
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+import obs_now_playing_widget_windows_media_api as widget
+
+REPORT_FORMAT_VERSION = 2  # 2: stream mode
+SERVER_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'obs_now_playing_widget_windows_media_api.py')
+SERVER_START_TIMEOUT = 30  # seconds until the started server must answer /media
+POLL_SECONDS = 1  # the layouts' /media polling interval
+STREAM_RETRY_SECONDS = 1  # reconnect delay after a dropped /media/stream, like the server's retry:
+SAMPLE_SECONDS = 1  # server CPU and memory sampling interval
+ROUTES = ('/', '/media', '/media/stream', '/cover')
+
+
+class HttpConnection:
+    """
+    Minimal HTTP/1.1 client with keep-alive, enough for the widget's responses.
+    """
+    def __init__(self, host, port):
+        self.host = host
+        self.port = port
+        self.reader = None
+        self.writer = None
+        self.stream_headers = {}
+
+    async def request(self, path, headers):
+        #print("DEBUG: HttpConnection.request")
+        """
+        GET `path`. Returns (status, response headers, body, bytes received including headers).
+        """
+        if self.writer is None:
+            self.reader, self.writer = await asyncio.open_connection(self.host, self.port)
+        lines = [f"GET {path} HTTP/1.1", f"Host: {self.host}:{self.port}"]
+        lines += [f"{name}: {value}" for name, value in headers.items()]
+        self.writer.write(("\r\n".join(lines) + "\r\n\r\n").encode('ascii'))
+
+        try:
+            head = await self.reader.readuntil(b"\r\n\r\n")
+            status_line, *header_lines = head.decode('latin-1').split("\r\n")
+            status = int(status_line.split(" ", 2)[1])
+            response_headers = {}
+            for line in header_lines:
+                if ":" in line:
+                    name, value = line.split(":", 1)
+                    response_headers[name.strip().lower()] = value.strip()
+
+            received = len(head)
+            keep_alive = status_line.startswith("HTTP/1.1") and response_headers.get('connection', '').lower() != 'close'
+            if status in (204, 304):
+                body = b""
+            elif 'content-length' in response_headers:
+                body = await self.reader.readexactly(int(response_headers['content-length']))
+                received += len(body)
+            elif response_headers.get('transfer-encoding', '').lower() == 'chunked':
+                chunks = []
+                while True:
+                    size_line = await self.reader.readuntil(b"\r\n")
+                    size = int(size_line.split(b";")[0], 16)
+                    chunk = await self.reader.readexactly(size + 2)
+                    received += len(size_line) + len(chunk)
+                    if size == 0:
+                        break
+                    chunks.append(chunk[:-2])
+                body = b"".join(chunks)
+            else:
+                body = await self.reader.read()
+                received += len(body)
+                keep_alive = False
+        except Exception:
+            self.close()
+            raise
+
+        if not keep_alive:
+            self.close()
+        return status, response_headers, body, received
+
+    async def open_stream(self, path, headers):
+        #print("DEBUG: HttpConnection.open_stream")
+        """
+        GET a streamed response. Returns (status, response headers, bytes received), read the body
+        with read_stream(). The connection is not reused afterwards.
+        """
+        self.close()
+        self.reader, self.writer = await asyncio.open_connection(self.host, self.port)
+        lines = [f"GET {path} HTTP/1.1", f"Host: {self.host}:{self.port}"]
+        lines += [f"{name}: {value}" for name, value in headers.items()]
+        self.writer.write(("\r\n".join(lines) + "\r\n\r\n").encode('ascii'))
+
+        try:
+            head = await self.reader.readuntil(b"\r\n\r\n")
+        except Exception:
+            self.close()
+            raise
+        status_line, *header_lines = head.decode('latin-1').split("\r\n")
+        self.stream_headers = {}
+        for line in header_lines:
+            if ":" in line:
+                name, value = line.split(":", 1)
+                self.stream_headers[name.strip().lower()] = value.strip()
+        return int(status_line.split(" ", 2)[1]), self.stream_headers, len(head)
+
+    async def read_stream(self):
+        #print("DEBUG: HttpConnection.read_stream")
+        """
+        Next piece of a streamed body opened with open_stream(). Returns (data, bytes received),
+        data is empty at the end of the stream.
+        """
+        if self.stream_headers.get('transfer-encoding', '').lower() == 'chunked':
+            size_line = await self.reader.readuntil(b"\r\n")
+            size = int(size_line.split(b";")[0], 16)
+            chunk = await self.reader.readexactly(size + 2)
+            return chunk[:-2], len(size_line) + len(chunk)
+        # Without chunked encoding the stream ends when the server closes the connection
+        data = await self.reader.read(65536)
+        return data, len(data)
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+        self.reader = self.writer = None
+
+
+class LoadStats:
+    """
+    Latencies, errors and received bytes per route, recorded only while `recording` is set or with
+    `always`: every page loads / and connects to /media/stream once at its start, which is mostly
+    during the warmup. Stream events and their delays are recorded with record_stream().
+    """
+    def __init__(self):
+        self.recording = False
+        self.latencies = {route: [] for route in ROUTES}
+        self.errors = {route: 0 for route in ROUTES}
+        self.statuses = {}
+        self.received = 0
+        self.events = 0
+        self.event_delays = []
+
+    def record(self, route, seconds, status=None, received=0, always=False):
+        if not (self.recording or always):
+            return
+        if status is None:
+            self.errors[route] += 1
+            return
+        self.latencies[route].append(seconds)
+        self.statuses[status] = self.statuses.get(status, 0) + 1
+        if self.recording:
+            # Bytes per minute are the steady state, without the page loads before the measurement
+            self.received += received
+        if status >= 400:
+            self.errors[route] += 1
+
+    def record_stream(self, received, events, delays):
+        """
+        Bytes of a /media/stream read, the number of media events in it and their delays from the
+        server's update to their arrival.
+        """
+        if not self.recording:
+            return
+        self.received += received
+        self.events += events
+        self.event_delays.extend(delays)
+
+
+async def timed_request(connection, stats, route, path, headers, always=False):
+    #print("DEBUG: timed_request")
+    """
+    Request `path` and record it under `route`. Returns (status, headers, body), None on errors.
+    """
+    start = time.perf_counter()
+    try:
+        status, response_headers, body, received = await connection.request(path, headers)
+    except Exception:
+        stats.record(route, time.perf_counter() - start, always=always)
+        return None
+    stats.record(route, time.perf_counter() - start, status, received, always)
+    return status, response_headers, body
+
+
+async def load_cover(connection, stats, cover, loaded_covers):
+    # The browser caches covers, they are immutable
+    if cover and cover not in loaded_covers:
+        loaded_covers.add(cover)
+        await timed_request(connection, stats, '/cover', cover, {})
+
+
+async def run_client(connection, stats, mode, payload, encoding, stop_at):
+    #print("DEBUG: run_client")
+    """
+    One overlay page: load the layout, then follow /media/stream or poll /media, and load new covers.
+    """
+    await asyncio.sleep(random.random() * POLL_SECONDS)  # pages are not loaded all at once
+    accept_encoding = {'Accept-Encoding': 'gzip, deflate, br'} if encoding == 'gzip' else {}
+    await timed_request(connection, stats, '/', '/', accept_encoding, always=True)
+    try:
+        if mode == 'stream':
+            await stream_media(connection, stats, stop_at)
+        else:
+            await poll_media(connection, stats, payload, accept_encoding, stop_at)
+    finally:
+        connection.close()
+
+
+async def stream_media(connection, stats, stop_at):
+    #print("DEBUG: stream_media")
+    """
+    Follow /media/stream like the layouts' EventSource, on its own connection, until `stop_at`.
+    Covers are loaded on the page's other connection. Dropped streams are reconnected.
+    """
+    stream = HttpConnection(connection.host, connection.port)
+    cover = None
+    loaded_covers = set()
+    try:
+        while time.monotonic() < stop_at:
+            start = time.perf_counter()
+            try:
+                status, _, received = await asyncio.wait_for(
+                    stream.open_stream('/media/stream', {'Accept': 'text/event-stream'}),
+                    max(0.001, stop_at - time.monotonic())
+                )
+            except asyncio.TimeoutError:
+                break
+            except Exception:
+                stats.record('/media/stream', time.perf_counter() - start, always=True)
+                await asyncio.sleep(STREAM_RETRY_SECONDS)
+                continue
+            if status != 200:
+                stats.record('/media/stream', time.perf_counter() - start, status, received, always=True)
+                stream.close()
+                await asyncio.sleep(STREAM_RETRY_SECONDS)
+                continue
+
+            buffer = b""
+            connected = False
+            try:
+                while True:
+                    data, received_now = await asyncio.wait_for(stream.read_stream(), max(0.001, stop_at - time.monotonic()))
+                    received += received_now
+                    if not data:
+                        raise ConnectionError("stream ended")
+                    buffer += data
+                    *events, buffer = buffer.split(b"\n\n")
+                    arrived = time.monotonic()
+                    media_events = 0
+                    delays = []
+                    for event in events:
+                        lines = event.split(b"\n")
+                        # Keepalive comments and layout events carry no media info
+                        if any(line.startswith(b"event:") for line in lines):
+                            continue
+                        update = json.loads(b"\n".join(line[5:].strip() for line in lines if line.startswith(b"data:")) or b"null")
+                        if not isinstance(update, dict):
+                            continue
+                        media_events += 1
+                        if not connected:
+                            # Connected: the first event holds the full media info
+                            connected = True
+                            stats.record('/media/stream', time.perf_counter() - start, status, received, always=True)
+                            received = 0
+                        elif 'server_time' in update:
+                            # Both processes read the same system wide monotonic clock
+                            delays.append(arrived - update['server_time'])
+                        cover = update.get('cover', cover)
+                    stats.record_stream(received, media_events, delays)
+                    received = 0
+                    await load_cover(connection, stats, cover, loaded_covers)
+            except asyncio.TimeoutError:
+                break
+            except Exception:
+                if not connected:
+                    stats.record('/media/stream', time.perf_counter() - start, always=True)
+                stream.close()
+                await asyncio.sleep(STREAM_RETRY_SECONDS)
+    finally:
+        stream.close()
+
+
+async def poll_media(connection, stats, payload, accept_encoding, stop_at):
+    #print("DEBUG: poll_media")
+    """
+    Poll /media every second like fetchMediaInfo does without EventSource, until `stop_at`.
+    """
+
+    version = None
+    cover = None
+    loaded_covers = set()
+    next_poll = time.monotonic()
+    while time.monotonic() < stop_at:
+        path = f"/media?since={version}" if payload == 'delta' and version is not None else "/media"
+        response = await timed_request(connection, stats, '/media', path, accept_encoding)
+        if response is not None and response[0] == 200:
+            status, headers, body = response
+            if headers.get('content-encoding') == 'gzip':
+                body = gzip.decompress(body)
+            update = json.loads(body)
+            version = update.get('version', version)
+            cover = update.get('cover', cover)
+            await load_cover(connection, stats, cover, loaded_covers)
+
+        next_poll += POLL_SECONDS
+        await asyncio.sleep(max(0.0, next_poll - time.monotonic()))
+
+
+def write_stub_trace(path, tracks, track_seconds, cover_bytes):
+    #print("DEBUG: write_stub_trace")
+    """
+    A replay trace of `tracks` tracks of `track_seconds` each, played in a loop, with a random
+    JPEG-like cover of `cover_bytes` each. Headless servers serve covers without decoding them.
+    """
+    rng = random.Random(1)
+    with widget.open_trace(path, "w") as f:
+        f.write(json.dumps({'trace': widget.TRACE_FORMAT_VERSION, 'started': time.time()}) + "\n")
+        for index in range(tracks):
+            data = b"\xff\xd8\xff\xe0" + rng.randbytes(max(0, cover_bytes - 4))
+            thumbnail_hash = hashlib.sha1(data).hexdigest()
+            f.write(json.dumps({'thumbnail': thumbnail_hash, 'data': base64.b64encode(data).decode('ascii')}) + "\n")
+            session = {
+                'app_id': 'LoadTest.Player', 'title': f'Track {index + 1}', 'artist': 'Load Test', 'album': '',
+                'thumbnail': thumbnail_hash, 'playback_status': 4, 'playback_rate': 1.0,
+                'position': 0, 'duration': track_seconds, 'timeline_updated': index * track_seconds
+            }
+            f.write(json.dumps({'t': index * track_seconds, 'sessions': [session], 'current': 'LoadTest.Player'}) + "\n")
+        # Hold the last track to its end before the trace starts over
+        f.write(json.dumps({'t': tracks * track_seconds - 0.001, 'sessions': [session], 'current': 'LoadTest.Player'}) + "\n")
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def start_server(server, port, trace, settings_file, log_file):
+    #print("DEBUG: start_server")
+    """
+    Start the widget headless on `port` with the replay source and wait until it answers /media.
+    `settings_file` keeps the server away from the real settings, export folder and push target.
+    """
+    process = subprocess.Popen(
+        [sys.executable, SERVER_SCRIPT, '--headless', '--host', '127.0.0.1', '--port', str(port),
+         '--server', server, '--media-source', 'replay', '--replay-trace', trace, '--no-history',
+         '--settings-file', settings_file],
+        stdout=log_file, stderr=subprocess.STDOUT
+    )
+    deadline = time.monotonic() + SERVER_START_TIMEOUT
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"server exited with code {process.returncode}")
+        try:
+            with socket.create_connection(('127.0.0.1', port), timeout=1) as s:
+                s.sendall(b"GET /media HTTP/1.1\r\nHost: 127.0.0.1\r\nConnection: close\r\n\r\n")
+                if s.recv(12).startswith(b"HTTP/1.1 200"):
+                    return process
+        except OSError:
+            pass
+        time.sleep(0.2)
+    process.kill()
+    raise RuntimeError(f"server did not answer within {SERVER_START_TIMEOUT} seconds")
+
+
+class ProcessSampler:
+    """
+    CPU seconds and resident memory of a process, from psutil or /proc. sample() returns None for
+    both when neither is available.
+    """
+    def __init__(self, pid):
+        self.pid = pid
+        self._process = None
+        try:
+            import psutil
+            self._process = psutil.Process(pid)
+        except ImportError:
+            pass
+
+    def sample(self):
+        #print("DEBUG: ProcessSampler.sample")
+        """
+        Return (CPU seconds used so far, resident memory in bytes).
+        """
+        if self._process is not None:
+            cpu = self._process.cpu_times()
+            return cpu.user + cpu.system, self._process.memory_info().rss
+        try:
+            with open(f"/proc/{self.pid}/stat", "r") as f:
+                # Fields after the command name, which may contain spaces
+                fields = f.read().rsplit(")", 1)[1].split()
+            ticks = os.sysconf('SC_CLK_TCK')
+            rss = int(fields[21]) * os.sysconf('SC_PAGE_SIZE')
+            return (int(fields[11]) + int(fields[12])) / ticks, rss
+        except (OSError, ValueError, IndexError, AttributeError):
+            return None, None
+
+
+async def sample_process(sampler, samples, stop_at):
+    while time.monotonic() < stop_at:
+        samples.append((time.monotonic(), *sampler.sample()))
+        await asyncio.sleep(SAMPLE_SECONDS)
+    samples.append((time.monotonic(), *sampler.sample()))
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    return sorted_values[min(len(sorted_values) - 1, int(fraction * len(sorted_values)))]
+
+
+def report_label(options):
+    # Streaming clients send no /media requests, so the payload only applies to polling
+    parts = (options['server'], options['mode'], options['payload'], options['encoding'])
+    return "/".join(part for part in parts if part)
+
+
+def build_report(options, stats, samples, measured_seconds):
+    #print("DEBUG: build_report")
+    routes = {}
+    total_requests = 0
+    for route in ROUTES:
+        latencies = sorted(stats.latencies[route])
+        total_requests += len(latencies)
+        routes[route] = {
+            'requests': len(latencies),
+            'errors': stats.errors[route],
+            **{
+                f'p{name}_ms': (percentile(latencies, fraction) * 1000 if latencies else None)
+                for name, fraction in (('50', 0.5), ('95', 0.95), ('99', 0.99))
+            },
+            'max_ms': latencies[-1] * 1000 if latencies else None
+        }
+
+    cpu_percent = rss_avg = rss_peak = None
+    measured = [sample for sample in samples if sample[1] is not None]
+    if len(measured) >= 2:
+        (start, cpu_start, _), (end, cpu_end, _) = measured[0], measured[-1]
+        cpu_percent = (cpu_end - cpu_start) / (end - start) * 100
+        rss_avg = sum(sample[2] for sample in measured) / len(measured) / 2 ** 20
+        rss_peak = max(sample[2] for sample in measured) / 2 ** 20
+
+    delays = sorted(stats.event_delays)
+    return {
+        'format': REPORT_FORMAT_VERSION,
+        'created': time.time(),
+        'label': report_label(options),
+        **options,
+        'measured_seconds': measured_seconds,
+        'throughput_rps': total_requests / measured_seconds,
+        'bytes_per_client_per_minute': stats.received / options['clients'] / (measured_seconds / 60),
+        'statuses': {str(status): count for status, count in sorted(stats.statuses.items())},
+        'routes': routes,
+        'stream': {
+            'events': stats.events,
+            'events_per_client_per_minute': stats.events / options['clients'] / (measured_seconds / 60),
+            **{
+                f'delay_p{name}_ms': (percentile(delays, fraction) * 1000 if delays else None)
+                for name, fraction in (('50', 0.5), ('95', 0.95), ('99', 0.99))
+            }
+        },
+        'server_cpu_percent': cpu_percent,
+        'server_rss_mb_avg': rss_avg,
+        'server_rss_mb_peak': rss_peak
+    }
+
+
+async def run_load(port, process, options):
+    #print("DEBUG: run_load")
+    """
+    Run the clients for the warmup and the measured duration and return the report.
+    """
+    stats = LoadStats()
+    started = time.monotonic()
+    measure_from = started + options['warmup']
+    stop_at = measure_from + options['duration']
+
+    clients = [
+        asyncio.ensure_future(run_client(HttpConnection('127.0.0.1', port), stats, options['mode'],
+                                         options['payload'], options['encoding'], stop_at))
+        for _ in range(options['clients'])
+    ]
+    await asyncio.sleep(max(0.0, measure_from - time.monotonic()))
+    stats.recording = True
+    samples = []
+    await sample_process(ProcessSampler(process.pid), samples, stop_at)
+    stats.recording = False
+    await asyncio.gather(*clients, return_exceptions=True)
+    return build_report(options, stats, samples, stop_at - measure_from)
+
+
+def format_ms(value):
+    return "-" if value is None else f"{value:.2f} ms"
+
+
+def format_number(value, unit=""):
+    if value is None:
+        return "-"
+    for limit, suffix in ((2 ** 30, "G"), (2 ** 20, "M"), (2 ** 10, "K")):
+        if abs(value) >= limit:
+            return f"{value / limit:.1f} {suffix}{unit}"
+    return f"{value:.1f} {unit}".rstrip()
+
+
+def report_value(report, *keys):
+    # Reports saved by older versions lack the stream numbers
+    value = report
+    for key in keys:
+        value = value.get(key) if isinstance(value, dict) else None
+    return value
+
+
+def print_report(report):
+    print(f"\n{report['label']}: {report['clients']} clients, {report['measured_seconds']:.0f} s measured")
+    print(f"{'route':<14} {'requests':>9} {'errors':>7} {'p50':>10} {'p95':>10} {'p99':>10} {'max':>10}")
+    for route, result in report['routes'].items():
+        if not (result['requests'] or result['errors']):
+            continue
+        print(f"{route:<14} {result['requests']:>9} {result['errors']:>7} {format_ms(result['p50_ms']):>10} "
+              f"{format_ms(result['p95_ms']):>10} {format_ms(result['p99_ms']):>10} {format_ms(result['max_ms']):>10}")
+    if report_value(report, 'mode') == 'stream':
+        stream = report['stream']
+        print(f"/media/stream {stream['events']} events, {stream['events_per_client_per_minute']:.1f} per client per minute, "
+              f"delay p50 {format_ms(stream['delay_p50_ms'])}, p95 {format_ms(stream['delay_p95_ms'])}, "
+              f"p99 {format_ms(stream['delay_p99_ms'])} (/media/stream latency above is until the first event)")
+    print(f"throughput {report['throughput_rps']:.1f} req/s, "
+          f"{format_number(report['bytes_per_client_per_minute'], 'B')} per client per minute, "
+          f"statuses {report['statuses']}")
+    if report['server_cpu_percent'] is None:
+        print("server CPU and memory unknown, install psutil")
+    else:
+        print(f"server CPU {report['server_cpu_percent']:.1f}%, "
+              f"RSS {report['server_rss_mb_avg']:.1f} MB average, {report['server_rss_mb_peak']:.1f} MB peak")
+
+
+def compare_reports(reports):
+    #print("DEBUG: compare_reports")
+    """
+    Print the main numbers of several reports side by side, one column per report.
+    """
+    rows = [
+        ('clients', lambda r: str(r['clients'])),
+        ('req/s', lambda r: f"{r['throughput_rps']:.1f}"),
+        ('/media p50', lambda r: format_ms(report_value(r, 'routes', '/media', 'p50_ms'))),
+        ('/media p95', lambda r: format_ms(report_value(r, 'routes', '/media', 'p95_ms'))),
+        ('/media p99', lambda r: format_ms(report_value(r, 'routes', '/media', 'p99_ms'))),
+        ('stream connect p95', lambda r: format_ms(report_value(r, 'routes', '/media/stream', 'p95_ms'))),
+        ('event delay p50', lambda r: format_ms(report_value(r, 'stream', 'delay_p50_ms'))),
+        ('event delay p99', lambda r: format_ms(report_value(r, 'stream', 'delay_p99_ms'))),
+        ('events/client/min', lambda r: "-" if report_value(r, 'mode') != 'stream'
+                                        else f"{r['stream']['events_per_client_per_minute']:.1f}"),
+        ('/ p95', lambda r: format_ms(r['routes']['/']['p95_ms'])),
+        ('/cover p95', lambda r: format_ms(r['routes']['/cover']['p95_ms'])),
+        ('errors', lambda r: str(sum(route['errors'] for route in r['routes'].values()))),
+        ('bytes/client/min', lambda r: format_number(r['bytes_per_client_per_minute'], 'B')),
+        ('server CPU', lambda r: "-" if r['server_cpu_percent'] is None else f"{r['server_cpu_percent']:.1f}%"),
+        ('server RSS peak', lambda r: "-" if r['server_rss_mb_peak'] is None else f"{r['server_rss_mb_peak']:.1f} MB")
+    ]
+    width = max(20, *(len(report['label']) + 2 for report in reports))
+    print(f"\n{'':<20}" + "".join(f"{report['label']:>{width}}" for report in reports))
+    for name, value in rows:
+        print(f"{name:<20}" + "".join(f"{value(report):>{width}}" for report in reports))
+
+
+def load_reports(paths):
+    reports = []
+    for path in paths:
+        with open(path, "r") as f:
+            reports.extend(json.load(f)['runs'])
+    return reports
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Load test the widget server with simulated overlay clients.")
+    parser.add_argument("--clients", type=int, default=100, help="simulated overlay pages (default: %(default)s)")
+    parser.add_argument("--duration", type=float, default=60, help="measured seconds per run (default: %(default)s)")
+    parser.add_argument("--warmup", type=float, default=5, help="seconds before measuring (default: %(default)s)")
+    parser.add_argument("--server", nargs="+", choices=("async", "flask"), default=["async"],
+                        help="server(s) to test (default: async)")
+    parser.add_argument("--mode", nargs="+", choices=("stream", "poll"), default=["stream"],
+                        help="stream follows /media/stream like the layouts, poll requests /media every second "
+                             "like the layouts' fallback (default: stream)")
+    parser.add_argument("--payload", nargs="+", choices=("delta", "full"), default=["delta"],
+                        help="with --mode poll: delta polls with ?since= like the layouts, full polls without (default: delta)")
+    parser.add_argument("--encoding", nargs="+", choices=("gzip", "identity"), default=["gzip"],
+                        help="accept gzip like browsers, or no compression (default: gzip)")
+    parser.add_argument("--track-seconds", type=float, default=30, help="length of the stub tracks (default: %(default)s)")
+    parser.add_argument("--cover-kb", type=int, default=100, help="size of the stub covers (default: %(default)s)")
+    parser.add_argument("--json", metavar="FILE", help="write the reports to this JSON file")
+    parser.add_argument("--compare", metavar="FILE", nargs="+", help="print saved reports side by side without running")
+    args = parser.parse_args(argv)
+
+    if args.compare:
+        reports = load_reports(args.compare)
+        for report in reports:
+            print_report(report)
+        compare_reports(reports)
+        return 0
+
+    temp_dir = tempfile.mkdtemp(prefix="nowplaying_loadtest_")
+    trace = os.path.join(temp_dir, "stub_trace.jsonl")
+    write_stub_trace(trace, 4, args.track_seconds, args.cover_kb * 1024)
+    settings_file = os.path.join(temp_dir, "settings.json")
+
+    reports = []
+    try:
+        runs = [
+            (server, mode, payload, encoding)
+            for server in args.server
+            for mode in args.mode
+            for payload in (args.payload if mode == 'poll' else [None])
+            for encoding in args.encoding
+        ]
+        for server, mode, payload, encoding in runs:
+            options = {
+                'server': server, 'mode': mode, 'payload': payload, 'encoding': encoding, 'clients': args.clients,
+                'duration': args.duration, 'warmup': args.warmup, 'cover_kb': args.cover_kb
+            }
+            port = free_port()
+            log_path = os.path.join(temp_dir, f"server_{report_label(options).replace('/', '_')}.log")
+            with open(log_path, "w") as log_file:
+                try:
+                    process = start_server(server, port, trace, settings_file, log_file)
+                except RuntimeError as e:
+                    log_file.flush()
+                    with open(log_path, "r") as f:
+                        log_tail = f.read()[-2000:]
+                    print(f"Error starting the {server} server: {e}\n{log_tail}")
+                    continue
+                try:
+                    report = asyncio.run(run_load(port, process, options))
+                finally:
+                    process.terminate()
+                    try:
+                        process.wait(5)
+                    except subprocess.TimeoutExpired:
+                        process.kill()
+            print_report(report)
+            reports.append(report)
+    finally:
+        shutil.rmtree(temp_dir, ignore_errors=True)
+
+    if len(reports) > 1:
+        compare_reports(reports)
+    if args.json:
+        temp_file = f"{args.json}.tmp"
+        with open(temp_file, "w") as f:
+            json.dump({'format': REPORT_FORMAT_VERSION, 'runs': reports}, f, indent=2)
+        os.replace(temp_file, args.json)
+        print(f"Saved reports: {args.json}")
+    return 0 if reports else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
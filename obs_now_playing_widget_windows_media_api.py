@@ -1,328 +1,3686 @@
+import time
+startup_time = time.perf_counter()  # see probe_first_media_response
 import asyncio
 import threading
-import base64
-import time
-import tkinter as tk
-from flask import Flask, jsonify, render_template, redirect, url_for
-from winsdk.windows.media.control import GlobalSystemMediaTransportControlsSessionManager as MediaManager
-from winsdk.windows.storage.streams import DataReader
+import queue
+import atexit
+import argparse
 import os
 import sys
 import webbrowser
 import socket
 import shutil
 import json
+import urllib.parse
+
+import math
+import re
+import unicodedata
+import hashlib
+import hmac
+import base64
+import gzip
+import bisect
+import datetime
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+import io
+
+# tkinter, PIL, Flask, winsdk and brotli are imported on first use, so a headless start
+# only loads what it runs (see load_winsdk, create_flask_app, create_gui)
+MediaManager = None
+DataReader = None
+brotli = None
+
+
+# Content addressed LRU cover cache: hash -> processed cover (see process_cover), limited by size in bytes
+cover_store = OrderedDict()
+cover_store_lock = threading.Lock()
+cover_store_bytes = 0
+COVER_CACHE_MAX_BYTES = 32 * 1024 * 1024
+COVER_WIDGET_SIZE = 512  # max width/height of the cover served to the widget
+COVER_WIDGET_QUALITY = 85
+COVER_GUI_SIZE = (60, 60)
+COVER_PROCESSING = True  # decode and resize covers, off when headless: covers are served as they are
+
+
+
+def get_exe_dir():
+    #print("DEBUG: get_exe_dir")
+    """
+    Get the directory where the executable is located (not the temp folder).
+    """
+    if getattr(sys, '_MEIPASS', False):
+        return os.path.dirname(sys.executable)  # Path of the .exe
+    return os.path.dirname(os.path.abspath(__file__))
+
+
+SETTINGS_FILE = os.path.join(get_exe_dir(), "now_playing_settings.json")
+SETTINGS_SAVE_DELAY = 0.5  # seconds changes are collected before they are written
+SETTINGS_WATCH_INTERVAL = 2  # seconds between checks for edits of the settings file
+
+
+class SettingsStore:
+    """
+    Thread-safe in-memory settings, the single source of truth while running. Changes are
+    written in the background after SETTINGS_SAVE_DELAY seconds through a temp file and rename,
+    so a crash never leaves a half written file. Edits of the file from outside are picked
+    up by a watcher thread and passed on to the listeners.
+    """
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._write_lock = threading.Lock()
+        self._values = {}
+        self._file_stat = None
+        self._dirty = False
+        self._save_timer = None
+        self._listeners = []
+        self._watcher = None
+        self._load()
+
+    def _stat(self):
+        try:
+            stat = os.stat(self.path)
+            return stat.st_mtime_ns, stat.st_size
+        except OSError:
+            return None
+
+    def _load(self):
+        #print("DEBUG: SettingsStore._load")
+        """
+        Read the settings file, returns True if the values changed.
+        """
+        stat = self._stat()
+        values = {}  # Default empty settings
+        if stat is not None:
+            try:
+                with open(self.path, "r") as f:
+                    values = json.load(f)
+            except Exception as e:
+                print(f"Error loading settings: {e}")
+                return False
+
+        with self._lock:
+            changed = values != self._values
+            self._values = values
+            self._file_stat = stat
+        return changed
+
+    def get(self, key, default=None):
+        with self._lock:
+            return self._values.get(key, default)
+
+    def snapshot(self):
+        with self._lock:
+            return dict(self._values)
+
+    def update(self, **changes):
+        #print("DEBUG: SettingsStore.update")
+        """
+        Change settings in memory, a value of None removes the key. Written to disk later.
+        """
+        with self._lock:
+            for key, value in changes.items():
+                if value is None:
+                    self._values.pop(key, None)
+                else:
+                    self._values[key] = value
+            self._dirty = True
+            if self._save_timer is not None:
+                self._save_timer.cancel()
+            self._save_timer = threading.Timer(SETTINGS_SAVE_DELAY, self.flush)
+            self._save_timer.daemon = True
+            self._save_timer.start()
+
+    def flush(self):
+        #print("DEBUG: SettingsStore.flush")
+        """
+        Write pending changes now: to a temp file first, which then replaces the settings file.
+        """
+        with self._write_lock:
+            with self._lock:
+                if self._save_timer is not None:
+                    self._save_timer.cancel()
+                    self._save_timer = None
+                if not self._dirty:
+                    return
+                values = dict(self._values)
+                self._dirty = False
+
+            temp_file = f"{self.path}.tmp"
+            try:
+                with open(temp_file, "w") as f:
+                    json.dump(values, f)
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.replace(temp_file, self.path)
+                with self._lock:
+                    self._file_stat = self._stat()
+                print(f"Saved settings: {values}")
+            except Exception as e:
+                print(f"Error saving settings: {e}")
+
+    def add_listener(self, callback):
+        """
+        Call `callback(settings dict)` from the watcher thread when the file was edited from outside.
+        """
+        self._listeners.append(callback)
+
+    def start_watching(self):
+        if self._watcher is None:
+            self._watcher = threading.Thread(target=self._watch, daemon=True)
+            self._watcher.start()
+
+    def _watch(self):
+        while True:
+            time.sleep(SETTINGS_WATCH_INTERVAL)
+            stat = self._stat()
+            with self._lock:
+                # Our own pending changes win until they are written
+                outside_edit = stat is not None and stat != self._file_stat and not self._dirty
+            if outside_edit and self._load():
+                values = self.snapshot()
+                print(f"Settings file changed, reloaded: {values}")
+                for listener in self._listeners:
+                    try:
+                        listener(values)
+                    except Exception as e:
+                        print(f"Error in settings listener: {e}")
+
+
+def save_settings(locked_app=None, layout=None):
+    #print("DEBUG: save_settings")
+    changes = {"locked_app": locked_app}
+    if layout is not None:
+        changes["layout"] = layout
+    elif settings.get("layout") is None:
+        changes["layout"] = "horizontal"  # or some default fallback
+    settings.update(**changes)
+
+def clear_locked_app():
+    save_settings(locked_app=None)
+
+
+
+
+
+def is_significant_change(new_info, old_info):
+    #print("DEBUG: is_significant_change")
+    if not old_info:
+        return True
+
+    keys_to_check = ['title', 'artist', 'app_id', 'status', 'duration', 'cover', 'playback_rate', 'stale']
+    for key in keys_to_check:
+        if new_info.get(key) != old_info.get(key):
+            return True
+    
+    # Clients advance the position on their own while playing, so only a jump against
+    # the extrapolated old position (a seek) is significant
+    expected_position = old_info.get('position', 0)
+    if old_info.get('status') == "Playing" and 'position_time' in new_info and 'position_time' in old_info:
+        expected_position += (new_info['position_time'] - old_info['position_time']) * old_info.get('playback_rate', 1.0)
+    if math.fabs(new_info.get('position', 0) - expected_position) > 0.5:
+        return True
+    
+    return False
+
+
+
+
+def copy_templates():
+    #print("DEBUG: copy_templates")
+    """
+    Copy the external 'templates' folder to the temp directory if needed.
+    """
+    exe_dir = get_exe_dir()
+    temp_dir = getattr(sys, '_MEIPASS', exe_dir)  # Handle both .exe and script
+
+    src_templates = os.path.join(exe_dir, 'templates')
+    dest_templates = os.path.join(temp_dir, 'templates')
+
+    # Copy only if the folder exists and is not already copied
+    if os.path.exists(src_templates) and not os.path.exists(dest_templates):
+        shutil.copytree(src_templates, dest_templates)
+        print(f"Copied templates to: {dest_templates}")
+    return dest_templates
+
+
+
+# Detect the base directory (location of the .exe)
+base_dir = os.path.dirname(os.path.abspath(__file__))
+template_dir = os.path.join(base_dir, 'templates')
+
+
+class MediaSnapshot:
+    """
+    Immutable media state of one version. Updates swap in a new snapshot instead of mutating
+    this one, so readers never see a mix of two tracks. The JSON body is encoded once per
+    version, its gzip copy and delta bodies once on first use.
+    """
+    MAX_CACHED_DELTAS = 8
+
+    def __init__(self, version, info, field_versions=None):
+        self.version = version
+        self.info = dict(info)  # never mutated
+        self.field_versions = field_versions or {key: version for key in self.info}
+        self.json = json.dumps({**self.info, 'version': version}).encode('utf-8')
+        self._gzip = None
+        self._deltas = OrderedDict()
+        self._lock = threading.Lock()
+
+    def gzip_json(self):
+        if self._gzip is None:
+            self._gzip = gzip.compress(self.json)
+        return self._gzip
+
+    def delta_json(self, since):
+        """
+        JSON of only the fields changed after version `since`, marked with a 'since' key.
+        """
+        with self._lock:
+            if since not in self._deltas:
+                payload = {key: value for key, value in self.info.items() if self.field_versions.get(key, 0) > since}
+                payload['since'] = since
+                payload['version'] = self.version
+                self._deltas[since] = json.dumps(payload).encode('utf-8')
+                if len(self._deltas) > self.MAX_CACHED_DELTAS:
+                    self._deltas.popitem(last=False)
+            return self._deltas[since]
+
+    def body(self, since=None, accept_gzip=False):
+        """
+        Return (bytes, content encoding or None) to send for a client at version `since`.
+        """
+        if since is not None and since < self.version:
+            return self.delta_json(since), None
+        if accept_gzip and len(self.json) >= GZIP_MIN_BYTES:
+            return self.gzip_json(), 'gzip'
+        return self.json, None
+
+    def with_changes(self, new_info):
+        """
+        Return the next snapshot with `new_info` applied.
+        """
+        version = self.version + 1
+        field_versions = dict(self.field_versions)
+        for key, value in new_info.items():
+            if self.info.get(key) != value:
+                field_versions[key] = version
+        return MediaSnapshot(version, {**self.info, **new_info}, field_versions)
+
+
+def with_server_time(json_body):
+    """
+    Append the current server clock to an encoded JSON object without re-encoding it.
+    """
+    return json_body[:-1] + b', "server_time": ' + repr(time.monotonic()).encode('ascii') + b'}'
+
+
+DEFAULT_MEDIA_INFO = {
+    'title': 'Unknown',
+    'artist': 'Unknown',
+    'position': 0,
+    'duration': 0,
+    'cover': '',
+    'app_id': 'Unknown',
+    'status': 'Stopped',
+    'position_time': 0,  # server time.monotonic() the position was sampled at
+    'playback_rate': 1.0,
+    'timeline_updated': None,  # epoch seconds the player last updated its timeline
+    'accent': '',  # colors from the cover (see compute_cover_palette), '' for the layout's defaults
+    'background': '',
+    'stale': False  # True while the media source fails and this is the last good media info
+}
+
+# Every applied update swaps in a new snapshot with the next version. Versions start at the
+# startup time in ms so they keep increasing across restarts and clients never get a false 304
+# from an older process. media_info and media_version always mirror media_snapshot.
+media_snapshot = MediaSnapshot(int(time.time() * 1000), DEFAULT_MEDIA_INFO)
+media_info = media_snapshot.info
+media_version = media_snapshot.version
+media_changed = threading.Condition()  # serializes updates, wakes /media/stream clients
+
+# Media info of every session by normalized app id, each app with its own version. Closed apps
+# keep a default snapshot in app_snapshots so their clients see the change.
+app_media_info = {}
+app_snapshots = {}
+app_media_version = int(time.time() * 1000)
+EMPTY_APP_SNAPSHOT = MediaSnapshot(0, DEFAULT_MEDIA_INFO)
+sessions_json = b"{}"
+GZIP_MIN_BYTES = 1024  # smaller JSON bodies are not worth compressing
+media_listeners = []  # called with the new media info after every update, see add_media_listener
+STREAM_KEEPALIVE_SECONDS = 15
+STREAM_RETRY_MS = 2000
+
+STATUS_MAP = {
+    0: "Closed",
+    1: "Stopped",
+    5: "Paused",
+    4: "Playing"
+}
+
+POLL_INTERVAL = 1  # seconds between media updates while playing
+POLL_MIN_INTERVAL = 0.25  # fastest polling, right after a change and at the end of a track
+POLL_MAX_INTERVAL = 10  # slowest polling, reached while nothing plays
+POLL_BACKOFF = 1.5  # the interval grows by this factor per poll while nothing plays
+POLL_FAST_POLLS = 3  # polls at POLL_MIN_INTERVAL after a track or status change
+POLL_TRACK_END_WINDOW = 2  # seconds before the end of a track polled at POLL_MIN_INTERVAL
+RECONCILE_INTERVAL = 10  # seconds between full re-queries in event driven mode
+WINRT_CALL_TIMEOUT = 5  # seconds a single async Windows media API call may take
+MEDIA_SOURCE_TIMEOUT = 20  # seconds a media source may take to return all sessions
+THUMBNAIL_TIMEOUT = 15  # seconds a media source may take to read a cover
+COVER_WAIT_TIMEOUT = 2  # seconds a poll waits for a new cover before publishing without it
+POLL_STALL_TIMEOUT = 60  # seconds a poll may take before the watchdog restarts the poller
+WATCHDOG_INTERVAL = 5  # seconds between watchdog checks of the poller
+BREAKER_FAILURES = 3  # failures in a row that open a circuit breaker
+BREAKER_COOLDOWN = 5  # seconds an open circuit breaker waits before the next try
+BREAKER_MAX_COOLDOWN = 120  # the cooldown doubles on every failed try up to this
+GUI_QUEUE_POLL_MS = 100  # how often the control window checks for queued media updates
+
+# Store current layout
+template_name = 'horizontal'
+layout_generation = 0  # raised on every layout switch, stream clients showing the default layout reload
+
+
+locked_app_id = None  # Global lock state
+
+settings = None  # SettingsStore, loaded at startup, see main
+http_port = 5000
+first_poll_done = threading.Event()  # set once the first poll filled media_info, see probe_first_media_response
+STARTUP_PROBE_TIMEOUT = 60  # seconds the startup probe waits for the server
+
+
+def get_local_ip():
+    #print("DEBUG: get_local_ip")
+    try:
+        hostname = socket.gethostname()
+        local_ip = socket.gethostbyname(hostname)
+        return local_ip
+    except Exception as e:
+        print(f"Error getting local IP: {e}")
+        return "127.0.0.1"
+
+
+def set_layout(layout):
+    global template_name
+    #print("DEBUG: set_layout")
+    template_name = layout
+    notify_layout_change()
+
+
+def notify_layout_change():
+    """
+    Tell open widget pages through /media/stream to reload, so they show the current layout.
+    """
+    global layout_generation
+    #print("DEBUG: notify_layout_change")
+    with media_changed:
+        layout_generation += 1
+        media_changed.notify_all()
+    wake_async_streams()
+
+# ---------------------------------------------------------------------------
+# Metrics
+#
+# Counters, gauges and histograms kept in memory and served on /metrics in the Prometheus
+# text format, to tell stalls of the media API, cover decoding and HTTP load apart.
+# ---------------------------------------------------------------------------
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+METRICS_CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+METRIC_DEFINITIONS = {
+    # name: (type, help, histogram buckets)
+    'nowplaying_winrt_call_seconds': ('histogram', 'Latency of Windows media API calls by call', LATENCY_BUCKETS),
+    'nowplaying_cover_extract_seconds': ('histogram', 'Time to read (stage=read) and decode/resize (stage=process) a cover', LATENCY_BUCKETS),
+    'nowplaying_cover_bytes': ('histogram', 'Size of newly extracted cover thumbnails', SIZE_BUCKETS),
+    'nowplaying_cover_cache_bytes': ('gauge', 'Bytes held by the cover cache', None),
+    'nowplaying_cover_cache_entries': ('gauge', 'Covers held by the cover cache', None),
+    'nowplaying_polls_total': ('counter', 'Media poll loop iterations', None),
+    'nowplaying_poll_duration_seconds': ('histogram', 'Time spent querying and applying media info per poll', LATENCY_BUCKETS),
+    'nowplaying_poll_lag_seconds': ('histogram', 'Time between polls beyond the scheduled interval', LATENCY_BUCKETS),
+    'nowplaying_poll_interval_seconds': ('gauge', 'Currently scheduled time until the next poll', None),
+    'nowplaying_significant_changes_total': ('counter', 'Significant media changes, for the widget (scope=widget) and per app (scope=app)', None),
+    'nowplaying_http_requests_total': ('counter', 'HTTP requests by route and status', None),
+    'nowplaying_http_request_duration_seconds': ('histogram', 'Time to handle an HTTP request, streams until their headers are sent', LATENCY_BUCKETS),
+    'nowplaying_http_response_bytes': ('histogram', 'HTTP response body size, not counted for streams', SIZE_BUCKETS),
+    'nowplaying_stream_clients': ('gauge', 'Connected /media/stream clients', None),
+    'nowplaying_media_call_timeouts_total': ('counter', 'Media API and media source calls that missed their deadline, by call', None),
+    'nowplaying_poller_stalls_total': ('counter', 'Polls that did not finish in time, the poller was restarted', None),
+    'nowplaying_circuit_breaker_opens_total': ('counter', 'Circuit breakers opened for the media source (scope=source), a session (scope=session) or a cover (scope=cover)', None),
+    'nowplaying_stale_responses_total': ('counter', 'Polls that served the last good media info of an app instead of a fresh one', None)
+}
+
+
+def format_metric_labels(labels):
+    if not labels:
+        return ""
+    escaped = (
+        (name, str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+        for name, value in labels
+    )
+    return "{" + ",".join(f'{name}="{value}"' for name, value in escaped) + "}"
+
+
+class Metrics:
+    """
+    Thread-safe in-memory metrics, see METRIC_DEFINITIONS. Histograms keep one count per bucket,
+    rendering makes them cumulative.
+    """
+    def __init__(self, definitions):
+        self.definitions = definitions
+        self._lock = threading.Lock()
+        self._values = {}  # (name, sorted label items) -> number, or [bucket counts, sum, count] for histograms
+
+    def inc(self, name, amount=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def set(self, name, value, **labels):
+        with self._lock:
+            self._values[(name, tuple(sorted(labels.items())))] = value
+
+    def observe(self, name, value, **labels):
+        buckets = self.definitions[name][2]
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self._values.get(key)
+            if histogram is None:
+                histogram = self._values[key] = [[0] * (len(buckets) + 1), 0.0, 0]
+            histogram[0][bisect.bisect_left(buckets, value)] += 1
+            histogram[1] += value
+            histogram[2] += 1
+
+    @contextmanager
+    def time(self, name, **labels):
+        """
+        Observe the run time of a with block (awaits included) in the histogram `name`.
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def render(self):
+        #print("DEBUG: Metrics.render")
+        """
+        All metrics in the Prometheus text exposition format.
+        """
+        with self._lock:
+            values = {
+                key: [list(value[0]), value[1], value[2]] if isinstance(value, list) else value
+                for key, value in self._values.items()
+            }
+
+        lines = []
+        for name, (metric_type, help_text, buckets) in self.definitions.items():
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {metric_type}")
+            for (key_name, labels), value in sorted(values.items()):
+                if key_name != name:
+                    continue
+                if metric_type != 'histogram':
+                    lines.append(f"{name}{format_metric_labels(labels)} {value}")
+                    continue
+                counts, total, count = value
+                cumulative = 0
+                for bound, bucket_count in zip(buckets + (float('inf'),), counts):
+                    cumulative += bucket_count
+                    le = "+Inf" if bound == float('inf') else repr(float(bound))
+                    lines.append(f"{name}_bucket{format_metric_labels(labels + (('le', le),))} {cumulative}")
+                lines.append(f"{name}_sum{format_metric_labels(labels)} {total!r}")
+                lines.append(f"{name}_count{format_metric_labels(labels)} {count}")
+        return ("\n".join(lines) + "\n").encode('utf-8')
+
+
+metrics = Metrics(METRIC_DEFINITIONS)
+
+
+def winrt_timer(call):
+    return metrics.time('nowplaying_winrt_call_seconds', call=call)
+
+
+async def with_deadline(call, awaitable, timeout):
+    #print("DEBUG: with_deadline")
+    """
+    Await `awaitable` for at most `timeout` seconds. A call that misses its deadline is counted
+    and raises TimeoutError, so one hung call cannot stall the poll loop.
+    """
+    try:
+        return await asyncio.wait_for(awaitable, timeout)
+    except asyncio.TimeoutError:
+        metrics.inc('nowplaying_media_call_timeouts_total', call=call)
+        raise TimeoutError(f"{call} did not return within {timeout} seconds") from None
+
+
+async def winrt_call(call, awaitable):
+    # An async Windows media API call, timed and with a deadline
+    with winrt_timer(call):
+        return await with_deadline(call, awaitable, WINRT_CALL_TIMEOUT)
+
+
+class CircuitBreaker:
+    """
+    Stops calling a failing media source, session or cover for a while. After `threshold` failures
+    in a row the breaker opens: allow() is False for a cooldown, which doubles on every failed
+    try up to BREAKER_MAX_COOLDOWN. After the cooldown one try is let through, a success closes it.
+    """
+    def __init__(self, name, scope, threshold=BREAKER_FAILURES):
+        self.name = name
+        self.scope = scope  # metrics label, 'source', 'session' or 'cover'
+        self.threshold = threshold
+        self.failures = 0
+        self.cooldown = BREAKER_COOLDOWN
+        self.open_until = None  # time.monotonic() of the next try while open
+
+    def allow(self, now=None):
+        if self.open_until is None:
+            return True
+        return (time.monotonic() if now is None else now) >= self.open_until
+
+    def record_success(self):
+        #print("DEBUG: CircuitBreaker.record_success")
+        if self.open_until is not None:
+            print(f"{self.name} recovered")
+        self.failures = 0
+        self.cooldown = BREAKER_COOLDOWN
+        self.open_until = None
+
+    def record_failure(self, now=None):
+        #print("DEBUG: CircuitBreaker.record_failure")
+        now = time.monotonic() if now is None else now
+        self.failures += 1
+        if self.open_until is not None:
+            # The try after the cooldown failed as well
+            self.cooldown = min(self.cooldown * 2, BREAKER_MAX_COOLDOWN)
+        elif self.failures >= self.threshold:
+            metrics.inc('nowplaying_circuit_breaker_opens_total', scope=self.scope)
+            print(f"{self.name} failed ({self.failures} in a row), trying again in {self.cooldown} seconds")
+        else:
+            return
+        self.open_until = now + self.cooldown
+
+
+def record_http_request(route, status, seconds, size=None):
+    #print("DEBUG: record_http_request")
+    """
+    Count a handled request of `route` (the route pattern, see metrics_route), `size` is None for streams.
+    """
+    metrics.inc('nowplaying_http_requests_total', route=route, status=str(status))
+    metrics.observe('nowplaying_http_request_duration_seconds', seconds, route=route)
+    if size is not None:
+        metrics.observe('nowplaying_http_response_bytes', size, route=route)
+
+
+def get_metrics_body():
+    #print("DEBUG: get_metrics_body")
+    """
+    The /metrics body, with the gauges that are read at scrape time.
+    """
+    with cover_store_lock:
+        metrics.set('nowplaying_cover_cache_bytes', cover_store_bytes)
+        metrics.set('nowplaying_cover_cache_entries', len(cover_store))
+    return metrics.render()
+
+
+# ---------------------------------------------------------------------------
+# Play history
+#
+# Every finished play (track change, or the player closed) of every app is appended to a
+# SQLite database in WAL mode, written in batches. The most recent plays are also kept in
+# memory, so /history/recent never touches the disk.
+# ---------------------------------------------------------------------------
+
+HISTORY_FILE = os.path.join(get_exe_dir(), "now_playing_history.db")
+HISTORY_FLUSH_SECONDS = 10  # max delay before finished plays are written
+HISTORY_RECENT_SIZE = 50  # plays kept in memory
+HISTORY_MIN_LISTENED = 1  # seconds, plays listened to shorter are not recorded
+HISTORY_DEFAULT_LIMIT = 100
+HISTORY_MAX_LIMIT = 1000
+
+HISTORY_SCHEMA = """
+CREATE TABLE IF NOT EXISTS plays (
+    id INTEGER PRIMARY KEY,
+    title TEXT NOT NULL,
+    artist TEXT NOT NULL,
+    app_id TEXT,
+    app TEXT,
+    started REAL NOT NULL,
+    ended REAL NOT NULL,
+    listened REAL NOT NULL,
+    duration REAL,
+    cover TEXT
+);
+CREATE INDEX IF NOT EXISTS plays_started ON plays (started);
+CREATE INDEX IF NOT EXISTS plays_app_started ON plays (app, started);
+"""
+HISTORY_FIELDS = ('title', 'artist', 'app_id', 'app', 'started', 'ended', 'listened', 'duration', 'cover')
+
+
+class PlayHistory:
+    """
+    Tracks the play in progress of every app from the media info of each poll (see observe) and
+    logs finished plays. Times are epoch seconds, `listened` counts only the time spent playing.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.recent = deque(maxlen=HISTORY_RECENT_SIZE)  # newest first
+        self._playing = {}  # normalized app id -> play in progress
+        self._pending = []  # finished plays not written yet
+        self._lock = threading.Lock()
+        self._db_lock = threading.Lock()
+        self._db = None
+        self._flush_timer = None
+
+    def _connect(self):
+        if self._db is None:
+            import sqlite3
+
+            db = sqlite3.connect(self.path, check_same_thread=False)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            db.executescript(HISTORY_SCHEMA)
+            self._db = db
+        return self._db
+
+    def observe(self, infos, now=None):
+        #print("DEBUG: PlayHistory.observe")
+        """
+        Update the plays in progress from {normalized app id: media info}, finishing those whose track changed or whose app is gone.
+        """
+        now = time.time() if now is None else now
+        with self._lock:
+            for app_key, play in list(self._playing.items()):
+                info = infos.get(app_key)
+                if info is None or (info['title'], info['artist']) != (play['title'], play['artist']):
+                    del self._playing[app_key]
+                    self._finish(play, now)
+
+            for app_key, info in infos.items():
+                play = self._playing.get(app_key)
+                if play is None:
+                    play = self._playing[app_key] = {
+                        'title': info['title'],
+                        'artist': info['artist'],
+                        'app_id': info['app_id'],
+                        'app': app_key,
+                        'started': now,
+                        'listened': 0.0,
+                        'cover': None,
+                        'playing': False,
+                        'seen': now
+                    }
+                elif play['playing']:
+                    play['listened'] += now - play['seen']
+                play['seen'] = now
+                play['playing'] = info['status'] == "Playing"
+                play['duration'] = info['duration']
+                play['cover'] = cover_hash_from_url(info['cover']) or play['cover']
+
+    def _finish(self, play, now):
+        if play['playing']:
+            play['listened'] += now - play['seen']
+        if play['listened'] < HISTORY_MIN_LISTENED:
+            return
+        play['ended'] = now if play['playing'] else play['seen']
+        entry = {key: play[key] for key in HISTORY_FIELDS}
+        self.recent.appendleft(entry)
+        self._pending.append(entry)
+        if self._flush_timer is None:
+            self._flush_timer = threading.Timer(HISTORY_FLUSH_SECONDS, self.flush)
+            self._flush_timer.daemon = True
+            self._flush_timer.start()
+
+    def flush(self):
+        #print("DEBUG: PlayHistory.flush")
+        """
+        Write all finished plays in one transaction.
+        """
+        with self._db_lock:
+            with self._lock:
+                if self._flush_timer is not None:
+                    self._flush_timer.cancel()
+                    self._flush_timer = None
+                pending, self._pending = self._pending, []
+            if not pending:
+                return
+            try:
+                db = self._connect()
+                with db:
+                    db.executemany(
+                        f"INSERT INTO plays ({', '.join(HISTORY_FIELDS)}) VALUES ({', '.join('?' * len(HISTORY_FIELDS))})",
+                        [tuple(entry[key] for key in HISTORY_FIELDS) for entry in pending]
+                    )
+            except Exception as e:
+                print(f"Error writing play history: {e}")
+
+    def close(self):
+        #print("DEBUG: PlayHistory.close")
+        """
+        Finish the plays in progress and write everything, on shutdown.
+        """
+        now = time.time()
+        with self._lock:
+            for play in self._playing.values():
+                self._finish(play, now)
+            self._playing = {}
+        self.flush()
+
+    def get_recent(self, app_key=None, limit=HISTORY_RECENT_SIZE):
+        with self._lock:
+            return [entry for entry in self.recent if app_key is None or entry['app'] == app_key][:limit]
+
+    def query(self, start=None, end=None, app_key=None, limit=HISTORY_DEFAULT_LIMIT):
+        #print("DEBUG: PlayHistory.query")
+        """
+        Plays started in [start, end) of one app or all apps, newest first.
+        """
+        self.flush()
+        conditions, params = [], []
+        if start is not None:
+            conditions.append("started >= ?")
+            params.append(start)
+        if end is not None:
+            conditions.append("started < ?")
+            params.append(end)
+        if app_key:
+            conditions.append("app = ?")
+            params.append(app_key)
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+        with self._db_lock:
+            rows = self._connect().execute(
+                f"SELECT {', '.join(HISTORY_FIELDS)} FROM plays {where} ORDER BY started DESC LIMIT ?",
+                params + [limit]
+            ).fetchall()
+        return [dict(zip(HISTORY_FIELDS, row)) for row in rows]
+
+
+play_history = None  # PlayHistory, unless disabled, see main
+
+
+def parse_history_time(value):
+    """
+    Epoch seconds or an ISO 8601 date/time (local time unless it has an offset).
+    """
+    try:
+        return float(value)
+    except ValueError:
+        return datetime.datetime.fromisoformat(value).timestamp()
+
+
+def get_history_body(path_parts, args):
+    #print("DEBUG: get_history_body")
+    """
+    Return (status, JSON body) for /history?from=&to=&app=&limit= and /history/recent?app=&limit=.
+    """
+    if play_history is None:
+        return 404, b'{"error": "play history is disabled"}'
+    try:
+        try:
+            limit = int(args.get('limit') or HISTORY_DEFAULT_LIMIT)
+        except ValueError:
+            raise ValueError(f"limit must be an integer: {args.get('limit')!r}") from None
+        # SQLite reads LIMIT -1 as no limit
+        limit = max(1, min(limit, HISTORY_MAX_LIMIT))
+        if path_parts == ['history', 'recent']:
+            plays = play_history.get_recent(args.get('app'), limit)
+        else:
+            plays = play_history.query(
+                parse_history_time(args['from']) if args.get('from') else None,
+                parse_history_time(args['to']) if args.get('to') else None,
+                args.get('app'),
+                limit
+            )
+    except ValueError as e:
+        return 400, json.dumps({'error': str(e)}).encode('utf-8')
+    except Exception as e:
+        print(f"Error querying play history: {e}")
+        return 500, b'{"error": "history query failed"}'
+    return 200, json.dumps({
+        'plays': [{**play, 'cover': cover_url(play['cover'])} for play in plays]
+    }).encode('utf-8')
+
+
+# ---------------------------------------------------------------------------
+# File export
+#
+# For OBS Text (GDI+) and Image sources instead of a browser source: the current media info
+# is written to files in an export folder. Files are replaced atomically and only when their
+# content changed. The widget's rules apply: while nothing plays, the texts are empty and the
+# cover is a transparent pixel.
+# ---------------------------------------------------------------------------
+
+EXPORT_FILES = {
+    # field: default file name, a field set to "" or null in the export_files setting is not written
+    'title': 'title.txt',
+    'artist': 'artist.txt',
+    'artist_title': 'artist_title.txt',  # "Artist - Title"
+    'duration': 'duration.txt',
+    'cover': 'cover.png',
+    'position': 'position.txt'  # "1:23 / 4:56", only written with a position interval
+}
+EXPORT_MIN_POSITION_INTERVAL = 1  # seconds, the position file is never written more often
+EXPORT_REPLACE_RETRIES = 5  # os.replace fails on Windows while OBS is reading the file
+EXPORT_IMAGE_FORMATS = {'.png': ('PNG', 'image/png'), '.jpg': ('JPEG', 'image/jpeg'), '.jpeg': ('JPEG', 'image/jpeg')}
+EMPTY_PNG = base64.b64decode(
+    "iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAYAAAAfFcSJAAAADUlEQVR42mNgYGBgAAAABQABeqhXUAAAAABJRU5ErkJggg=="
+)
+EMPTY_JPEG = base64.b64decode(  # JPEG has no transparency, a black pixel
+    "/9j/4AAQSkZJRgABAQAAAQABAAD/2wBDABALDA4MChAODQ4SERATGCgaGBYWGDEjJR0oOjM9PDkzODdASFxOQERXRTc4UG1RV19iZ2hnPk1xeXBkeFxlZ2P/"
+    "2wBDARESEhgVGC8aGi9jQjhCY2NjY2NjY2NjY2NjY2NjY2NjY2NjY2NjY2NjY2NjY2NjY2NjY2NjY2NjY2NjY2NjY2P/wAARCAABAAEDASIAAhEBAxEB/8QA"
+    "FQABAQAAAAAAAAAAAAAAAAAAAAf/xAAUEAEAAAAAAAAAAAAAAAAAAAAA/8QAFAEBAAAAAAAAAAAAAAAAAAAAAP/EABQRAQAAAAAAAAAAAAAAAAAAAAD/2gAM"
+    "AwEAAhEDEQA/AJ+AD//Z"
+)
+
+
+def format_export_time(seconds):
+    seconds = max(0, int(seconds))
+    hours, minutes, secs = seconds // 3600, (seconds % 3600) // 60, seconds % 60
+    if hours > 0:
+        return f"{hours}:{minutes:02}:{secs:02}"
+    return f"{minutes}:{secs:02}"
+
+
+def write_file_atomic(path, data):
+    #print("DEBUG: write_file_atomic")
+    """
+    Replace `path` with `data` through a temp file in the same folder, so readers never see a half written file.
+    """
+    temp_file = f"{path}.tmp"
+    with open(temp_file, "wb") as f:
+        f.write(data)
+    for attempt in range(EXPORT_REPLACE_RETRIES):
+        try:
+            os.replace(temp_file, path)
+            return
+        except PermissionError:
+            if attempt == EXPORT_REPLACE_RETRIES - 1:
+                raise
+            time.sleep(0.05)
+
+
+def export_cover_data(cover, file_name):
+    #print("DEBUG: export_cover_data")
+    """
+    Bytes of the cover at URL `cover` for the cover file, converted to the file's format (.png, .jpg)
+    if needed and Pillow is available. Without a cover a single pixel in the file's format,
+    transparent for PNG.
+    """
+    image_format = EXPORT_IMAGE_FORMATS.get(os.path.splitext(file_name)[1].lower())
+    entry = get_cover(cover_hash_from_url(cover))
+    if entry is None:
+        return EMPTY_JPEG if image_format and image_format[0] == 'JPEG' else EMPTY_PNG
+    if image_format is None or entry['mimetype'] == image_format[1]:
+        return entry['original']
+    try:
+        from PIL import Image
+
+        img = Image.open(io.BytesIO(entry['original']))
+        output = io.BytesIO()
+        img.convert("RGBA" if image_format[0] == 'PNG' else "RGB").save(output, image_format[0])
+        return output.getvalue()
+    except Exception as e:
+        print(f"Error converting cover for export: {e}")
+        return entry['original']
+
+
+class FileExporter:
+    """
+    Writes the media info to text and image files, see EXPORT_FILES. update() is a media
+    listener: it only queues the info, the files are written by the exporter's own thread.
+    The position file is opt-in: with `position_interval` it is written on a timer every that
+    many seconds, however often the media info changes.
+    """
+    def __init__(self, folder, files=None, position_interval=None):
+        self.folder = folder
+        self.files = dict(EXPORT_FILES, **(files or {}))
+        self.position_interval = max(position_interval, EXPORT_MIN_POSITION_INTERVAL) if position_interval else None
+        if not self.position_interval:
+            self.files['position'] = None
+        self._updates = queue.Queue()
+        self._info = None
+        self._written = {}  # field -> content of its file, or the cover URL
+
+    def start(self):
+        os.makedirs(self.folder, exist_ok=True)
+        print(f"Exporting media info to: {self.folder}")
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def update(self, info):
+        self._updates.put(info)
+
+    def _run(self):
+        #print("DEBUG: FileExporter._run")
+        next_tick = time.monotonic() + self.position_interval if self.position_interval else None
+        while True:
+            try:
+                info = self._updates.get(timeout=None if next_tick is None else max(0.0, next_tick - time.monotonic()))
+                # Only the newest of several queued updates matters
+                while not self._updates.empty():
+                    info = self._updates.get_nowait()
+                self._info = info
+                self.export(info)
+            except queue.Empty:
+                pass
+
+            now = time.monotonic()
+            if next_tick is not None and now >= next_tick:
+                # Position tick
+                if self._info is not None:
+                    self.export_position(self._info)
+                next_tick += self.position_interval
+                if next_tick <= now:
+                    next_tick = now + self.position_interval
+
+    def _write(self, field, content, data=None):
+        file_name = self.files.get(field)
+        if not file_name or self._written.get(field) == content:
+            return
+        try:
+            write_file_atomic(os.path.join(self.folder, file_name), content.encode('utf-8') if data is None else data)
+            self._written[field] = content
+        except Exception as e:
+            print(f"Error exporting {file_name}: {e}")
+
+    def export(self, info):
+        #print("DEBUG: FileExporter.export")
+        """
+        Write every file whose content changed with `info`.
+        """
+        playing = info.get('status') == "Playing"
+        title = info.get('title', '') if playing else ''
+        artist = info.get('artist', '') if playing else ''
+        self._write('title', title)
+        self._write('artist', artist)
+        self._write('artist_title', f"{artist} - {title}" if playing else '')
+        self._write('duration', format_export_time(info.get('duration', 0)) if playing else '')
+
+        cover = info.get('cover', '') if playing else ''
+        if self.files.get('cover') and self._written.get('cover') != cover:
+            self._write('cover', cover, export_cover_data(cover, self.files['cover']))
+
+    def export_position(self, info):
+        if info.get('status') != "Playing":
+            self._write('position', '')
+            return
+        position = info.get('position', 0)
+        if 'position_time' in info:
+            position += (time.monotonic() - info['position_time']) * info.get('playback_rate', 1.0)
+        duration = info.get('duration', 0)
+        if duration > 0:
+            position = min(position, duration)
+        self._write('position', f"{format_export_time(position)} / {format_export_time(duration)}")
+
+
+file_exporter = None  # FileExporter, when an export folder is configured, see main
+
+
+# ---------------------------------------------------------------------------
+# Media sources
+#
+# get_all_media_info does not talk to the Windows media API directly but asks a media source
+# for all media sessions. A session is a plain dict:
+#   app_id, title, artist, album, thumbnail (opaque handle for read_thumbnail),
+#   playback_status (int, see STATUS_MAP), position, duration (seconds),
+#   timeline_updated (epoch seconds of the last timeline update by the player, or None)
+# ---------------------------------------------------------------------------
+
+class MediaSource:
+    """
+    Base class for media backends. wait_for_change sleeps between polls and is woken up early
+    by notify_changed, so backends which know when something changed do not need to be polled.
+    """
+    def __init__(self):
+        self._changed = None
+        self._loop = None
+
+    async def get_sessions(self):
+        """
+        Return (sessions, current_app_id) with a list of all sessions and the raw app id
+        of the session Windows considers current (or None).
+        """
+        raise NotImplementedError
+
+    async def read_thumbnail(self, thumbnail):
+        raise NotImplementedError
+
+    async def close(self):
+        pass
+
+    async def reset(self):
+        """
+        Drop held media API objects after the poller stalled, they are requested again on the next poll.
+        """
+        pass
+
+    def notify_changed(self):
+        #print("DEBUG: MediaSource.notify_changed")
+        """
+        Wake up wait_for_change. Safe to call from any thread.
+        """
+        if self._loop is not None and not self._loop.is_closed():
+            self._loop.call_soon_threadsafe(self._changed.set)
+
+    async def wait_for_change(self, timeout):
+        #print("DEBUG: MediaSource.wait_for_change")
+        """
+        Sleep up to `timeout` seconds. Returns True if woken up early by a change notification.
+        """
+        if self._changed is None:
+            self._loop = asyncio.get_running_loop()
+            self._changed = asyncio.Event()
+        try:
+            await asyncio.wait_for(self._changed.wait(), timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+        finally:
+            self._changed.clear()
+
+
+def session_properties_state(info):
+    return {'title': info.title, 'artist': info.artist, 'album': info.album_title, 'thumbnail': info.thumbnail}
+
+
+def session_playback_state(playback_info):
+    return {
+        'playback_status': playback_info.playback_status,
+        'playback_rate': playback_info.playback_rate or 1.0
+    }
+
+
+def session_timeline_state(timeline):
+    try:
+        timeline_updated = timeline.last_updated_time.timestamp()
+    except Exception:
+        timeline_updated = None
+    return {
+        'position': timeline.position.total_seconds(),
+        'duration': timeline.end_time.total_seconds(),
+        'timeline_updated': timeline_updated
+    }
+
+
+def session_keys(sessions):
+    """
+    App id of every Windows media session. Browsers register one session per tab under the same
+    app id, the second and later ones get 'app id~2', '~3', ... in the order Windows lists them.
+    """
+    keys = []
+    counts = {}
+    for session in sessions:
+        app_id = session.source_app_user_model_id
+        counts[app_id] = counts.get(app_id, 0) + 1
+        keys.append(app_id if counts[app_id] == 1 else f"{app_id}~{counts[app_id]}")
+    return keys
+
+
+async def current_session_key(current_session, keyed_sessions):
+    #print("DEBUG: current_session_key")
+    """
+    Key (see session_keys) of the current session in `keyed_sessions`, {key: (session, state)}.
+    Windows hands out a new object for the current session, so when its app id has several
+    sessions the one with the same title and artist is picked, else the first one.
+    """
+    if current_session is None:
+        return None
+    app_id = current_session.source_app_user_model_id
+    candidates = [key for key, (session, _) in keyed_sessions.items() if session.source_app_user_model_id == app_id]
+    if len(candidates) <= 1:
+        return candidates[0] if candidates else app_id
+    try:
+        info = await winrt_call('try_get_media_properties_async', current_session.try_get_media_properties_async())
+        for key in candidates:
+            state = keyed_sessions[key][1]
+            if (state.get('title'), state.get('artist')) == (info.title, info.artist):
+                return key
+    except Exception as e:
+        print(f"Error matching the current media session: {e}")
+    return candidates[0]
+
+
+class WindowsMediaSource(MediaSource):
+    """
+    Polls the Windows media API. Every call queries the session manager and all session properties again.
+    """
+    async def get_sessions(self):
+        session_manager = await winrt_call('request_async', MediaManager.request_async())
+        current_session = session_manager.get_current_session()
+
+        keyed_sessions = {}
+        windows_sessions = list(session_manager.get_sessions())
+        for key, session in zip(session_keys(windows_sessions), windows_sessions):
+            info = await winrt_call('try_get_media_properties_async', session.try_get_media_properties_async())
+            with winrt_timer('get_playback_info'):
+                playback_info = session.get_playback_info()
+            with winrt_timer('get_timeline_properties'):
+                timeline = session.get_timeline_properties()
+            keyed_sessions[key] = (session, {
+                'app_id': key,
+                **session_properties_state(info),
+                **session_playback_state(playback_info),
+                **session_timeline_state(timeline)
+            })
+        current_app_id = await current_session_key(current_session, keyed_sessions)
+        return [state for _, state in keyed_sessions.values()], current_app_id
+
+    async def read_thumbnail(self, thumbnail):
+        stream = await winrt_call('open_read_async', thumbnail.open_read_async())
+        reader = DataReader(stream)
+
+        await winrt_call('load_async', reader.load_async(stream.size))
+
+        return bytes(reader.read_buffer(stream.size))
+
+
+class WindowsEventMediaSource(WindowsMediaSource):
+    """
+    Event driven Windows backend. Holds the session manager once, subscribes to the change
+    notifications of the manager and every session and only re-queries the parts an event
+    invalidated. Everything is re-queried every `reconcile_interval` seconds as a safety net
+    against missed events. A session whose queries keep failing is left alone while its circuit
+    breaker is open and returned with its last good state, marked as stale.
+    """
+    SESSION_PARTS = ('properties', 'playback', 'timeline')
+
+    def __init__(self, reconcile_interval=None):
+        super().__init__()
+        self.reconcile_interval = reconcile_interval or RECONCILE_INTERVAL
+        self._manager = None
+        self._manager_tokens = []
+        self._current_session = None
+        self._current_app_id = None
+        self._watched = {}  # session key (see session_keys) -> {'session', 'tokens', 'state', 'dirty', 'breaker'}
+        self._sessions_dirty = True
+        self._dirty_lock = threading.Lock()
+        self._last_reconcile = time.monotonic()
+
+    def _invalidate(self, app_id, part):
+        # Called by WinRT on its own threads
+        with self._dirty_lock:
+            if app_id is None:
+                self._sessions_dirty = True
+            elif app_id in self._watched:
+                self._watched[app_id]['dirty'].add(part)
+        self.notify_changed()
+
+    def _hook_session(self, app_id, session):
+        #print("DEBUG: WindowsEventMediaSource._hook_session")
+        def handler(part):
+            return lambda sender, args: self._invalidate(app_id, part)
+
+        tokens = [
+            (session.remove_media_properties_changed, session.add_media_properties_changed(handler('properties'))),
+            (session.remove_playback_info_changed, session.add_playback_info_changed(handler('playback'))),
+            (session.remove_timeline_properties_changed, session.add_timeline_properties_changed(handler('timeline')))
+        ]
+        self._watched[app_id] = {
+            'session': session,
+            'tokens': tokens,
+            'state': {'app_id': app_id},
+            'dirty': set(self.SESSION_PARTS),
+            'breaker': CircuitBreaker(f"Media session {app_id}", 'session')
+        }
+
+    def _unhook_session(self, app_id):
+        #print("DEBUG: WindowsEventMediaSource._unhook_session")
+        watched = self._watched.pop(app_id)
+        for remove, token in watched['tokens']:
+            try:
+                remove(token)
+            except Exception as e:
+                print(f"Error removing session handler: {e}")
+
+    def _sync_sessions(self):
+        #print("DEBUG: WindowsEventMediaSource._sync_sessions")
+        self._current_session = self._manager.get_current_session()
+
+        windows_sessions = list(self._manager.get_sessions())
+        sessions = dict(zip(session_keys(windows_sessions), windows_sessions))
+        counts = {}
+        for session in windows_sessions:
+            counts[session.source_app_user_model_id] = counts.get(session.source_app_user_model_id, 0) + 1
+        watched_counts = {}
+        for watched in self._watched.values():
+            app_id = watched['session'].source_app_user_model_id
+            watched_counts[app_id] = watched_counts.get(app_id, 0) + 1
+        with self._dirty_lock:
+            for key, watched in list(self._watched.items()):
+                # A tab opened or closed shifts the keys of its browser, hook all its sessions again
+                app_id = watched['session'].source_app_user_model_id
+                if key not in sessions or counts.get(app_id) != watched_counts[app_id]:
+                    self._unhook_session(key)
+            for key, session in sessions.items():
+                if key not in self._watched:
+                    self._hook_session(key, session)
+
+    async def _query_session(self, watched, dirty):
+        session = watched['session']
+        if 'properties' in dirty:
+            info = await winrt_call('try_get_media_properties_async', session.try_get_media_properties_async())
+            watched['state'].update(session_properties_state(info))
+        if 'playback' in dirty:
+            with winrt_timer('get_playback_info'):
+                playback_info = session.get_playback_info()
+            watched['state'].update(session_playback_state(playback_info))
+        if 'timeline' in dirty:
+            with winrt_timer('get_timeline_properties'):
+                timeline = session.get_timeline_properties()
+            watched['state'].update(session_timeline_state(timeline))
+
+    async def get_sessions(self):
+        if self._manager is None:
+            self._manager = await winrt_call('request_async', MediaManager.request_async())
+            self._manager_tokens = [
+                (self._manager.remove_sessions_changed,
+                 self._manager.add_sessions_changed(lambda sender, args: self._invalidate(None, 'sessions'))),
+                (self._manager.remove_current_session_changed,
+                 self._manager.add_current_session_changed(lambda sender, args: self._invalidate(None, 'sessions')))
+            ]
+
+        now = time.monotonic()
+        with self._dirty_lock:
+            if now - self._last_reconcile >= self.reconcile_interval:
+                self._sessions_dirty = True
+                for watched in self._watched.values():
+                    watched['dirty'].update(self.SESSION_PARTS)
+                self._last_reconcile = now
+            sessions_dirty, self._sessions_dirty = self._sessions_dirty, False
+
+        if sessions_dirty:
+            try:
+                self._sync_sessions()
+            except Exception:
+                # Query again on the next call
+                self._sessions_dirty = True
+                raise
+
+        sessions = []
+        for app_id, watched in list(self._watched.items()):
+            stale = False
+            if watched['breaker'].allow():
+                with self._dirty_lock:
+                    dirty, watched['dirty'] = watched['dirty'], set()
+                try:
+                    await self._query_session(watched, dirty)
+                    watched['breaker'].record_success()
+                except Exception as e:
+                    print(f"Error querying media session {app_id}: {e}")
+                    watched['breaker'].record_failure()
+                    stale = True
+                    with self._dirty_lock:
+                        watched['dirty'].update(dirty)
+                        self._sessions_dirty = True
+            else:
+                stale = True
+            if 'title' in watched['state']:
+                sessions.append({**watched['state'], 'stale': stale})
+
+        if sessions_dirty:
+            keyed_sessions = {key: (watched['session'], watched['state']) for key, watched in self._watched.items()}
+            self._current_app_id = await current_session_key(self._current_session, keyed_sessions)
+        return sessions, self._current_app_id
+
+    async def close(self):
+        for app_id in list(self._watched):
+            self._unhook_session(app_id)
+        for remove, token in self._manager_tokens:
+            remove(token)
+        self._manager_tokens = []
+        self._manager = None
+
+    async def reset(self):
+        await self.close()
+
+
+class FakeMediaSource(MediaSource):
+    """
+    In-memory backend driven from code, for running and testing without Windows.
+    Every change wakes up the poller like a Windows media event. Thumbnails are plain bytes.
+    """
+    DEFAULT_APP_ID = 'Fake.Player'
+
+    def __init__(self):
+        super().__init__()
+        self.sessions = {}  # raw app id -> session
+        self.current_app_id = None
+        self.query_count = 0
+        self.hanging = set()  # 'get_sessions' and/or 'read_thumbnail' never return, like a hung player
+
+    async def _hang(self, call):
+        if call in self.hanging:
+            await asyncio.Event().wait()  # never set
+
+    def set_session(self, app_id=DEFAULT_APP_ID, make_current=True, **fields):
+        #print("DEBUG: FakeMediaSource.set_session")
+        if app_id not in self.sessions:
+            self.sessions[app_id] = {
+                'app_id': app_id,
+                'title': 'Unknown',
+                'artist': 'Unknown',
+                'album': '',
+                'thumbnail': None,
+                'playback_status': 4,
+                'playback_rate': 1.0,
+                'position': 0,
+                'duration': 0,
+                'timeline_updated': time.time()
+            }
+        self.sessions[app_id].update(fields)
+        if make_current:
+            self.current_app_id = app_id
+        self.notify_changed()
+
+    def close_session(self, app_id=None):
+        self.sessions.pop(app_id or self.current_app_id, None)
+        if self.current_app_id not in self.sessions:
+            self.current_app_id = next(iter(self.sessions), None)
+        self.notify_changed()
+
+    def replace_sessions(self, sessions, current_app_id):
+        self.sessions = {session['app_id']: dict(session) for session in sessions}
+        self.current_app_id = current_app_id
+        self.notify_changed()
+
+    async def get_sessions(self):
+        self.query_count += 1
+        await self._hang('get_sessions')
+        return [dict(session) for session in self.sessions.values()], self.current_app_id
+
+    async def read_thumbnail(self, thumbnail):
+        await self._hang('read_thumbnail')
+        return bytes(thumbnail)
+
+
+# Trace files are JSON lines (gzip compressed when the name ends with .gz):
+#   {"trace": 2, "started": <epoch seconds>}                     header
+#   {"thumbnail": <sha1>, "data": <base64>}                      thumbnail bytes, written once per hash
+#   {"t": <seconds since start>, "sessions": [...], "current": <app id or null>}
+#                                                                all sessions, thumbnails replaced by their sha1
+# timeline_updated is stored relative to the start of the trace.
+# Version 1 traces recorded only the current session as {"t": ..., "session": {...} or null}.
+TRACE_FORMAT_VERSION = 2
+
+
+def open_trace(path, mode):
+    if path.endswith(".gz"):
+        return gzip.open(path, mode + "t", encoding="utf-8")
+    return open(path, mode, encoding="utf-8")
+
+
+class WrappingMediaSource(MediaSource):
+    """
+    Base of media sources that wrap another one and pass its sessions on with thumbnails as their
+    sha1. get_sessions never reads a thumbnail: the hash is taken when the widget's cover loader
+    reads it through read_thumbnail (see update_cover), with its deadline and cover breaker, so a
+    hung thumbnail cannot hold up the session query. Until then the thumbnail hash is None, the
+    read wakes up the poller so the next query has it.
+    """
+    def __init__(self, source):
+        super().__init__()
+        self.source = source
+        self._song_thumbnails = {}  # song key -> thumbnail hash, of the current sessions
+        self._thumbnail_songs = {}  # id(thumbnail handle) -> (handle, song key) of the last query
+
+    def _thumbnail_hashes(self, sessions):
+        """
+        Thumbnail hash of every session in order, None without a thumbnail or before it was read.
+        """
+        self._thumbnail_songs = {}
+        song_thumbnails = {}
+        hashes = []
+        for session in sessions:
+            thumbnail_hash = None
+            if session.get('thumbnail') is not None:
+                song_key = (session.get('app_id'), session.get('title'), session.get('artist'))
+                self._thumbnail_songs[id(session['thumbnail'])] = (session['thumbnail'], song_key)
+                thumbnail_hash = self._song_thumbnails.get(song_key)
+                if thumbnail_hash is not None:
+                    song_thumbnails[song_key] = thumbnail_hash
+            hashes.append(thumbnail_hash)
+        self._song_thumbnails = song_thumbnails  # forget songs no session plays anymore
+        return hashes
+
+    def _thumbnail_read(self, thumbnail_hash, data):
+        """
+        Called once per thumbnail hash and song with the bytes of a thumbnail the widget read.
+        """
+        pass
+
+    async def read_thumbnail(self, thumbnail):
+        handle, song_key = self._thumbnail_songs.get(id(thumbnail), (None, None))
+        data = await self.source.read_thumbnail(thumbnail)
+        if handle is thumbnail and song_key not in self._song_thumbnails:
+            thumbnail_hash = hashlib.sha1(data).hexdigest()
+            self._thumbnail_read(thumbnail_hash, data)
+            self._song_thumbnails[song_key] = thumbnail_hash
+            self.source.notify_changed()
+        return data
+
+    async def wait_for_change(self, timeout):
+        return await self.source.wait_for_change(timeout)
+
+    async def reset(self):
+        await self.source.reset()
+
+
+class RecordingMediaSource(WrappingMediaSource):
+    """
+    Wraps another media source and writes every distinct sessions state, including thumbnails, to a trace file.
+    """
+    def __init__(self, source, path):
+        super().__init__(source)
+        self.path = path
+        self._file = None
+        self._started = None
+        self._last_record = None
+        self._written_thumbnails = set()
+
+    def _write(self, record):
+        self._file.write(json.dumps(record, separators=(",", ":")) + "\n")
+        self._file.flush()
+
+    def _thumbnail_read(self, thumbnail_hash, data):
+        if self._file is not None and thumbnail_hash not in self._written_thumbnails:
+            self._write({'thumbnail': thumbnail_hash, 'data': base64.b64encode(data).decode('ascii')})
+            self._written_thumbnails.add(thumbnail_hash)
+
+    def _session_record(self, session, thumbnail_hash):
+        record = dict(session)
+        if record.get('thumbnail') is not None:
+            record['thumbnail'] = thumbnail_hash
+        if record.get('timeline_updated') is not None:
+            record['timeline_updated'] = round(record['timeline_updated'] - self._started, 3)
+        return record
+
+    async def get_sessions(self):
+        sessions, current_app_id = await self.source.get_sessions()
+
+        if self._file is None:
+            self._started = time.time()
+            self._file = open_trace(self.path, "w")
+            self._write({'trace': TRACE_FORMAT_VERSION, 'started': self._started})
+            print(f"Recording media trace to: {self.path}")
+
+        hashes = self._thumbnail_hashes(sessions)
+        record = {
+            'sessions': [self._session_record(session, thumbnail_hash) for session, thumbnail_hash in zip(sessions, hashes)],
+            'current': current_app_id
+        }
+        if record != self._last_record:
+            self._write({'t': round(time.time() - self._started, 3), **record})
+            self._last_record = record
+        return sessions, current_app_id
+
+    async def close(self):
+        await self.source.close()
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+class ReplayMediaSource(FakeMediaSource):
+    """
+    Plays a recorded trace back at `speed` times real time, optionally in a loop.
+    Position extrapolation in get_media_info still runs in real time.
+    """
+    def __init__(self, path, speed=1.0, loop=False):
+        super().__init__()
+        self.path = path
+        self.speed = speed if speed and speed > 0 else 1.0
+        self.loop = loop
+        self.thumbnails = {}
+        self.events = []
+        self._task = None
+        self._load()
+
+    def _load(self):
+        #print("DEBUG: ReplayMediaSource._load")
+        with open_trace(self.path, "r") as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                record = json.loads(line)
+                if 'thumbnail' in record and 'data' in record:
+                    self.thumbnails[record['thumbnail']] = base64.b64decode(record['data'])
+                elif 'sessions' in record:
+                    self.events.append((record['t'], record['sessions'], record.get('current')))
+                elif 't' in record:
+                    # Version 1 trace with only the current session
+                    session = record['session']
+                    self.events.append((record['t'], [session] if session else [], session and session['app_id']))
+        print(f"Loaded media trace with {len(self.events)} events: {self.path}")
+
+    def _replay_session(self, session, started):
+        session = dict(session)
+        if session.get('thumbnail') is not None:
+            session['thumbnail'] = self.thumbnails.get(session['thumbnail'])
+        if session.get('timeline_updated') is not None:
+            session['timeline_updated'] = started + session['timeline_updated'] / self.speed
+        return session
+
+    async def _play(self):
+        #print("DEBUG: ReplayMediaSource._play")
+        while True:
+            started = time.time()
+            for t, sessions, current_app_id in self.events:
+                delay = started + t / self.speed - time.time()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                self.replace_sessions([self._replay_session(session, started) for session in sessions], current_app_id)
+            if not self.loop:
+                break
+
+    async def get_sessions(self):
+        if self._task is None:
+            self._task = asyncio.get_running_loop().create_task(self._play())
+        return await super().get_sessions()
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+
+
+# ---------------------------------------------------------------------------
+# Ingest
+#
+# An instance started with --push-to sends its media sessions to a hub instance, which shows
+# them through the 'ingest' media source. Only changed session fields are sent, thumbnails as
+# their sha1, and a cover is uploaded only if the hub does not have it yet (HEAD /cover/<sha1>/original).
+# Both requests are signed with an HMAC-SHA256 of a shared token (X-Ingest-Signature):
+#   POST /ingest               {"source", "seq", "sent", "full", "sessions": {raw app id: changed fields},
+#                               "closed": [raw app ids], "current": raw app id}
+#   PUT  /ingest/cover/<sha1>  the thumbnail bytes
+# The hub answers 409 when it missed a message (restart, seq gap), the next push then sends everything.
+# ---------------------------------------------------------------------------
+
+INGEST_MAX_BODY_BYTES = 8 * 1024 * 1024
+INGEST_MAX_CLOCK_SKEW = 300  # seconds a pushed message may be off the hub's clock
+INGEST_SOURCE_TIMEOUT = 90  # seconds without a push before the hub drops a source's sessions
+INGEST_COVER_CACHE_BYTES = 16 * 1024 * 1024  # uploaded covers kept until the poller extracted them
+PUSH_HEARTBEAT_SECONDS = 30
+PUSH_RETRY_SECONDS = 5
+PUSH_TIMEOUT = 5
+
+
+def ingest_signature(token, method, path, body):
+    message = f"{method} {path}\n".encode('utf-8') + body
+    return hmac.new(token.encode('utf-8'), message, hashlib.sha256).hexdigest()
+
+
+class PushingMediaSource(WrappingMediaSource):
+    """
+    Wraps another media source and pushes its sessions to a hub instance under `name`.
+    Pushing runs in the background and never holds up the poller.
+    """
+    def __init__(self, source, hub_url, token, name):
+        super().__init__(source)
+        self.hub_url = hub_url.rstrip("/")
+        self.token = token
+        self.name = name
+        self._task = None
+        self._pending = None  # asyncio.Event, set when there is something to push
+        self._latest = ({}, None)  # (raw app id -> session with thumbnail hash, current raw app id)
+        self._acked = None  # state the hub has, None if unknown: push everything
+        self._acked_current = None
+        self._seq = 0
+        self._hub_covers = set()  # hashes the hub has
+        self._thumbnails = {}  # thumbnail hash -> bytes, of the pushed and the current sessions
+
+    def _thumbnail_read(self, thumbnail_hash, data):
+        self._thumbnails[thumbnail_hash] = data
+
+    async def get_sessions(self):
+        sessions, current_app_id = await self.source.get_sessions()
+
+        state = {}
+        for session, thumbnail_hash in zip(sessions, self._thumbnail_hashes(sessions)):
+            pushed = {key: value for key, value in session.items() if key != 'app_id'}
+            if pushed.get('thumbnail') is not None:
+                pushed['thumbnail'] = thumbnail_hash
+            state[session['app_id']] = pushed
+
+        if (state, current_app_id) != self._latest:
+            self._latest = (state, current_app_id)
+            if self._task is None:
+                self._pending = asyncio.Event()
+                self._task = asyncio.get_running_loop().create_task(self._push_loop())
+            self._pending.set()
+        return sessions, current_app_id
+
+    async def _push_loop(self):
+        #print("DEBUG: PushingMediaSource._push_loop")
+        print(f"Pushing media sessions to {self.hub_url} as '{self.name}'")
+        while True:
+            try:
+                # A heartbeat keeps the hub from dropping this source while nothing changes
+                await asyncio.wait_for(self._pending.wait(), PUSH_HEARTBEAT_SECONDS)
+            except asyncio.TimeoutError:
+                pass
+            self._pending.clear()
+            try:
+                await self._push()
+            except Exception as e:
+                print(f"Error pushing to {self.hub_url}: {e}")
+                self._forget_hub_state()
+                self._pending.set()
+                await asyncio.sleep(PUSH_RETRY_SECONDS)
+
+    def _forget_hub_state(self):
+        # After a restart the hub has neither the sessions nor the covers, check both again
+        self._acked = None
+        self._hub_covers.clear()
+
+    async def _request(self, method, path, body=b"", signed=True):
+        headers = {'Content-Type': 'application/octet-stream' if path.startswith('/ingest/cover') else 'application/json'}
+        if signed:
+            headers['X-Ingest-Signature'] = ingest_signature(self.token, method, path, body)
+
+        def send():
+            # Imported on first push, urllib.request pulls in ssl and http.client
+            import urllib.request
+            import urllib.error
+
+            request = urllib.request.Request(self.hub_url + path, data=body if method in ("POST", "PUT") else None,
+                                             headers=headers, method=method)
+            try:
+                with urllib.request.urlopen(request, timeout=PUSH_TIMEOUT) as response:
+                    return response.status
+            except urllib.error.HTTPError as e:
+                return e.code
+
+        return await asyncio.get_running_loop().run_in_executor(None, send)
+
+    async def _upload_cover(self, cover_hash):
+        #print("DEBUG: PushingMediaSource._upload_cover")
+        if await self._request("HEAD", f"/cover/{cover_hash}/original", signed=False) != 200:
+            status = await self._request("PUT", f"/ingest/cover/{cover_hash}", self._thumbnails[cover_hash])
+            if status != 200:
+                raise RuntimeError(f"cover upload failed with HTTP {status}")
+        self._hub_covers.add(cover_hash)
+
+    async def _push(self):
+        #print("DEBUG: PushingMediaSource._push")
+        state, current_app_id = self._latest
+
+        # Covers first, so the hub has them before it shows the session
+        for session in state.values():
+            if session.get('thumbnail') and session['thumbnail'] not in self._hub_covers:
+                await self._upload_cover(session['thumbnail'])
+
+        full = self._acked is None
+        acked = self._acked or {}
+        message = {'source': self.name, 'seq': self._seq + 1, 'sent': round(time.time(), 3)}
+        if full:
+            message['full'] = True
+        changes = {}
+        for app_id, session in state.items():
+            old = acked.get(app_id, {})
+            changed = {key: value for key, value in session.items() if key not in old or old[key] != value}
+            if changed:
+                changes[app_id] = changed
+        if changes:
+            message['sessions'] = changes
+        closed = [app_id for app_id in acked if app_id not in state]
+        if closed:
+            message['closed'] = closed
+        if full or current_app_id != self._acked_current:
+            message['current'] = current_app_id
+
+        body = json.dumps(message, separators=(",", ":")).encode('utf-8')
+        status = await self._request("POST", "/ingest", body)
+        self._seq += 1
+        if status == 409:
+            # The hub missed something, send everything again
+            self._forget_hub_state()
+            self._pending.set()
+            return
+        if status != 200:
+            raise RuntimeError(f"push failed with HTTP {status}")
+        self._acked, self._acked_current = state, current_app_id
+
+        # Forget thumbnails no session uses anymore, a thumbnail read since the last query is kept for the next push
+        used = {session.get('thumbnail') for session in state.values()} | set(self._song_thumbnails.values())
+        self._thumbnails = {cover_hash: data for cover_hash, data in self._thumbnails.items() if cover_hash in used}
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+        await self.source.close()
+
+
+class IngestMediaSource(MediaSource):
+    """
+    Hub side: the sessions pushed by other instances (see PushingMediaSource). The source name is
+    appended to every app id, so the same player on two machines shows up as two apps, e.g.
+    ?app=Spotify.exe@gaming-pc. The current session is the one of the source that changed last,
+    sources with a playing current session first. Thumbnails are cover hashes.
+    """
+    def __init__(self, token=None):
+        super().__init__()
+        self.token = token
+        self.remotes = {}  # source name -> {'seq', 'sessions': {raw app id: session}, 'current', 'updated'}
+        self.covers = OrderedDict()  # cover hash -> uploaded bytes
+        self._covers_bytes = 0
+        self._lock = threading.Lock()
+
+    def _signed(self, method, path, body, signature):
+        if not self.token:
+            return False
+        return hmac.compare_digest(ingest_signature(self.token, method, path, body), signature or "")
+
+    def ingest(self, body, signature):
+        #print("DEBUG: IngestMediaSource.ingest")
+        """
+        Apply a pushed message, returns (HTTP status, text).
+        """
+        if not self._signed("POST", "/ingest", body, signature):
+            return 403, "Bad signature"
+        try:
+            message = json.loads(body)
+            name = str(message['source'])
+            seq = int(message['seq'])
+            sessions = message.get('sessions', {})
+            sent = float(message['sent'])
+        except (ValueError, KeyError, TypeError):
+            return 400, "Bad message"
+        if abs(time.time() - sent) > INGEST_MAX_CLOCK_SKEW:
+            # Also rejects replayed old messages
+            print(f"Rejected push from '{name}': clocks differ by {time.time() - sent:.0f} seconds")
+            return 403, "Clock skew too large"
+
+        with self._lock:
+            remote = self.remotes.get(name)
+            if message.get('full'):
+                if remote is None:
+                    print(f"Ingesting media sessions from '{name}'")
+                remote = self.remotes[name] = {'seq': seq, 'sessions': {}, 'current': None, 'updated': 0}
+            elif remote is None or seq != remote['seq'] + 1:
+                return 409, "Send full state"
+            remote['seq'] = seq
+            for app_id, changes in sessions.items():
+                session = remote['sessions'].setdefault(app_id, {'thumbnail': None})
+                session.update(changes)
+            for app_id in message.get('closed', []):
+                remote['sessions'].pop(app_id, None)
+            if 'current' in message:
+                remote['current'] = message['current']
+            remote['updated'] = time.monotonic()
+
+        if sessions or message.get('closed') or 'current' in message:
+            self.notify_changed()
+        return 200, "OK"
+
+    def ingest_cover(self, cover_hash, data, signature):
+        #print("DEBUG: IngestMediaSource.ingest_cover")
+        """
+        Store an uploaded cover until the poller extracted it, returns (HTTP status, text).
+        """
+        if not self._signed("PUT", f"/ingest/cover/{cover_hash}", data, signature):
+            return 403, "Bad signature"
+        if hashlib.sha1(data).hexdigest() != cover_hash:
+            return 400, "Hash mismatch"
+        with self._lock:
+            if cover_hash not in self.covers:
+                self.covers[cover_hash] = data
+                self._covers_bytes += len(data)
+                while self._covers_bytes > INGEST_COVER_CACHE_BYTES and len(self.covers) > 1:
+                    _, evicted = self.covers.popitem(last=False)
+                    self._covers_bytes -= len(evicted)
+        return 200, "OK"
+
+    async def get_sessions(self):
+        now = time.monotonic()
+        sessions = []
+        current = None  # (playing, updated, app id)
+        with self._lock:
+            for name in [name for name, remote in self.remotes.items() if now - remote['updated'] > INGEST_SOURCE_TIMEOUT]:
+                print(f"No push from '{name}' for {INGEST_SOURCE_TIMEOUT} seconds, dropping its sessions")
+                del self.remotes[name]
+
+            for name, remote in self.remotes.items():
+                for app_id, session in remote['sessions'].items():
+                    sessions.append({**session, 'app_id': f"{app_id}@{name}"})
+                session = remote['sessions'].get(remote['current'])
+                if session is not None:
+                    candidate = (session.get('playback_status') == 4, remote['updated'], f"{remote['current']}@{name}")
+                    if current is None or candidate > current:
+                        current = candidate
+        return sessions, current[2] if current else None
+
+    async def read_thumbnail(self, thumbnail):
+        with self._lock:
+            data = self.covers.get(thumbnail)
+        if data is None:
+            entry = get_cover(thumbnail)
+            if entry is None:
+                raise KeyError(f"cover {thumbnail} was not uploaded")
+            data = entry['original']
+        return data
+
+
+ingest_source = None  # the IngestMediaSource of a hub, see handle_ingest
+
+
+def handle_ingest(method, parts, body, signature):
+    #print("DEBUG: handle_ingest")
+    """
+    Handle a request to /ingest or /ingest/cover/<hash> for both servers, returns (HTTP status, text).
+    """
+    if ingest_source is None:
+        return 404, "Not a hub, start with --media-source ingest"
+    if parts == ['ingest'] and method == "POST":
+        return ingest_source.ingest(body, signature)
+    if len(parts) == 3 and parts[1] == 'cover' and method == "PUT":
+        return ingest_source.ingest_cover(parts[2], body, signature)
+    return 405, "Method Not Allowed"
+
+
+MEDIA_SOURCES = {
+    'events': WindowsEventMediaSource,
+    'poll': WindowsMediaSource,
+    'fake': FakeMediaSource,
+    'replay': ReplayMediaSource,
+    'ingest': IngestMediaSource
+}
+
+
+def load_winsdk():
+    """
+    Import the Windows media API on first use. Returns False if it is not available (not on Windows).
+    """
+    global MediaManager, DataReader
+    #print("DEBUG: load_winsdk")
+    if MediaManager is None:
+        try:
+            from winsdk.windows.media.control import GlobalSystemMediaTransportControlsSessionManager
+            from winsdk.windows.storage.streams import DataReader as WinDataReader
+        except ImportError:
+            return False
+        MediaManager, DataReader = GlobalSystemMediaTransportControlsSessionManager, WinDataReader
+    return True
+
+
+def create_media_source(name, trace=None, speed=1.0, record=None, ingest_token=None,
+                        push_to=None, push_token=None, push_name=None):
+    """
+    Create the media source called `name`. The replay source plays back `trace`, the ingest
+    source accepts pushes signed with `ingest_token`. When `record` is set, every session seen
+    is recorded to that trace file, with `push_to` all sessions are pushed to that hub URL.
+    """
+    global ingest_source
+    #print("DEBUG: create_media_source")
+    source_class = MEDIA_SOURCES.get(name)
+    if source_class is None:
+        print(f"Unknown media source '{name}', using 'events'")
+        source_class = WindowsEventMediaSource
+    if issubclass(source_class, WindowsMediaSource) and not load_winsdk():
+        print("Windows media API (winsdk) not available, using the fake media source")
+        source_class = FakeMediaSource
+
+    if source_class is ReplayMediaSource:
+        if not trace:
+            print("No trace file given for the replay media source, using the fake media source")
+            source = FakeMediaSource()
+        else:
+            source = ReplayMediaSource(trace, speed=speed, loop=True)
+    elif source_class is IngestMediaSource:
+        if not ingest_token:
+            print("No ingest token set, pushes from other instances are rejected")
+        source = ingest_source = IngestMediaSource(ingest_token)
+    else:
+        source = source_class()
+
+    if record:
+        source = RecordingMediaSource(source, record)
+    if push_to:
+        if not push_token:
+            print("No push token set, the hub will reject the pushes")
+        source = PushingMediaSource(source, push_to, push_token or "", push_name or socket.gethostname())
+    return source
+
+
+media_source = None  # created on the poller's event loop, see start_async_loop
+
+def normalize_app_id(app_id):
+    """
+    Windows app ids look like 'SpotifyAB.SpotifyMusic_zpdnekdrzrea0!Spotify', the index uses the part after '!'.
+    """
+    if app_id and "!" in app_id:
+        return app_id.split("!")[1]
+    return app_id
+
+
+# Per app tracking state for position extrapolation and cover caching, by normalized app id
+app_states = {}
+
+
+def new_app_state(app_key=""):
+    return {
+        'last_update_time': 0,
+        'last_position': 0,
+        'last_song_id': "",
+        'last_known_position': 0,
+        'cover': '',  # content hash of the cover, see cover_store
+        'cover_song_id': '',
+        'cover_task': None,  # asyncio task loading the cover of cover_task_song_id, see update_cover
+        'cover_task_song_id': '',
+        # A hung thumbnail read is not retried on every poll
+        'cover_breaker': CircuitBreaker(f"Cover of {app_key or 'an app'}", 'cover', threshold=1)
+    }
+
+
+async def fetch_cover(session):
+    #print("DEBUG: fetch_cover")
+    """
+    Content hash of the session's cover, from its thumbnail or else the music library.
+    Raises TimeoutError when reading the thumbnail hung.
+    """
+    cover = await extract_cover(session['thumbnail']) if session['thumbnail'] else ""
+    if not cover and music_library is not None:
+        cover = await library_cover(session)
+    return cover
+
+
+async def update_cover(session, state, song_id):
+    #print("DEBUG: update_cover")
+    """
+    Load the cover of `song_id` into state['cover'] in a background task. The poll that starts
+    the task waits up to COVER_WAIT_TIMEOUT for it, a slower cover is picked up by a later poll,
+    so a hung thumbnail never holds back the metadata of any app. A failed or timed out cover
+    opens the app's cover breaker and is tried again after its cooldown.
+    """
+    task = state['cover_task']
+    if task is not None and state['cover_task_song_id'] != song_id:
+        task.cancel()
+        task = state['cover_task'] = None
+    if task is None:
+        state['cover'] = ""
+        if not state['cover_breaker'].allow():
+            return
+        task = asyncio.ensure_future(fetch_cover(session))
+        state['cover_task'], state['cover_task_song_id'] = task, song_id
+        await asyncio.wait([task], timeout=COVER_WAIT_TIMEOUT)
+        if not task.done():
+            # Publish the cover as soon as it is there, not on the next regular poll
+            task.add_done_callback(lambda _: media_source.notify_changed())
+    if not task.done():
+        return
+
+    state['cover_task'] = None
+    try:
+        state['cover'] = task.result()
+    except Exception as e:
+        print(f"Error loading cover: {e}")
+        state['cover_breaker'].record_failure()
+        return
+    state['cover_breaker'].record_success()
+    state['cover_song_id'] = song_id
+
+
+async def get_media_info(session, state):
+    #print("DEBUG: get_media_info")
+    """
+    Build the media info of one session. `state` is the app's entry in app_states.
+    """
+    app_id = session['app_id']
+
+    current_song_id = f"{session['title']}-{session['artist']}"
+    playback_status = session['playback_status']
+    playback_rate = session.get('playback_rate') or 1.0
+
+    current_time = time.monotonic()
+    current_timeline_position = int(session['position'])
+
+    if (
+        current_song_id != state['last_song_id'] or
+        abs(current_timeline_position - state['last_known_position']) > 1
+    ):
+        state['last_position'] = current_timeline_position
+        state['last_update_time'] = current_time
+        state['last_song_id'] = current_song_id
+
+    if playback_status == 4:  # Playing
+        elapsed_time = current_time - state['last_update_time']
+        position = state['last_position'] + elapsed_time * playback_rate
+    else:
+        position = current_timeline_position
+
+    state['last_update_time'] = current_time
+    state['last_position'] = position
+    state['last_known_position'] = current_timeline_position
+
+    duration = session['duration']
+
+    # Only reload cover art if the song changed, or its thumbnail came in after the song
+    cover_song_id = f"{current_song_id}-{session['thumbnail'] is not None}"
+    if cover_song_id != state['cover_song_id']:
+        await update_cover(session, state, cover_song_id)
+
+    cover_entry = get_cover(state['cover']) if state['cover'] else None
+    palette = (cover_entry or {}).get('palette') or {}
+
+    return {
+        'title': session['title'],
+        'artist': session['artist'],
+        'position': position,
+        'duration': duration,
+        'cover': cover_url(state['cover']),
+        'app_id': app_id,
+        'status': STATUS_MAP.get(playback_status, "Unknown"),
+        'position_time': current_time,
+        'playback_rate': playback_rate,
+        'timeline_updated': session.get('timeline_updated'),
+        'accent': palette.get('accent', ''),
+        'background': palette.get('background', ''),
+        'stale': bool(session.get('stale'))
+    }
+
+
+# Last good media info of every app and the current app, served marked as stale while the
+# media source or a session fails, see get_all_media_info
+last_good_media = ({}, None)
+source_breaker = CircuitBreaker("Media source", 'source')
+session_breakers = {}  # normalized app id -> CircuitBreaker
+
+
+def stale_media_info(info):
+    metrics.inc('nowplaying_stale_responses_total')
+    return info if info.get('stale') else dict(info, stale=True)
+
+
+async def get_all_media_info():
+    """
+    Return ({normalized app id: media info}, normalized app id of the current session).
+    While the media source or a session keeps failing or timing out, its circuit breaker is
+    open: it is not called and its last good media info is returned marked as stale.
+    """
+    global last_good_media
+    #print("DEBUG: get_all_media_info")
+    last_infos, last_current_app_key = last_good_media
+    sessions = None
+    if source_breaker.allow():
+        try:
+            sessions, current_app_id = await with_deadline('get_sessions', media_source.get_sessions(), MEDIA_SOURCE_TIMEOUT)
+            source_breaker.record_success()
+        except Exception as e:
+            print(f"Error in get_all_media_info: {e}")
+            source_breaker.record_failure()
+    if sessions is None:
+        return {app_key: stale_media_info(info) for app_key, info in last_infos.items()}, last_current_app_key
+
+    infos = {}
+    for session in sessions:
+        app_key = normalize_app_id(session['app_id'])
+        breaker = session_breakers.setdefault(app_key, CircuitBreaker(f"Media session {app_key}", 'session'))
+        if breaker.allow():
+            try:
+                infos[app_key] = await get_media_info(session, app_states.setdefault(app_key, new_app_state(app_key)))
+                breaker.record_success()
+                continue
+            except Exception as e:
+                print(f"Error in get_media_info: {e}")
+                breaker.record_failure()
+        if app_key in last_infos:
+            infos[app_key] = stale_media_info(last_infos[app_key])
+
+    # Forget apps without a session
+    app_keys = {normalize_app_id(session['app_id']) for session in sessions}
+    for app_key in [app_key for app_key in app_states if app_key not in app_keys]:
+        if app_states[app_key]['cover_task'] is not None:
+            app_states[app_key]['cover_task'].cancel()
+        del app_states[app_key]
+    for app_key in [app_key for app_key in session_breakers if app_key not in app_keys]:
+        del session_breakers[app_key]
+
+    last_good_media = (infos, normalize_app_id(current_app_id))
+    return last_good_media
+
+def detect_image_mimetype(data):
+    #print("DEBUG: detect_image_mimetype")
+    """
+    Guess the image mimetype from the magic bytes of the data.
+    """
+    if data.startswith(b"\x89PNG\r\n\x1a\n"):
+        return "image/png"
+    if data.startswith(b"\xff\xd8\xff"):
+        return "image/jpeg"
+    if data.startswith((b"GIF87a", b"GIF89a")):
+        return "image/gif"
+    if data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+        return "image/webp"
+    if data.startswith(b"BM"):
+        return "image/bmp"
+    return "application/octet-stream"
+
+
+PIL_FORMAT_MIMETYPES = {
+    'PNG': 'image/png',
+    'JPEG': 'image/jpeg',
+    'GIF': 'image/gif',
+    'WEBP': 'image/webp',
+    'BMP': 'image/bmp'
+}
+
+
+def encode_widget_cover(img):
+    #print("DEBUG: encode_widget_cover")
+    """
+    Encode a cover variant for the browser source: WebP if Pillow supports it, else JPEG (PNG with transparency).
+    """
+    from PIL import features
+
+    has_alpha = img.mode in ("RGBA", "LA") or (img.mode == "P" and "transparency" in img.info)
+    output = io.BytesIO()
+    if features.check("webp"):
+        img.convert("RGBA" if has_alpha else "RGB").save(output, "WEBP", quality=COVER_WIDGET_QUALITY, method=4)
+        return output.getvalue(), "image/webp"
+    if has_alpha:
+        img.convert("RGBA").save(output, "PNG", optimize=True)
+        return output.getvalue(), "image/png"
+    img.convert("RGB").save(output, "JPEG", quality=COVER_WIDGET_QUALITY, optimize=True)
+    return output.getvalue(), "image/jpeg"
+
+
+COVER_PALETTE_SAMPLE = 64  # covers are downsampled to at most this many pixels per side for the palette
+DEFAULT_ACCENT = (13, 110, 253)  # #0d6efd, the layouts' default progress bar color
+
+
+def rgb_hex(color):
+    return "#{:02x}{:02x}{:02x}".format(*(int(round(channel)) for channel in color))
+
+
+def compute_cover_palette(img):
+    #print("DEBUG: compute_cover_palette")
+    """
+    Return {'accent', 'background'} hex colors of a PIL cover image, None without NumPy.
+    Pixels of the downsampled cover are quantized to 4 bits per channel. The background is
+    the most common color, darkened until white text is readable on it. The accent is the most
+    common saturated color that differs from the background, lightened until it stands out.
+    """
+    try:
+        import numpy as np
+    except ImportError:
+        return None
+
+    sample = img.copy()
+    sample.thumbnail((COVER_PALETTE_SAMPLE, COVER_PALETTE_SAMPLE))
+    sample = sample.convert("RGB")
+    pixels = np.asarray(sample, dtype=np.uint8).reshape(-1, 3)
+
+    bins = ((pixels[:, 0] >> 4).astype(np.int32) << 8) | ((pixels[:, 1] >> 4).astype(np.int32) << 4) | (pixels[:, 2] >> 4)
+    counts = np.bincount(bins, minlength=4096)
+    used = np.nonzero(counts)[0]
+    # Mean color of every used bin
+    colors = np.stack([
+        np.bincount(bins, weights=pixels[:, channel], minlength=4096)[used] for channel in range(3)
+    ], axis=1) / counts[used, None]
+    counts = counts[used]
+
+    def luminance(color):
+        return (color * np.array([0.2126, 0.7152, 0.0722])).sum(axis=-1) / 255
+
+    background = colors[np.argmax(counts)]
+    if luminance(background) > 0.18:
+        background = background * (0.18 / luminance(background))
+
+    brightest = colors.max(axis=1)
+    saturation = np.where(brightest > 0, (brightest - colors.min(axis=1)) / np.maximum(brightest, 1), 0)
+    distance = np.sqrt(((colors - background) ** 2).sum(axis=1))
+    score = counts * (saturation + 0.05) * (brightest > 60) * (distance > 80)
+    if score.max() > 0:
+        accent = colors[np.argmax(score)]
+        # Lighten towards white until it stands out from the darkened background
+        while luminance(accent) < luminance(background) + 0.25 and accent.min() < 250:
+            accent = accent + (255 - accent) * 0.15
+    else:
+        accent = np.array(DEFAULT_ACCENT, dtype=float)
+
+    return {'accent': rgb_hex(accent), 'background': rgb_hex(background)}
+
+
+def make_gui_cover(img):
+    # The control window's cover variant of a decoded cover
+    return img.convert("RGBA").resize(COVER_GUI_SIZE)
+
+
+def decode_cover_palette(data):
+    #print("DEBUG: decode_cover_palette")
+    """
+    Palette of undecoded cover bytes, None without Pillow. JPEGs are decoded at reduced size only.
+    """
+    try:
+        from PIL import Image
+    except ImportError:
+        return None
+    try:
+        img = Image.open(io.BytesIO(data))
+        img.draft("RGB", (COVER_PALETTE_SAMPLE, COVER_PALETTE_SAMPLE))
+        return compute_cover_palette(img)
+    except Exception as e:
+        print(f"Error computing cover palette: {e}")
+        return None
+
+
+def process_cover(data):
+    #print("DEBUG: process_cover")
+    """
+    Decode the cover once and build its variants:
+      original - the thumbnail bytes with their real mimetype
+      widget   - at most COVER_WIDGET_SIZE pixels, served to the browser source
+      gui      - 60x60 RGBA PIL image for the control window
+      palette  - accent and background color for the widget, see compute_cover_palette
+    CPU heavy, runs in an executor and never on the poll loop. Without COVER_PROCESSING
+    all variants are the original bytes, and the cover is only decoded at low resolution for the palette.
+    """
+    entry = {
+        'original': data,
+        'mimetype': detect_image_mimetype(data),
+        'widget': data,
+        'widget_mimetype': detect_image_mimetype(data),
+        'gui': None,
+        'palette': None
+    }
+    if not COVER_PROCESSING:
+        entry['palette'] = decode_cover_palette(data)
+        entry['size'] = len(data)
+        return entry
+    try:
+        from PIL import Image
+
+        img = Image.open(io.BytesIO(data))
+        img.load()
+        entry['mimetype'] = PIL_FORMAT_MIMETYPES.get(img.format, entry['mimetype'])
+        entry['widget_mimetype'] = entry['mimetype']
+
+        # Small JPEG/WebP covers are served as they are, everything else is resized and re-encoded
+        if max(img.size) > COVER_WIDGET_SIZE or img.format not in ('JPEG', 'WEBP'):
+            widget_img = img.copy()
+            widget_img.thumbnail((COVER_WIDGET_SIZE, COVER_WIDGET_SIZE))
+            widget, widget_mimetype = encode_widget_cover(widget_img)
+            if len(widget) < len(data):
+                entry['widget'], entry['widget_mimetype'] = widget, widget_mimetype
+
+        entry['gui'] = make_gui_cover(img)
+        entry['palette'] = compute_cover_palette(entry['gui'])  # already downsampled
+    except Exception as e:
+        print(f"Error processing cover: {e}")
+
+    entry['size'] = (
+        len(entry['original']) +
+        (len(entry['widget']) if entry['widget'] is not entry['original'] else 0) +
+        (COVER_GUI_SIZE[0] * COVER_GUI_SIZE[1] * 4 if entry['gui'] is not None else 0)
+    )
+    return entry
+
+
+def make_paused_image(img):
+    #print("DEBUG: make_paused_image")
+    """
+    The 60x60 control window cover with a pause symbol on top.
+    """
+    from PIL import Image, ImageDraw
+
+    overlay = Image.new("RGBA", img.size, (0, 0, 0, 0))
+    draw = ImageDraw.Draw(overlay)
+
+    # Dimensions for pause bars
+    bar_width = 6
+    spacing = 6
+    height = 30
+    x_center = img.width // 2
+
+    # Left bar
+    draw.rectangle(
+        [x_center - spacing - bar_width, (img.height - height) // 2,
+         x_center - spacing, (img.height + height) // 2],
+        fill=(255, 255, 255, 180)
+    )
+    # Right bar
+    draw.rectangle(
+        [x_center + spacing, (img.height - height) // 2,
+         x_center + spacing + bar_width, (img.height + height) // 2],
+        fill=(255, 255, 255, 180)
+    )
+
+    return Image.alpha_composite(img, overlay)
+
+
+def store_cover_entry(cover_hash, entry):
+    """
+    Add a processed cover to the LRU cache, evicting the least recently used covers over the byte budget.
+    """
+    global cover_store_bytes
+    #print("DEBUG: store_cover_entry")
+    with cover_store_lock:
+        if cover_hash in cover_store:
+            cover_store.move_to_end(cover_hash)
+            return
+        cover_store[cover_hash] = entry
+        cover_store_bytes += entry['size']
+        while cover_store_bytes > COVER_CACHE_MAX_BYTES and len(cover_store) > 1:
+            _, evicted = cover_store.popitem(last=False)
+            cover_store_bytes -= evicted['size']
+
+
+def store_cover(data):
+    #print("DEBUG: store_cover")
+    """
+    Process and store cover bytes under their content hash and return the hash.
+    """
+    cover_hash = hashlib.sha1(data).hexdigest()
+    if get_cover(cover_hash) is None:
+        store_cover_entry(cover_hash, process_cover(data))
+    return cover_hash
+
+
+def get_cover(cover_hash):
+    #print("DEBUG: get_cover")
+    with cover_store_lock:
+        entry = cover_store.get(cover_hash)
+        if entry is not None:
+            cover_store.move_to_end(cover_hash)
+        return entry
+
+
+def cover_url(cover_hash):
+    return f"/cover/{cover_hash}" if cover_hash else ""
+
+
+def cover_hash_from_url(url):
+    return url.rsplit("/", 1)[-1] if url else ""
+
+
+async def extract_cover(thumbnail):
+    #print("DEBUG: extract_cover")
+    """
+    Read the thumbnail stream into the cover store and return its content hash.
+    Decoding and resizing runs in an executor so it never blocks the poll loop.
+    """
+    try:
+        with metrics.time('nowplaying_cover_extract_seconds', stage='read'):
+            data = await with_deadline('read_thumbnail', media_source.read_thumbnail(thumbnail), THUMBNAIL_TIMEOUT)
+
+        cover_hash = hashlib.sha1(data).hexdigest()
+        if get_cover(cover_hash) is None:
+            metrics.observe('nowplaying_cover_bytes', len(data))
+            with metrics.time('nowplaying_cover_extract_seconds', stage='process'):
+                entry = await asyncio.get_running_loop().run_in_executor(None, process_cover, data)
+            store_cover_entry(cover_hash, entry)
+        return cover_hash
+    except TimeoutError:
+        # A hung player, opens the app's cover breaker, see update_cover
+        raise
+    except Exception as e:
+        print(f"Error extracting cover: {e}")
+        return ""
+
+
+# ---------------------------------------------------------------------------
+# Music library cover fallback
+#
+# Players without a thumbnail get the cover from the local music library: the configured
+# folders are scanned in the background into a SQLite index (embedded art via mutagen when
+# installed, else cover.jpg/folder.jpg next to the files). Files whose mtime and size did not
+# change are not read again. Covers are stored resized, a lookup is a dict hit plus one row read.
+# ---------------------------------------------------------------------------
+
+LIBRARY_FILE = os.path.join(get_exe_dir(), "now_playing_library.db")
+LIBRARY_AUDIO_EXTENSIONS = ('.mp3', '.flac', '.m4a', '.mp4', '.aac', '.ogg', '.oga', '.opus', '.wma', '.wav', '.aiff', '.ape', '.wv')
+LIBRARY_FOLDER_IMAGES = ('cover', 'folder', 'front', 'album', 'albumart', 'albumartlarge')  # with .jpg, .jpeg or .png
+LIBRARY_COMMIT_EVERY = 500  # files per transaction while scanning
+
+LIBRARY_SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY,
+    mtime REAL NOT NULL,
+    size INTEGER NOT NULL,
+    art_mtime REAL NOT NULL,
+    artist TEXT,
+    title TEXT,
+    album TEXT,
+    cover TEXT
+);
+CREATE TABLE IF NOT EXISTS covers (
+    hash TEXT PRIMARY KEY,
+    data BLOB NOT NULL
+);
+"""
+
+
+def normalize_tag(value, first_artist=False):
+    """
+    Lookup form of an artist, title or album: case, accents, bracketed suffixes like
+    '(Remastered 2011)' and punctuation do not matter. With `first_artist` only the first
+    of several artists is kept.
+    """
+    if not value:
+        return ""
+    value = unicodedata.normalize("NFKD", str(value).casefold())
+    value = "".join(char for char in value if not unicodedata.combining(char))
+    if first_artist:
+        value = re.split(r",|;|&|/| feat\.? | ft\.? | featuring | x ", value)[0]
+    value = re.sub(r"[\(\[].*?[\)\]]", " ", value)
+    return " ".join(re.sub(r"[^\w]+", " ", value).split())
+
+
+def library_keys(artist, title, album):
+    artist = normalize_tag(artist, first_artist=True)
+    keys = []
+    if artist and title:
+        keys.append(('title', artist, normalize_tag(title)))
+    if artist and album:
+        keys.append(('album', artist, normalize_tag(album)))
+    return keys
+
+
+# Tag names per field in ID3, MP4, ASF (WMA) and Vorbis comment or APEv2 tags
+AUDIO_TAG_NAMES = {
+    'albumartist': ('TPE2', 'aART', 'WM/AlbumArtist', 'albumartist', 'album artist'),
+    'artist': ('TPE1', '\xa9ART', 'Author', 'artist'),
+    'title': ('TIT2', '\xa9nam', 'Title', 'title'),
+    'album': ('TALB', '\xa9alb', 'WM/AlbumTitle', 'album')
+}
+
+
+def audio_tag(tags, field):
+    """
+    First value of a field in the tags of a mutagen file, whatever the tag format, "" if missing.
+    """
+    for name in AUDIO_TAG_NAMES[field]:
+        try:
+            value = tags[name]
+        except (KeyError, ValueError, TypeError):
+            continue
+        value = getattr(value, 'text', value)  # ID3 frames
+        if isinstance(value, (list, tuple)):
+            value = value[0] if value else ""
+        value = str(value).strip()
+        if value:
+            return value
+    return ""
+
+
+def read_audio_file(path):
+    #print("DEBUG: read_audio_file")
+    """
+    Return (artist, title, album, embedded art bytes or None). Tags and art need mutagen,
+    without it artist and title come from the path ('Artist - Title.mp3' or 'Artist/Album/01 Title.mp3').
+    """
+    try:
+        import mutagen
+    except ImportError:
+        mutagen = None
+
+    if mutagen is not None:
+        try:
+            # Opened once for tags and art
+            audio = mutagen.File(path)
+            if audio is not None and audio.tags:
+                artist = audio_tag(audio.tags, 'albumartist') or audio_tag(audio.tags, 'artist')
+                title = audio_tag(audio.tags, 'title')
+                album = audio_tag(audio.tags, 'album')
+                if artist and title:
+                    return artist, title, album, read_embedded_art(audio)
+        except Exception as e:
+            print(f"Error reading tags of {path}: {e}")
+
+    stem = os.path.splitext(os.path.basename(path))[0]
+    album_dir = os.path.dirname(path)
+    if " - " in stem:
+        artist, title = stem.split(" - ", 1)
+        artist = re.sub(r"^\d+[\s.\-_]*", "", artist)
+    else:
+        artist = os.path.basename(os.path.dirname(album_dir))
+        title = re.sub(r"^\d+[\s.\-_]*", "", stem)
+    return artist.strip(), title.strip(), os.path.basename(album_dir), None
+
+
+def read_embedded_art(audio):
+    """
+    Front cover (or the first picture) of a mutagen file: ID3 APIC, FLAC/Ogg pictures or MP4 covr.
+    """
+    if audio is None:
+        return None
+    pictures = list(getattr(audio, 'pictures', None) or [])
+    tags = audio.tags
+    if tags is not None:
+        if hasattr(tags, 'getall'):
+            pictures += tags.getall('APIC')
+        if 'covr' in tags:
+            return bytes(tags['covr'][0])
+        if 'metadata_block_picture' in tags:
+            from mutagen.flac import Picture
+
+            pictures += [Picture(base64.b64decode(value)) for value in tags['metadata_block_picture']]
+    if not pictures:
+        return None
+    front = [picture for picture in pictures if getattr(picture, 'type', None) == 3]
+    return (front or pictures)[0].data
+
+
+def resize_library_cover(data):
+    """
+    Widget sized version of cover art, the original if it cannot be decoded.
+    """
+    try:
+        from PIL import Image
+
+        img = Image.open(io.BytesIO(data))
+        img.load()
+        if max(img.size) > COVER_WIDGET_SIZE or img.format not in ('JPEG', 'WEBP'):
+            img.thumbnail((COVER_WIDGET_SIZE, COVER_WIDGET_SIZE))
+            resized, _ = encode_widget_cover(img)
+            if len(resized) < len(data):
+                return resized
+    except Exception as e:
+        print(f"Error resizing library cover: {e}")
+    return data
+
+
+class MusicLibrary:
+    """
+    Index of cover art in local music folders, see the section comment. The index keys are
+    ('title', artist, title) and ('album', artist, album) in normalize_tag form.
+    """
+    def __init__(self, path, folders):
+        self.path = path
+        self.folders = [os.path.abspath(folder) for folder in folders]
+        self.index = {}  # key -> cover hash, replaced as a whole after every scan
+        self._db = None
+        self._db_lock = threading.Lock()
+        self._scan_thread = None
+
+    def _connect(self):
+        if self._db is None:
+            import sqlite3
+
+            db = sqlite3.connect(self.path, check_same_thread=False)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.executescript(LIBRARY_SCHEMA)
+            self._db = db
+        return self._db
+
+    def load_index(self):
+        #print("DEBUG: MusicLibrary.load_index")
+        """
+        Build the lookup dict from the database. Ambiguous keys go to the first file in path order.
+        """
+        index = {}
+        with self._db_lock:
+            rows = self._connect().execute(
+                "SELECT artist, title, album, cover FROM files WHERE cover IS NOT NULL ORDER BY path"
+            ).fetchall()
+        for artist, title, album, cover_hash in rows:
+            for key in library_keys(artist, title, album):
+                index.setdefault(key, cover_hash)
+        self.index = index
+
+    def start(self):
+        #print("DEBUG: MusicLibrary.start")
+        """
+        Load the index of the last run and update it in the background.
+        """
+        try:
+            self.load_index()
+        except Exception as e:
+            print(f"Error loading music library index: {e}")
+        if self._scan_thread is None:
+            self._scan_thread = threading.Thread(target=self.scan, daemon=True)
+            self._scan_thread.start()
+
+    def _folder_image(self, directory, names):
+        for name in names:
+            base, extension = os.path.splitext(name)
+            if base.lower() in LIBRARY_FOLDER_IMAGES and extension.lower() in ('.jpg', '.jpeg', '.png'):
+                path = os.path.join(directory, name)
+                try:
+                    return path, os.path.getmtime(path)
+                except OSError:
+                    pass
+        return None, 0.0
+
+    def _resize_cover(self, data, resized_covers):
+        """
+        Return (cover hash, resized cover), the resized cover is None when this scan already has it.
+        """
+        source_hash = hashlib.sha1(data).hexdigest()
+        if source_hash in resized_covers:
+            return resized_covers[source_hash], None
+        resized = resize_library_cover(data)
+        cover_hash = hashlib.sha1(resized).hexdigest()
+        resized_covers[source_hash] = cover_hash
+        return cover_hash, resized
+
+    def scan(self):
+        #print("DEBUG: MusicLibrary.scan")
+        """
+        Walk the music folders and (re)index new and changed files, drop removed ones.
+        """
+        started = time.perf_counter()
+        with self._db_lock:
+            known = {
+                path: (mtime, size, art_mtime, cover_hash)
+                for path, mtime, size, art_mtime, cover_hash in
+                self._connect().execute("SELECT path, mtime, size, art_mtime, cover FROM files")
+            }
+        seen = set()
+        indexed = 0
+        resized_covers = {}  # sha1 of source art -> hash of the stored cover, within this scan
+        db = self._db
+
+        for folder in self.folders:
+            for directory, _, names in os.walk(folder):
+                folder_image, folder_image_mtime = self._folder_image(directory, names)
+                folder_cover = None
+                for name in names:
+                    if not name.lower().endswith(LIBRARY_AUDIO_EXTENSIONS):
+                        continue
+                    path = os.path.join(directory, name)
+                    try:
+                        stat = os.stat(path)
+                    except OSError:
+                        continue
+                    seen.add(path)
+                    old = known.get(path)
+                    # Files with embedded art (art_mtime -1) do not depend on the folder image
+                    if old is not None and old[0] == stat.st_mtime and old[1] == stat.st_size and old[2] in (-1, folder_image_mtime):
+                        continue
+
+                    try:
+                        artist, title, album, art = read_audio_file(path)
+                        # Reading and resizing run without the database lock, cover lookups from the poll loop wait for it
+                        new_cover = None
+                        art_mtime = -1
+                        if art:
+                            cover_hash, new_cover = self._resize_cover(art, resized_covers)
+                        elif folder_image:
+                            if folder_cover is None:
+                                with open(folder_image, "rb") as f:
+                                    folder_cover, new_cover = self._resize_cover(f.read(), resized_covers)
+                            cover_hash, art_mtime = folder_cover, folder_image_mtime
+                        else:
+                            cover_hash, art_mtime = None, 0.0
+                        with self._db_lock:
+                            if new_cover is not None:
+                                db.execute("INSERT OR IGNORE INTO covers (hash, data) VALUES (?, ?)", (cover_hash, new_cover))
+                            db.execute(
+                                "INSERT OR REPLACE INTO files (path, mtime, size, art_mtime, artist, title, album, cover) "
+                                "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                                (path, stat.st_mtime, stat.st_size, art_mtime, artist, title, album, cover_hash)
+                            )
+                            indexed += 1
+                            if indexed % LIBRARY_COMMIT_EVERY == 0:
+                                db.commit()
+                    except Exception as e:
+                        print(f"Error indexing {path}: {e}")
+
+        with self._db_lock:
+            removed = [path for path in known if path not in seen]
+            db.executemany("DELETE FROM files WHERE path = ?", [(path,) for path in removed])
+            if removed or indexed:
+                db.execute("DELETE FROM covers WHERE hash NOT IN (SELECT cover FROM files WHERE cover IS NOT NULL)")
+            db.commit()
+        self.load_index()
+        print(f"Music library: {len(seen)} files, {indexed} indexed, {len(removed)} removed, "
+              f"{len(self.index)} cover keys in {time.perf_counter() - started:.1f} s")
+
+    def lookup(self, artist, title, album=None):
+        """
+        Cover hash for a track, or None. Only a dict lookup, never touches the disk.
+        """
+        for key in library_keys(artist, title, album):
+            cover_hash = self.index.get(key)
+            if cover_hash:
+                return cover_hash
+        return None
+
+    def get_cover_data(self, cover_hash):
+        with self._db_lock:
+            row = self._connect().execute("SELECT data FROM covers WHERE hash = ?", (cover_hash,)).fetchone()
+        return row[0] if row else None
+
+
+music_library = None  # MusicLibrary, when music folders are configured, see main
+
+
+async def library_cover(session):
+    #print("DEBUG: library_cover")
+    """
+    Cover hash from the music library for a session without a thumbnail, "" if there is none.
+    """
+    cover_hash = music_library.lookup(session['artist'], session['title'], session.get('album'))
+    if not cover_hash:
+        return ""
+    if get_cover(cover_hash) is None:
+        def load():
+            data = music_library.get_cover_data(cover_hash)
+            return process_cover(data) if data else None
+
+        try:
+            entry = await asyncio.get_running_loop().run_in_executor(None, load)
+        except Exception as e:
+            print(f"Error loading library cover: {e}")
+            return ""
+        if entry is None:
+            return ""
+        store_cover_entry(cover_hash, entry)
+    return cover_hash
+
+
+def apply_media_update(new_info):
+    """
+    Swap in a new snapshot with the new media info and wake up all waiting /media/stream clients.
+    """
+    global media_snapshot, media_info, media_version
+    #print("DEBUG: apply_media_update")
+    with media_changed:
+        snapshot = media_snapshot.with_changes(new_info)
+        media_snapshot, media_info, media_version = snapshot, snapshot.info, snapshot.version
+        media_changed.notify_all()
+        updated_info = media_info
+    wake_async_streams()
+
+    for listener in media_listeners:
+        try:
+            listener(updated_info)
+        except Exception as e:
+            print(f"Error in media listener: {e}")
+
+
+def add_media_listener(callback):
+    #print("DEBUG: add_media_listener")
+    """
+    Call `callback(media_info)` from the poller thread after every applied media update.
+    """
+    media_listeners.append(callback)
+
+
+def get_media_snapshot():
+    # A single reference read, snapshots are never mutated
+    return media_snapshot
+
+
+def update_app_media_index(infos):
+    """
+    Store the media info of every session by normalized app id, each app with its own version.
+    """
+    global app_media_version, sessions_json
+    #print("DEBUG: update_app_media_index")
+    with media_changed:
+        changed = False
+        for app_key, info in infos.items():
+            if is_significant_change(info, app_media_info.get(app_key)):
+                metrics.inc('nowplaying_significant_changes_total', scope='app')
+                app_media_version += 1
+                app_media_info[app_key] = info
+                app_snapshots[app_key] = MediaSnapshot(app_media_version, info)
+                changed = True
+        for app_key in [app_key for app_key in app_media_info if app_key not in infos]:
+            app_media_version += 1
+            del app_media_info[app_key]
+            app_snapshots[app_key] = MediaSnapshot(app_media_version, DEFAULT_MEDIA_INFO)
+            changed = True
+        if changed:
+            sessions_json = json.dumps({
+                app_key: {**info, 'version': app_snapshots[app_key].version}
+                for app_key, info in app_media_info.items()
+            }).encode('utf-8')
+            media_changed.notify_all()
+    if changed:
+        wake_async_streams()
+
+
+def get_app_media_snapshot(app_key):
+    """
+    Snapshot of one app, a default one if the app never had a session.
+    """
+    return app_snapshots.get(app_key, EMPTY_APP_SNAPSHOT)
+
+
+def get_stream_snapshot(app_key):
+    return get_app_media_snapshot(app_key) if app_key else get_media_snapshot()
+
+
+def stream_event(snapshot, seen_version=None):
+    """
+    Encoded /media/stream event for a client at `seen_version`: the full media info for a new
+    client or an app stream, only the changed fields otherwise.
+    """
+    if seen_version is None or snapshot.version < seen_version:
+        body = snapshot.json
+    else:
+        body = snapshot.delta_json(seen_version)
+    return b"data: " + with_server_time(body) + b"\n\n"
+
+
+def layout_event():
+    """
+    Encoded /media/stream event asking pages that show the default layout to reload.
+    """
+    return b"event: layout\ndata: " + json.dumps({'layout': template_name}).encode('utf-8') + b"\n\n"
+
+
+class PollScheduler:
+    """
+    Picks the time until the next poll from the widget's media info: POLL_MIN_INTERVAL for a few
+    polls after a track or status change and in the last seconds of a track, POLL_INTERVAL while
+    playing, and backing off up to max_interval while paused, stopped or without a session.
+    Event driven media sources still wake the poller early on every change.
+    """
+    def __init__(self, min_interval=None, max_interval=None):
+        self.min_interval = min_interval or POLL_MIN_INTERVAL
+        self.max_interval = max(max_interval or POLL_MAX_INTERVAL, self.min_interval)
+        self._last_key = None
+        self._fast_polls = 0
+        self._idle_interval = None
+
+    def next_interval(self, info, now=None):
+        #print("DEBUG: PollScheduler.next_interval")
+        """
+        Seconds until the next poll after a poll that left the widget at `info`.
+        """
+        now = time.monotonic() if now is None else now
+        key = (info.get('app_id'), info.get('title'), info.get('artist'), info.get('status'))
+        if key != self._last_key:
+            self._last_key = key
+            self._fast_polls = POLL_FAST_POLLS
+            self._idle_interval = None
+
+        if self._fast_polls > 0:
+            self._fast_polls -= 1
+            return self.min_interval
+        return min(max(self._interval(info, now), self.min_interval), self.max_interval)
+
+    def _interval(self, info, now):
+        if info.get('status') != "Playing":
+            # Nothing to miss while nothing plays
+            self._idle_interval = min(self.max_interval, self._idle_interval * POLL_BACKOFF) if self._idle_interval else POLL_INTERVAL
+            return self._idle_interval
+        self._idle_interval = None
+
+        duration = info.get('duration') or 0
+        rate = info.get('playback_rate') or 1.0
+        if duration <= 0 or rate <= 0:
+            return POLL_INTERVAL
+        position = info.get('position', 0) + max(0.0, now - info.get('position_time', now)) * rate
+        remaining = (duration - position) / rate
+        if remaining > POLL_TRACK_END_WINDOW:
+            # Wake up when the track enters its last seconds
+            return min(POLL_INTERVAL, remaining - POLL_TRACK_END_WINDOW)
+        if remaining > -POLL_TRACK_END_WINDOW:
+            return self.min_interval
+        return POLL_INTERVAL  # player stuck past the end, no track change to catch
+
+
+poller_deadline = None  # time.monotonic() the running poll or the next poll must be done by, see watch_media_poller
+
+
+async def update_media_info():
+    global media_info, locked_app_id, poller_deadline
+    #print("DEBUG: update_media_info")
+    scheduler = PollScheduler()
+    interval = POLL_INTERVAL
+    last_poll_start = None
+    while True:
+        #print("DEBUG: update_media_info while")
+        poller_deadline = time.monotonic() + POLL_STALL_TIMEOUT
+        poll_start = time.perf_counter()
+        if last_poll_start is not None:
+            # Event driven sources wake up early, only polls later than scheduled count as lag
+            metrics.observe('nowplaying_poll_lag_seconds', max(0.0, poll_start - last_poll_start - interval))
+        last_poll_start = poll_start
+        metrics.inc('nowplaying_polls_total')
+
+        try:
+            infos, current_app_key = await get_all_media_info()
+            update_app_media_index(infos)
+            if play_history is not None:
+                play_history.observe(infos)
+
+            # A locked app is a lookup in the index, otherwise follow the current session
+            new_info = infos.get(locked_app_id or current_app_key)
+
+            if new_info:
+                if is_significant_change(new_info, media_info):
+                    metrics.inc('nowplaying_significant_changes_total', scope='widget')
+                    apply_media_update(new_info)
+            elif media_info != DEFAULT_MEDIA_INFO:
+                # Reset to default when no session is active
+                metrics.inc('nowplaying_significant_changes_total', scope='widget')
+                apply_media_update(DEFAULT_MEDIA_INFO)
+        except Exception as e:
+            print(f"Error updating media info: {e}")
+        first_poll_done.set()
+        metrics.observe('nowplaying_poll_duration_seconds', time.perf_counter() - poll_start)
+
+        interval = scheduler.next_interval(media_info)
+        metrics.set('nowplaying_poll_interval_seconds', interval)
+        poller_deadline = time.monotonic() + interval + POLL_STALL_TIMEOUT
+        # Returns early when an event driven media source reports a change
+        await media_source.wait_for_change(interval)
+
+
+async def watch_media_poller():
+    #print("DEBUG: watch_media_poller")
+    """
+    Run update_media_info and restart it when a poll stalls past its deadline, e.g. on a hung
+    call without a deadline of its own, or when it ends with an error. Restarts reset the media
+    source, so Windows backends request the session manager again.
+    """
+    while True:
+        poller = asyncio.ensure_future(update_media_info())
+        while not poller.done():
+            await asyncio.wait({poller}, timeout=WATCHDOG_INTERVAL)
+            if not poller.done() and poller_deadline is not None and time.monotonic() > poller_deadline:
+                metrics.inc('nowplaying_poller_stalls_total')
+                print(f"Media poller stalled for more than {POLL_STALL_TIMEOUT} seconds, restarting it")
+                poller.cancel()
+                # A call that ignores the cancellation is left behind
+                await asyncio.wait({poller}, timeout=WATCHDOG_INTERVAL)
+                break
 
-import math
+        if poller.done() and not poller.cancelled() and poller.exception() is not None:
+            print(f"Media poller failed, restarting it: {poller.exception()}")
+        try:
+            await with_deadline('reset', media_source.reset(), WINRT_CALL_TIMEOUT)
+        except Exception as e:
+            print(f"Error resetting media source: {e}")
+        await asyncio.sleep(1)
 
-from PIL import Image, ImageTk
-from PIL import ImageDraw
-import io
+
+def probe_first_media_response(host, port):
+    #print("DEBUG: probe_first_media_response")
+    """
+    Once the first poll filled media_info, request /media from this instance until the server
+    answers and print the time from process start, for tuning cold starts. Runs in its own thread.
+    """
+    if not first_poll_done.wait(STARTUP_PROBE_TIMEOUT):
+        return
+    address = {'': '127.0.0.1', '0.0.0.0': '127.0.0.1', '::': '::1'}.get(host, host)
+    deadline = time.monotonic() + STARTUP_PROBE_TIMEOUT
+    while time.monotonic() < deadline:
+        try:
+            with socket.create_connection((address, port), timeout=1) as s:
+                s.sendall(f"GET /media HTTP/1.1\r\nHost: {address}\r\nConnection: close\r\n\r\n".encode('latin-1'))
+                if s.recv(12).startswith(b"HTTP/1.1 200"):
+                    print(f"First /media response {(time.perf_counter() - startup_time) * 1000:.0f} ms after start")
+                    return
+        except OSError:
+            pass
+        time.sleep(0.05)
 
 
-cached_cover = ''
-cached_song_id = ''
+def get_media_body(since, app_key, client_etags, accept_gzip):
+    #print("DEBUG: get_media_body")
+    """
+    Return (version, body, content encoding) for /media. The body is None when the client already
+    has the current version, either as ETag in `client_etags` or as `since`. App bodies are always full.
+    """
+    snapshot = get_app_media_snapshot(app_key) if app_key else get_media_snapshot()
 
+    if str(snapshot.version) in client_etags or (since is not None and since == snapshot.version):
+        return snapshot.version, None, None
+    body, encoding = snapshot.body(None if app_key else since, accept_gzip)
+    return snapshot.version, body, encoding
 
 
-def get_exe_dir():
-    #print("DEBUG: get_exe_dir")
+def get_cover_variant(cover_hash, variant):
     """
-    Get the directory where the executable is located (not the temp folder).
+    Return (bytes, mimetype) of a cover variant ('widget' or 'original'), None if unknown.
     """
-    if getattr(sys, '_MEIPASS', False):
-        return os.path.dirname(sys.executable)  # Path of the .exe
-    return os.path.dirname(os.path.abspath(__file__))
+    entry = get_cover(cover_hash)
+    if not entry or variant not in ('widget', 'original'):
+        return None
+    if variant == 'original':
+        return entry['original'], entry['mimetype']
+    return entry['widget'], entry['widget_mimetype']
 
 
-SETTINGS_FILE = os.path.join(get_exe_dir(), "now_playing_settings.json")
+# Rendered widget layouts by (layout, theme), rendered and compressed once. The layouts only pull
+# their state from /media, so the page itself only changes when a template file changes.
+rendered_layouts = {}
+rendered_layouts_lock = threading.Lock()
+LAYOUT_ASSET_FILES = ('widget_base.css',)  # inlined into every layout
+LAYOUT_NAME_PATTERN = re.compile(r'^[A-Za-z0-9_-]{1,64}$')  # layout and theme names from the URL
+THEMES_DIR = 'themes'  # theme stylesheets inside the templates folder, inlined after the layout's styles
 
-def save_settings(locked_app=None, layout=None):
-    #print("DEBUG: save_settings")
-    settings = load_settings()
 
-    if locked_app is not None:
-        settings["locked_app"] = locked_app
-    elif "locked_app" in settings:
-        del settings["locked_app"]
+layout_environment = None  # jinja2 environment of the layouts, see get_layout_environment
 
-    if layout is not None:
-        settings["layout"] = layout
-    elif "layout" not in settings:
-        settings["layout"] = "horizontal"  # or some default fallback
 
-    try:
-        with open(SETTINGS_FILE, "w") as f:
-            json.dump(settings, f)
-        print(f"Saved settings: {settings}")
-    except Exception as e:
-        print(f"Error saving settings: {e}")
+def layout_files(layout, theme=None):
+    """
+    Template files a layout variant is rendered from, relative to the templates folder.
+    """
+    files = (f'{layout}.html',) + LAYOUT_ASSET_FILES
+    if theme:
+        files += (f'{THEMES_DIR}/{theme}.css',)
+    return files
 
 
+def layout_files_mtime(layout, theme=None):
+    return max(
+        os.path.getmtime(os.path.join(template_dir, name))
+        for name in layout_files(layout, theme)
+    )
 
-def load_settings():
-    #print("DEBUG: load_settings")
-    if os.path.exists(SETTINGS_FILE):
-        try:
-            with open(SETTINGS_FILE, "r") as f:
-                return json.load(f)
-        except Exception as e:
-            print(f"Error loading settings: {e}")
-    return {}  # Default empty settings
 
-def clear_locked_app():
-    save_settings(locked_app=None)
+def resolve_layout(layout=None, theme=None):
+    #print("DEBUG: resolve_layout")
+    """
+    (layout, theme) of a widget request such as /?layout=vertical&theme=compact. A missing or
+    unknown layout is the current one, a missing or unknown theme none. Any <name>.html in the
+    templates folder is a layout and any themes/<name>.css a theme.
+    """
+    if not (layout and LAYOUT_NAME_PATTERN.match(layout) and os.path.isfile(os.path.join(template_dir, f'{layout}.html'))):
+        layout = template_name
+    if not (theme and LAYOUT_NAME_PATTERN.match(theme) and os.path.isfile(os.path.join(template_dir, THEMES_DIR, f'{theme}.css'))):
+        theme = None
+    return layout, theme
 
 
+def get_layout_environment():
+    """
+    Layouts are rendered with jinja2 directly, so the async server never needs to import Flask.
+    """
+    global layout_environment
+    #print("DEBUG: get_layout_environment")
+    if layout_environment is None:
+        import jinja2
 
+        layout_environment = jinja2.Environment(
+            loader=jinja2.FileSystemLoader(template_dir),
+            autoescape=jinja2.select_autoescape(['html'])
+        )
+    return layout_environment
 
 
-def is_significant_change(new_info, old_info):
-    #print("DEBUG: is_significant_change")
-    if not old_info:
-        return True
+def get_brotli():
+    """
+    The brotli module, False if it is not installed: layouts are then served gzip compressed only.
+    """
+    global brotli
+    if brotli is None:
+        try:
+            import brotli as brotli_module
+            brotli = brotli_module
+        except ImportError:
+            brotli = False
+    return brotli
 
-    keys_to_check = ['title', 'artist', 'app_id', 'status']
-    for key in keys_to_check:
-        if new_info.get(key) != old_info.get(key):
-            return True
-    
-    if math.fabs(new_info.get('position', 0) - old_info.get('position', 0)) > 0.5:
-        return True
-    
-    return False
 
+def get_rendered_layout(layout, theme=None):
+    #print("DEBUG: get_rendered_layout")
+    """
+    Return the cached render of a layout and theme with its gzip (and brotli, if available) copy
+    and ETag. Rendered again when one of its template files changed on disk.
+    """
+    try:
+        mtime = layout_files_mtime(layout, theme)
+    except OSError:
+        mtime = None
+
+    with rendered_layouts_lock:
+        entry = rendered_layouts.get((layout, theme))
+        if entry is not None and entry['mtime'] == mtime:
+            return entry
 
+    html = get_layout_environment().get_template(f'{layout}.html').render(layout=layout, theme=theme).encode('utf-8')
+    compressor = get_brotli()
+    entry = {
+        'mtime': mtime,
+        'html': html,
+        'gzip': gzip.compress(html, compresslevel=9),
+        'br': compressor.compress(html) if compressor else None,
+        'etag': hashlib.sha1(html).hexdigest()[:20]
+    }
+    with rendered_layouts_lock:
+        rendered_layouts[(layout, theme)] = entry
+    return entry
 
 
-def copy_templates():
-    #print("DEBUG: copy_templates")
+def get_layout_body(entry, accept_encoding):
     """
-    Copy the external 'templates' folder to the temp directory if needed.
+    Return (bytes, content encoding or None) of a rendered layout for an Accept-Encoding header.
     """
-    exe_dir = get_exe_dir()
-    temp_dir = getattr(sys, '_MEIPASS', exe_dir)  # Handle both .exe and script
+    if entry['br'] is not None and 'br' in accept_encoding:
+        return entry['br'], 'br'
+    if 'gzip' in accept_encoding:
+        return entry['gzip'], 'gzip'
+    return entry['html'], None
 
-    src_templates = os.path.join(exe_dir, 'templates')
-    dest_templates = os.path.join(temp_dir, 'templates')
 
-    # Copy only if the folder exists and is not already copied
-    if os.path.exists(src_templates) and not os.path.exists(dest_templates):
-        shutil.copytree(src_templates, dest_templates)
-        print(f"Copied templates to: {dest_templates}")
-    return dest_templates
+def create_flask_app():
+    #print("DEBUG: create_flask_app")
+    """
+    Build the Flask app serving the widget. Flask is only imported when the Flask server is used.
+    """
+    from flask import Flask, Response, abort, g, redirect, request, url_for, stream_with_context
 
+    app = Flask(__name__, template_folder=template_dir)
+    app.config['MAX_CONTENT_LENGTH'] = INGEST_MAX_BODY_BYTES
 
+    @app.before_request
+    def start_request_timer():
+        g.request_start = time.perf_counter()
 
-# Ensure templates are copied
-template_folder = copy_templates()
+    @app.after_request
+    def record_request(response):
+        route = request.url_rule.rule if request.url_rule else 'other'
+        # Streams have no length
+        record_http_request(route, response.status_code, time.perf_counter() - g.request_start, response.content_length)
+        return response
 
-# Detect the base directory (location of the .exe)
-base_dir = os.path.dirname(os.path.abspath(__file__))
-print(f"Running from: {base_dir}")
-print(f"Looking for templates in: {os.path.join(base_dir, 'templates')}")
+    @app.route('/')
+    def index():
+        #print("DEBUG: /")
+        """
+        The widget layout, self-contained (no external requests) and precompressed.
+        ?layout= and ?theme= pick a variant for this page, see resolve_layout.
+        """
+        entry = get_rendered_layout(*resolve_layout(request.args.get('layout'), request.args.get('theme')))
+        if entry['etag'] in request.if_none_match:
+            response = Response(status=304)
+        else:
+            body, encoding = get_layout_body(entry, request.headers.get('Accept-Encoding', ''))
+            response = Response(body, mimetype='text/html')
+            if encoding:
+                response.headers['Content-Encoding'] = encoding
+        response.set_etag(entry['etag'])
+        response.headers['Vary'] = 'Accept-Encoding'
+        # Revalidate on every load, so a layout switch shows up at once, a 304 otherwise
+        response.headers['Cache-Control'] = 'no-cache'
+        return response
 
+    @app.route('/media')
+    def media():
+        #print("DEBUG: media")
+        """
+        Current media info. Honors If-None-Match, and ?since=<version> returns only the fields changed since then.
+        ?app=<id> returns the full media info of that app instead of the widget's selected session.
+        """
+        version, body, encoding = get_media_body(
+            request.args.get('since', type=int),
+            request.args.get('app'),
+            request.if_none_match,
+            'gzip' in request.accept_encodings
+        )
+        if body is None:
+            response = Response(status=304)
+        else:
+            response = Response(body, mimetype='application/json')
+            if encoding:
+                response.headers['Content-Encoding'] = encoding
+        response.headers['Vary'] = 'Accept-Encoding'
 
+        response.set_etag(str(version))
+        response.headers['Cache-Control'] = 'no-cache'
+        response.headers['X-Server-Time'] = repr(time.monotonic())
+        return response
 
-# Flask app with external templates folder
-app = Flask(__name__, template_folder=os.path.join(base_dir, 'templates'))
+    @app.route('/media/stream')
+    def media_stream():
+        #print("DEBUG: media_stream")
+        """
+        Server-Sent Events stream. The first event holds the full media info, every following
+        event only the fields changed since the previous one. With ?app=<id> every event holds
+        the full media info of that app.
+        """
+        app_key = request.args.get('app')
 
-media_info = {
-    'title': 'Unknown',
-    'artist': 'Unknown',
-    'position': 0,
-    'duration': 0,
-    'cover': '',
-    'app_id': 'Unknown',
-    'status': 'Stopped'
-}
+        def generate():
+            snapshot = get_stream_snapshot(app_key)
+            # Ask the browser to reconnect quickly if the connection drops
+            yield f"retry: {STREAM_RETRY_MS}\n".encode('ascii') + stream_event(snapshot)
+            seen_version = snapshot.version
+            seen_layout = layout_generation
 
-STATUS_MAP = {
-    0: "Closed",
-    1: "Stopped",
-    5: "Paused",
-    4: "Playing"
+            metrics.inc('nowplaying_stream_clients')
+            try:
+                while True:
+                    with media_changed:
+                        changed = media_changed.wait_for(
+                            lambda: get_stream_snapshot(app_key).version != seen_version or layout_generation != seen_layout,
+                            timeout=STREAM_KEEPALIVE_SECONDS
+                        )
+
+                    if changed and layout_generation != seen_layout:
+                        seen_layout = layout_generation
+                        yield layout_event()
+                    elif changed:
+                        snapshot = get_stream_snapshot(app_key)
+                        yield stream_event(snapshot, seen_version)
+                        seen_version = snapshot.version
+                    else:
+                        # Comment line keeps idle connections (and proxies) alive
+                        yield b": keepalive\n\n"
+            finally:
+                metrics.inc('nowplaying_stream_clients', -1)
+
+        return Response(
+            stream_with_context(generate()),
+            mimetype='text/event-stream',
+            headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+        )
+
+    @app.route('/history')
+    @app.route('/history/recent')
+    def history():
+        #print("DEBUG: history")
+        """
+        Finished plays, newest first. /history filters by ?from=&to= (epoch seconds or ISO 8601)
+        and ?app=, /history/recent returns the last plays from memory.
+        """
+        parts = [part for part in request.path.split("/") if part]
+        status, body = get_history_body(parts, request.args)
+        return Response(body, status=status, mimetype='application/json')
+
+    @app.route('/sessions')
+    def sessions():
+        #print("DEBUG: sessions")
+        """
+        Media info of all sessions by normalized app id.
+        """
+        response = Response(sessions_json, mimetype='application/json')
+        response.headers['X-Server-Time'] = repr(time.monotonic())
+        return response
+
+    @app.route('/cover/<cover_hash>')
+    @app.route('/cover/<cover_hash>/<variant>')
+    def cover(cover_hash, variant='widget'):
+        #print("DEBUG: cover")
+        """
+        Serve the widget sized cover (or the 'original') by content hash. The content never changes
+        for a hash, so it is cached forever.
+        """
+        cover_data = get_cover_variant(cover_hash, variant)
+        if cover_data is None:
+            abort(404)
+
+        data, mimetype = cover_data
+        response = Response(data, mimetype=mimetype)
+        response.set_etag(f"{cover_hash}-{variant}")
+        response.headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+        return response.make_conditional(request)
+
+    @app.route('/ingest', methods=['POST'])
+    @app.route('/ingest/cover/<cover_hash>', methods=['PUT'])
+    def ingest(cover_hash=None):
+        #print("DEBUG: ingest")
+        """
+        Media sessions and covers pushed by other instances, when running as hub.
+        """
+        parts = ['ingest', 'cover', cover_hash] if cover_hash else ['ingest']
+        status, text = handle_ingest(request.method, parts, request.get_data(), request.headers.get('X-Ingest-Signature'))
+        return Response(text, status=status, mimetype='text/plain')
+
+    @app.route('/metrics')
+    def metrics_endpoint():
+        #print("DEBUG: metrics")
+        """
+        Poll loop, media API, cover and HTTP metrics in the Prometheus text format.
+        """
+        return Response(get_metrics_body(), content_type=METRICS_CONTENT_TYPE)
+
+    @app.route('/reload')
+    def reload():
+        #print("DEBUG: reload")
+        """Force a page reload to reflect layout changes."""
+        notify_layout_change()
+        return redirect(url_for('index'))
+
+    return app
+
+
+# ---------------------------------------------------------------------------
+# Async HTTP server
+#
+# Serves the same routes as the Flask app from the poller's event loop: no thread per
+# request, HTTP/1.1 keep-alive and /media/stream clients are just waiting coroutines.
+# ---------------------------------------------------------------------------
+
+HTTP_KEEPALIVE_SECONDS = 75  # idle time before a keep-alive connection is closed
+HTTP_HEADER_TIMEOUT = 10  # seconds a client may take to send the headers after the request line
+HTTP_MAX_HEADERS = 100
+HTTP_MAX_HEADER_BYTES = 16 * 1024  # all header lines together
+HTTP_REASONS = {
+    200: "OK", 302: "Found", 304: "Not Modified", 400: "Bad Request", 403: "Forbidden", 404: "Not Found",
+    405: "Method Not Allowed", 408: "Request Timeout", 409: "Conflict", 413: "Payload Too Large",
+    431: "Request Header Fields Too Large", 500: "Internal Server Error"
 }
 
-last_update_time = 0
-last_position = 0
-last_song_id = ""
-last_known_position = 0
+async_stream_loop = None
+async_stream_event = None  # set and replaced on every media change, awaited by async /media/stream clients
 
-# Store current layout
-template_name = 'horizontal'
 
+def wake_async_streams():
+    #print("DEBUG: wake_async_streams")
+    """
+    Wake up all async /media/stream clients. Safe to call from any thread.
+    """
+    def wake():
+        global async_stream_event
+        event, async_stream_event = async_stream_event, asyncio.Event()
+        event.set()
 
-locked_app_id = None  # Global lock state
+    if async_stream_loop is not None and not async_stream_loop.is_closed():
+        async_stream_loop.call_soon_threadsafe(wake)
 
 
-def get_local_ip():
-    #print("DEBUG: get_local_ip")
-    try:
-        hostname = socket.gethostname()
-        local_ip = socket.gethostbyname(hostname)
-        return local_ip
-    except Exception as e:
-        print(f"Error getting local IP: {e}")
-        return "127.0.0.1"
+def parse_etags(header):
+    """
+    Parse an If-None-Match header into a set of opaque tags ('*' included as is).
+    """
+    tags = set()
+    for tag in header.split(","):
+        tag = tag.strip()
+        if tag.startswith("W/"):
+            tag = tag[2:]
+        if tag:
+            tags.add(tag.strip('"'))
+    return tags
 
 
-def set_layout(layout):
-    global template_name
-    #print("DEBUG: set_layout")
-    template_name = layout
+class AsyncRequestEtags:
+    """
+    The subset of Flask's ETags used by the route helpers, built from an If-None-Match header.
+    """
+    def __init__(self, header):
+        self.tags = parse_etags(header)
 
-async def get_media_info():
-    global last_update_time, last_position, last_song_id, last_known_position, cached_cover, cached_song_id, locked_app_id
-    #print("DEBUG: get_media_info")
+    def __contains__(self, etag):
+        return "*" in self.tags or etag in self.tags
+
+
+async def async_media_stream(app_key):
+    #print("DEBUG: async_media_stream")
+    """
+    Async version of the /media/stream generator, waits for changes on the event loop.
+    """
+    snapshot = get_stream_snapshot(app_key)
+    # Ask the browser to reconnect quickly if the connection drops
+    yield f"retry: {STREAM_RETRY_MS}\n".encode('ascii') + stream_event(snapshot)
+    seen_version = snapshot.version
+    seen_layout = layout_generation
+
+    metrics.inc('nowplaying_stream_clients')
     try:
-        session_manager = await MediaManager.request_async()
-        current_session = session_manager.get_current_session()
+        while True:
+            if get_stream_snapshot(app_key).version == seen_version and layout_generation == seen_layout:
+                try:
+                    await asyncio.wait_for(async_stream_event.wait(), STREAM_KEEPALIVE_SECONDS)
+                except asyncio.TimeoutError:
+                    pass
 
-        if not current_session:
-            return None
+            snapshot = get_stream_snapshot(app_key)
+            if layout_generation != seen_layout:
+                seen_layout = layout_generation
+                yield layout_event()
+            elif snapshot.version != seen_version:
+                yield stream_event(snapshot, seen_version)
+                seen_version = snapshot.version
+            else:
+                # Comment line keeps idle connections (and proxies) alive
+                yield b": keepalive\n\n"
+    finally:
+        metrics.inc('nowplaying_stream_clients', -1)
 
-        info = await current_session.try_get_media_properties_async()
-        playback_info = current_session.get_playback_info()
-        timeline = current_session.get_timeline_properties()
-        app_id = current_session.source_app_user_model_id
 
-        current_song_id = f"{info.title}-{info.artist}"
-        playback_status = playback_info.playback_status
+async def async_history_response(parts, args):
+    #print("DEBUG: async_history_response")
+    """
+    /history response. Flushing pending plays and the SQLite query block, so they run in an executor
+    and not on the event loop the poller and all clients share.
+    """
+    status, history_body = await asyncio.get_running_loop().run_in_executor(None, get_history_body, parts, args)
+    return status, {'Content-Type': 'application/json'}, history_body
 
-        current_time = time.time()
-        current_timeline_position = int(timeline.position.total_seconds())
 
-        if (
-            current_song_id != last_song_id or
-            abs(current_timeline_position - last_known_position) > 1
-        ):
-            last_position = current_timeline_position
-            last_update_time = current_time
-            last_song_id = current_song_id
+def async_route(method, path, args, headers, body=b""):
+    #print("DEBUG: async_route")
+    """
+    Route a request to (status, headers, body). The body is bytes, or an async generator of bytes for streams.
+    Routes doing blocking work return a coroutine resulting in (status, headers, body) instead.
+    """
+    parts = [part for part in path.split("/") if part]
+    if parts[:1] == ['ingest']:
+        status, text = handle_ingest(method, parts, body, headers.get('x-ingest-signature'))
+        return status, {'Content-Type': 'text/plain'}, text.encode('utf-8')
 
-        if playback_status == 4:  # Playing
-            elapsed_time = current_time - last_update_time
-            position = last_position + elapsed_time
-        else:
-            position = current_timeline_position
+    if method not in ("GET", "HEAD"):
+        return 405, {'Allow': 'GET, HEAD'}, b""
 
-        last_update_time = current_time
-        last_position = position
-        last_known_position = current_timeline_position
+    etags = AsyncRequestEtags(headers.get('if-none-match', ''))
 
-        duration = timeline.end_time.total_seconds()
-        
-        
-        
-        
-        
-        
-        # only extract cover if the app id matches in case we have locked the app id
-        if locked_app_id:
-            session_app_id = app_id
-            if session_app_id and "!" in session_app_id:
-                session_app_id = session_app_id.split("!")[1]
-            if session_app_id == locked_app_id:
-                # Only reload cover art if song changed
-                if current_song_id != cached_song_id:
-                    cached_cover = await extract_cover(info.thumbnail) if info.thumbnail else ""
-                    cached_song_id = current_song_id
-        else:
-            # no app id locked, so we can normally update the cover in case if the song changed.
-            # Only reload cover art if song changed
-            if current_song_id != cached_song_id:
-                cached_cover = await extract_cover(info.thumbnail) if info.thumbnail else ""
-                cached_song_id = current_song_id
-        
-        return {
-            'title': info.title,
-            'artist': info.artist,
-            'position': position,
-            'duration': duration,
-            'cover': cached_cover,
-            'app_id': app_id,
-            'status': STATUS_MAP.get(playback_status, "Unknown")
+    if not parts:
+        entry = get_rendered_layout(*resolve_layout(args.get('layout'), args.get('theme')))
+        response_headers = {'ETag': f'"{entry["etag"]}"', 'Vary': 'Accept-Encoding', 'Cache-Control': 'no-cache'}
+        if entry['etag'] in etags:
+            return 304, response_headers, b""
+        body, encoding = get_layout_body(entry, headers.get('accept-encoding', ''))
+        response_headers['Content-Type'] = 'text/html; charset=utf-8'
+        if encoding:
+            response_headers['Content-Encoding'] = encoding
+        return 200, response_headers, body
+
+    if parts == ['media']:
+        try:
+            since = int(args['since']) if 'since' in args else None
+        except ValueError:
+            since = None
+        accept_gzip = 'gzip' in headers.get('accept-encoding', '')
+        version, body, encoding = get_media_body(since, args.get('app'), etags, accept_gzip)
+        response_headers = {
+            'ETag': f'"{version}"',
+            'Cache-Control': 'no-cache',
+            'Vary': 'Accept-Encoding',
+            'X-Server-Time': repr(time.monotonic())
         }
-    except Exception as e:
-        print(f"Error in get_media_info: {e}")
-        return None
+        if body is None:
+            return 304, response_headers, b""
+        response_headers['Content-Type'] = 'application/json'
+        if encoding:
+            response_headers['Content-Encoding'] = encoding
+        return 200, response_headers, body
 
-async def extract_cover(thumbnail):
-    #print("DEBUG: extract_cover")
-    try:
-        stream = await thumbnail.open_read_async()
-        reader = DataReader(stream)
+    if parts == ['media', 'stream']:
+        return 200, {
+            'Content-Type': 'text/event-stream',
+            'Cache-Control': 'no-cache',
+            'X-Accel-Buffering': 'no'
+        }, async_media_stream(args.get('app'))
 
-        await reader.load_async(stream.size)
+    if parts in (['history'], ['history', 'recent']):
+        return async_history_response(parts, args)
 
-        data = bytes(reader.read_buffer(stream.size))
+    if parts == ['sessions']:
+        return 200, {'Content-Type': 'application/json', 'X-Server-Time': repr(time.monotonic())}, sessions_json
 
-        return f"data:image/png;base64,{base64.b64encode(data).decode('utf-8')}"
-    except Exception as e:
-        print(f"Error extracting cover: {e}")
-        return ""
+    if parts[0] == 'cover' and len(parts) in (2, 3):
+        variant = parts[2] if len(parts) == 3 else 'widget'
+        cover_data = get_cover_variant(parts[1], variant)
+        if cover_data is None:
+            return 404, {'Content-Type': 'text/plain'}, b"Not Found"
+        data, mimetype = cover_data
+        etag = f"{parts[1]}-{variant}"
+        response_headers = {'ETag': f'"{etag}"', 'Cache-Control': 'public, max-age=31536000, immutable'}
+        if etag in etags:
+            return 304, response_headers, b""
+        response_headers['Content-Type'] = mimetype
+        return 200, response_headers, data
 
-async def update_media_info():
-    global media_info, locked_app_id
-    #print("DEBUG: update_media_info")
+    if parts == ['metrics']:
+        return 200, {'Content-Type': METRICS_CONTENT_TYPE}, get_metrics_body()
+
+    if parts == ['reload']:
+        # Force a page reload to reflect layout changes
+        notify_layout_change()
+        return 302, {'Location': '/'}, b""
+
+    return 404, {'Content-Type': 'text/plain'}, b"Not Found"
+
+
+HTTP_ROUTES = ('/', '/media', '/media/stream', '/sessions', '/history', '/history/recent', '/metrics', '/reload', '/ingest')
+
+
+def metrics_route(path):
+    """
+    The route pattern of a path as Flask names it, so both servers report the same routes.
+    """
+    parts = [part for part in path.split("/") if part]
+    if parts[:1] == ['cover'] and len(parts) in (2, 3):
+        return '/cover/<cover_hash>/<variant>' if len(parts) == 3 else '/cover/<cover_hash>'
+    if parts[:2] == ['ingest', 'cover'] and len(parts) == 3:
+        return '/ingest/cover/<cover_hash>'
+    path = "/" + "/".join(parts)
+    return path if path in HTTP_ROUTES else 'other'
+
+
+def http_head(status, headers):
+    lines = [f"HTTP/1.1 {status} {HTTP_REASONS.get(status, '')}"]
+    lines += [f"{name}: {value}" for name, value in headers.items()]
+    return ("\r\n".join(lines) + "\r\n\r\n").encode('latin-1')
+
+
+async def read_http_headers(reader):
+    #print("DEBUG: read_http_headers")
+    """
+    Read the header lines of a request into a dict with lowercase names. Returns None when the
+    client sends more than HTTP_MAX_HEADERS lines or HTTP_MAX_HEADER_BYTES.
+    """
+    headers = {}
+    count = size = 0
     while True:
-        #print("DEBUG: update_media_info while")
-        try:
-            new_info = await get_media_info()
-
-            if locked_app_id:
-                session_app_id = new_info.get('app_id') if new_info else None
-                if session_app_id and "!" in session_app_id:
-                    session_app_id = session_app_id.split("!")[1]
-                if session_app_id != locked_app_id:
-                    await asyncio.sleep(1)
-                    continue
+        line = await reader.readline()
+        if line in (b"\r\n", b"\n", b""):
+            return headers
+        count += 1
+        size += len(line)
+        if count > HTTP_MAX_HEADERS or size > HTTP_MAX_HEADER_BYTES:
+            return None
+        name, _, value = line.decode('latin-1').partition(":")
+        headers[name.strip().lower()] = value.strip()
 
-            if new_info:
-                if is_significant_change(new_info, media_info):
-                    media_info.update(new_info)
-            else:
-                # Reset to default when no session is active
-                media_info = {
-                    'title': 'Unknown',
-                    'artist': 'Unknown',
-                    'position': 0,
-                    'duration': 0,
-                    'cover': '',
-                    'app_id': 'Unknown',
-                    'status': 'Stopped'
-                }
-        except Exception as e:
-            print(f"Error updating media info: {e}")
-        await asyncio.sleep(1)
+
+async def handle_http_connection(reader, writer):
+    #print("DEBUG: handle_http_connection")
+    """
+    Serve HTTP/1.1 requests of one connection until the client closes it or it idles out.
+    """
+    try:
+        while True:
+            request_line = await asyncio.wait_for(reader.readline(), HTTP_KEEPALIVE_SECONDS)
+            if not request_line:
+                break
+            method, target, version = request_line.decode('latin-1').split()
+
+            # One deadline and a size cap for all headers, so a client cannot hold the connection or grow memory
+            try:
+                headers = await asyncio.wait_for(read_http_headers(reader), HTTP_HEADER_TIMEOUT)
+                error_status = 431 if headers is None else None
+            except asyncio.TimeoutError:
+                error_status = 408
+            if error_status is not None:
+                writer.write(http_head(error_status, {'Content-Length': '0', 'Connection': 'close'}))
+                await writer.drain()
+                break
+
+            content_length = int(headers.get('content-length') or 0)
+            if content_length > INGEST_MAX_BODY_BYTES:
+                writer.write(http_head(413, {'Content-Length': '0', 'Connection': 'close'}))
+                await writer.drain()
+                break
+            request_body = await reader.readexactly(content_length) if content_length else b""
+
+            connection = headers.get('connection', '').lower()
+            keep_alive = connection != 'close' if version == "HTTP/1.1" else connection == 'keep-alive'
+
+            url = urllib.parse.urlsplit(target)
+            args = dict(urllib.parse.parse_qsl(url.query))
+            request_start = time.perf_counter()
+            try:
+                response = async_route(method, url.path, args, headers, request_body)
+                if asyncio.iscoroutine(response):
+                    response = await response
+                status, response_headers, body = response
+            except Exception as e:
+                print(f"Error handling {method} {url.path}: {e}")
+                status, response_headers, body = 500, {'Content-Type': 'text/plain'}, b"Internal Server Error"
+
+            if isinstance(body, (bytes, bytearray)):
+                response_headers['Content-Length'] = str(len(body))
+                response_headers['Connection'] = 'keep-alive' if keep_alive else 'close'
+                writer.write(http_head(status, response_headers))
+                if method != "HEAD":
+                    writer.write(body)
+                await writer.drain()
+                record_http_request(metrics_route(url.path), status, time.perf_counter() - request_start, len(body))
+                if not keep_alive:
+                    break
+                continue
+
+            # Streaming response, chunked until the client goes away
+            response_headers['Transfer-Encoding'] = 'chunked'
+            writer.write(http_head(status, response_headers))
+            await writer.drain()
+            record_http_request(metrics_route(url.path), status, time.perf_counter() - request_start)
+            if method == "HEAD":
+                break
+            try:
+                async for data in body:
+                    writer.write(f"{len(data):x}\r\n".encode('latin-1') + data + b"\r\n")
+                    await writer.drain()
+            finally:
+                await body.aclose()
+            break
+    except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError, ValueError):
+        pass
+    finally:
+        writer.close()
 
 
-@app.route('/')
-def index():
-    #print("DEBUG: /")
-    return render_template(f'{template_name}.html', media=media_info)
+async def run_async_server(host, port):
+    global async_stream_loop, async_stream_event
+    #print("DEBUG: run_async_server")
+    async_stream_loop = asyncio.get_running_loop()
+    async_stream_event = asyncio.Event()
 
-@app.route('/media')
-def media():
-    #print("DEBUG: media")
-    return jsonify(media_info)
+    server = await asyncio.start_server(handle_http_connection, host, port, backlog=128)
+    print(f"Serving on http://{host}:{port} (async server)")
+    async with server:
+        await server.serve_forever()
 
-@app.route('/reload')
-def reload():
-    #print("DEBUG: reload")
-    """Force a page reload to reflect layout changes."""
-    return redirect(url_for('index'))
 
-def start_async_loop():
+def start_async_loop(http_host=None, http_port=None):
+    """
+    Run the media poller, and the async HTTP server when `http_port` is given, on a new event loop.
+    """
+    global media_source
     #print("DEBUG: start_async_loop")
+    if media_source is None:
+        media_source = create_media_source("events")  # main creates it from the options and settings
     loop = asyncio.new_event_loop()
     asyncio.set_event_loop(loop)
-    loop.run_until_complete(update_media_info())
+
+    async def main():
+        tasks = [watch_media_poller()]
+        if http_port:
+            tasks.append(run_async_server(http_host, http_port))
+        await asyncio.gather(*tasks)
+
+    loop.run_until_complete(main())
 
 def create_gui():
     global locked_app_id
     #print("DEBUG: create_gui")
+    import tkinter as tk
+    from PIL import Image, ImageTk
+
     root = tk.Tk()
     root.title("Now Playing Widget v1.0.5 © Crypto90")
     root.geometry("400x285")
@@ -336,6 +3694,9 @@ def create_gui():
 
     def shutdown():
         print("Shutting down...")
+        settings.flush()
+        if play_history is not None:
+            play_history.close()
         os._exit(0)
 
     root.protocol("WM_DELETE_WINDOW", shutdown)
@@ -362,7 +3723,6 @@ def create_gui():
         new_layout = layout_var.get()
         set_layout(new_layout)
         save_settings(locked_app=locked_app_id, layout=new_layout)  # Preserve lock
-        os.system('curl http://localhost:5000/reload')
 
 
     tk.Radiobutton(
@@ -385,8 +3745,8 @@ def create_gui():
 
     local_ip = get_local_ip()
     urls = [
-        ("http://127.0.0.1:5000", "http://127.0.0.1:5000"),
-        (f"http://{local_ip}:5000", f"http://{local_ip}:5000")
+        (f"http://127.0.0.1:{http_port}", f"http://127.0.0.1:{http_port}"),
+        (f"http://{local_ip}:{http_port}", f"http://{local_ip}:{http_port}")
     ]
 
     def open_url(url):
@@ -498,11 +3858,10 @@ def create_gui():
             save_settings(locked_app=None, layout=template_name)  # Preserve layout
             lock_button.config(text="Lock Current App", bg="darkred", fg="white", activebackground="#660000", activeforeground="white")
         else:
-            locked_app_id = media_info.get("app_id")
-            if "!" in locked_app_id:
-                locked_app_id = locked_app_id.split("!")[1]
+            locked_app_id = normalize_app_id(media_info.get("app_id"))
             save_settings(locked_app=locked_app_id, layout=template_name)  # Preserve layout
             lock_button.config(text="Unlock App", bg="darkgreen", fg="white", activebackground="#004d00", activeforeground="white")
+        update_process_label(media_info)  # Lock state is part of the process label
 
 
     
@@ -575,97 +3934,134 @@ def create_gui():
 
     
     
-    # Update UI loop
-    def update_process_label():
-        global cached_cover
+    # Update UI on media changes
+    # The poller only queues changed media info, the Tk thread drains the queue and
+    # touches only the widgets whose values changed.
+    gui_updates = queue.Queue()
+    add_media_listener(gui_updates.put)
+
+    shown = {}  # widget key -> value currently displayed
+    cover_images = {}  # PhotoImages of the current cover: 'hash', 'normal', 'paused'
+    fallback_cover = ImageTk.PhotoImage(Image.new("RGB", (64, 64), "black"))  # fallback black square
+    progress_bar = progress_canvas.create_rectangle(0, 0, 0, 10, fill="#00cc66", width=0)
+
+    def show(key, value, apply):
+        if shown.get(key) != value:
+            shown[key] = value
+            apply(value)
+
+    def get_cover_image(cover_hash, paused):
+        #print("DEBUG: get_cover_image")
+        """
+        PhotoImage of the cover, the normal and paused versions are built once per cover.
+        """
+        if cover_images.get('hash') != cover_hash:
+            cover_images.clear()
+            stored_cover = get_cover(cover_hash) if cover_hash else None
+            if stored_cover and stored_cover['gui'] is not None:
+                cover_images['normal'] = ImageTk.PhotoImage(stored_cover['gui'])
+                cover_images['paused'] = ImageTk.PhotoImage(make_paused_image(stored_cover['gui']))
+            cover_images['hash'] = cover_hash
+        return cover_images.get('paused' if paused else 'normal', fallback_cover)
+
+    def set_cover_image(cover_img):
+        cover_label.config(image=cover_img)
+        cover_label.image = cover_img  # Keep reference!
+
+    def update_progress_bar(*args):
+        position, duration = shown.get('progress', (0, 0))
+        if duration > 0 and position <= duration:
+            progress_canvas.coords(progress_bar, 0, 0, progress_canvas.winfo_width() * position / duration, 10)
+        else:
+            # Clear progress bar when no media or duration
+            progress_canvas.coords(progress_bar, 0, 0, 0, 10)
+
+    progress_canvas.bind("<Configure>", update_progress_bar)
+
+    def update_process_label(info):
         #print("DEBUG: update_process_label")
-        app_id = media_info.get("app_id", "Unknown")
-        status = media_info.get("status", "Stopped")
+        app_id = info.get("app_id", "Unknown")
+        status = info.get("status", "Stopped")
         
-        title = media_info.get("title") or "Unknown"
-        artist = media_info.get("artist") or "Unknown"
+        title = info.get("title") or "Unknown"
+        artist = info.get("artist") or "Unknown"
 
         # For position and duration, which are numbers, make sure to handle empty string or None
         try:
-            position = int(media_info.get("position", 0))
+            position = info.get("position", 0)
+            if status == "Playing":
+                # The position only changes on seeks, it is advanced locally while playing
+                position += (time.monotonic() - info.get("position_time", 0)) * info.get("playback_rate", 1.0)
+            position = int(position)
         except (TypeError, ValueError):
             position = 0
 
         try:
-            duration = int(media_info.get("duration", 0))
+            duration = int(info.get("duration", 0))
         except (TypeError, ValueError):
             duration = 0
+        position = min(position, duration) if duration > 0 else position
         
         
         # Update labels
-        song_title_label.config(text=title)
-        artist_label.config(text=artist)
-        start_time_label.config(text=format_seconds(int(position)))
-        end_time_label.config(text=format_seconds(int(duration)))
+        show('title', title, lambda text: song_title_label.config(text=text))
+        show('artist', artist, lambda text: artist_label.config(text=text))
+        show('position', format_seconds(position), lambda text: start_time_label.config(text=text))
+        show('duration', format_seconds(duration), lambda text: end_time_label.config(text=text))
 
         # Update progress bar
-        if duration > 0 and position <= duration:
-            percent = position / duration
-            progress_canvas.delete("all")
-            width = progress_canvas.winfo_width()
-            progress_canvas.create_rectangle(0, 0, width * percent, 10, fill="#00cc66", width=0)
-        else:
-            # Clear progress bar when no media or duration
-            progress_canvas.delete("all")
+        show('progress', (position, duration), lambda value: update_progress_bar())
 
         # Update album art
         try:
-            if cached_cover.startswith("data:image") and duration > 0:
-                img_data = base64.b64decode(cached_cover.split(",")[1])
-                img = Image.open(io.BytesIO(img_data)).resize((60, 60)).convert("RGBA")
-
-                if status == "Paused":
-                    
-
-                    overlay = Image.new("RGBA", img.size, (0, 0, 0, 0))
-                    draw = ImageDraw.Draw(overlay)
-
-                    # Dimensions for pause bars
-                    bar_width = 6
-                    spacing = 6
-                    height = 30
-                    x_center = img.width // 2
-
-                    # Left bar
-                    draw.rectangle(
-                        [x_center - spacing - bar_width, (img.height - height) // 2,
-                         x_center - spacing, (img.height + height) // 2],
-                        fill=(255, 255, 255, 180)
-                    )
-                    # Right bar
-                    draw.rectangle(
-                        [x_center + spacing, (img.height - height) // 2,
-                         x_center + spacing + bar_width, (img.height + height) // 2],
-                        fill=(255, 255, 255, 180)
-                    )
-
-                    img = Image.alpha_composite(img, overlay)
-            else:
-                img = Image.new("RGB", (64, 64), "black")  # fallback black square
-            
-            cover_img = ImageTk.PhotoImage(img)
-            cover_label.config(image=cover_img)
-            cover_label.image = cover_img  # Keep reference!
+            cover_hash = cover_hash_from_url(info.get("cover")) if duration > 0 else ""
+            show('cover', get_cover_image(cover_hash, status == "Paused"), set_cover_image)
         except Exception as e:
             print(f"Error updating cover: {e}")
 
         # App ID status
-        if "!" in app_id:
-            app_id = app_id.split("!")[1]
+        app_id = normalize_app_id(app_id)
         if locked_app_id and app_id != locked_app_id:
-            current_process_label.config(text=f"Locked ({locked_app_id})")
+            process_text = f"Locked ({locked_app_id})"
         else:
-            current_process_label.config(text=f"{app_id} ({status})")
+            process_text = f"{app_id} ({status})"
+        show('process', process_text, lambda text: current_process_label.config(text=text))
 
-        root.after(1000, update_process_label)
+    current = {'info': media_info}
 
+    # Settings edited in the settings file, applied on the Tk thread
+    settings_changed = threading.Event()
+    settings.add_listener(lambda values: settings_changed.set())
 
-    update_process_label()
+    def sync_settings():
+        #print("DEBUG: sync_settings")
+        layout_var.set(template_name)
+        if locked_app_id:
+            lock_button.config(text="Unlock App", bg="darkgreen", fg="white", activebackground="#004d00", activeforeground="white")
+        else:
+            lock_button.config(text="Lock Current App", bg="darkred", fg="white", activebackground="#660000", activeforeground="white")
+        update_process_label(current['info'])
+
+    def drain_media_updates():
+        # Only the newest queued media info matters
+        info = None
+        try:
+            while True:
+                info = gui_updates.get_nowait()
+        except queue.Empty:
+            pass
+        if info is not None:
+            current['info'] = info
+        if info is not None or current['info'].get("status") == "Playing":
+            # While playing the time label and progress bar tick locally
+            update_process_label(current['info'])
+        if settings_changed.is_set():
+            settings_changed.clear()
+            sync_settings()
+        root.after(GUI_QUEUE_POLL_MS, drain_media_updates)
+
+    update_process_label(media_info)
+    drain_media_updates()
     
     
     
@@ -678,12 +4074,125 @@ def create_gui():
     
     root.mainloop()
 
-settings = load_settings()
-locked_app_id = settings.get("locked_app")
-template_name = settings.get("layout", "horizontal")  # fallback default
+def apply_settings(values):
+    """
+    Apply settings edited in the settings file while running.
+    """
+    global locked_app_id
+    #print("DEBUG: apply_settings")
+    locked_app_id = values.get("locked_app")
+    if values.get("layout", "horizontal") != template_name:
+        set_layout(values.get("layout", "horizontal"))
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Now Playing widget for OBS, served from the Windows media API.")
+    parser.add_argument("--headless", action="store_true",
+                        help="no control window and no cover resizing, for machines nobody looks at")
+    parser.add_argument("--settings-file", metavar="FILE", help=f"settings file to use (default: {SETTINGS_FILE})")
+    parser.add_argument("--host", default="0.0.0.0", help="address to serve on (default: %(default)s)")
+    parser.add_argument("--port", type=int, default=5000, help="port to serve on (default: %(default)s)")
+    parser.add_argument("--poll-interval", type=float,
+                        help=f"seconds between media updates while playing (default: {POLL_INTERVAL})")
+    parser.add_argument("--poll-min-interval", type=float,
+                        help=f"fastest polling, after changes and at the end of a track (default: {POLL_MIN_INTERVAL})")
+    parser.add_argument("--poll-max-interval", type=float,
+                        help=f"slowest polling, while nothing plays (default: {POLL_MAX_INTERVAL})")
+    parser.add_argument("--layout", choices=("horizontal", "vertical"), help="widget layout, not saved")
+    parser.add_argument("--lock", metavar="APP_ID", help="show this app only, not saved")
+    parser.add_argument("--server", choices=("flask", "async"),
+                        help="HTTP server (default: from settings, async when headless)")
+    parser.add_argument("--media-source", choices=sorted(MEDIA_SOURCES), help="default: from settings, events")
+    parser.add_argument("--replay-trace", metavar="FILE", help="trace played back by the replay media source")
+    parser.add_argument("--replay-speed", type=float, help="replay speed factor")
+    parser.add_argument("--record-trace", metavar="FILE", help="record all media sessions to this trace file")
+    parser.add_argument("--history-file", metavar="FILE", help=f"play history database (default: {HISTORY_FILE})")
+    parser.add_argument("--no-history", action="store_true", help="do not record the play history")
+    parser.add_argument("--music-folder", metavar="DIR", action="append",
+                        help="music folder to find covers in for players without one, can be given several times")
+    parser.add_argument("--ingest-token", metavar="TOKEN",
+                        help="shared secret other instances push with, for the ingest media source")
+    parser.add_argument("--push-to", metavar="URL", help="push all media sessions to the hub instance at this URL")
+    parser.add_argument("--push-token", metavar="TOKEN", help="shared secret of the hub")
+    parser.add_argument("--push-name", metavar="NAME", help="name of this machine on the hub (default: host name)")
+    parser.add_argument("--export-folder", metavar="DIR",
+                        help="write title, artist, cover etc. to files in this folder, for OBS Text and Image sources")
+    parser.add_argument("--export-position", metavar="SECONDS", type=float, nargs="?", const=1.0,
+                        help="also write the position file, at most every SECONDS (default: 1)")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    global settings, locked_app_id, template_name, media_source, http_port, COVER_PROCESSING, play_history, music_library
+    global file_exporter
+    global POLL_INTERVAL, POLL_MIN_INTERVAL, POLL_MAX_INTERVAL
+    #print("DEBUG: main")
+    args = parse_args(argv)
+
+    copy_templates()  # Ensure templates are copied
+    print(f"Running from: {base_dir}")
+    print(f"Looking for templates in: {template_dir}")
+
+    settings = SettingsStore(args.settings_file or SETTINGS_FILE)
+    locked_app_id = settings.get("locked_app")
+    template_name = settings.get("layout", "horizontal")  # fallback default
+    settings.add_listener(apply_settings)
+    settings.start_watching()
+    atexit.register(settings.flush)
+
+    # Command line options win over the settings file for this run, without being saved
+    if args.layout:
+        template_name = args.layout
+    if args.lock:
+        locked_app_id = args.lock
+    POLL_INTERVAL = args.poll_interval or settings.get("poll_interval", POLL_INTERVAL)
+    POLL_MIN_INTERVAL = args.poll_min_interval or settings.get("poll_min_interval", POLL_MIN_INTERVAL)
+    POLL_MAX_INTERVAL = args.poll_max_interval or settings.get("poll_max_interval", POLL_MAX_INTERVAL)
+    http_port = args.port
+    COVER_PROCESSING = not args.headless
+    server = args.server or ("async" if args.headless else settings.get("server", "flask"))
+
+    media_source = create_media_source(
+        args.media_source or settings.get("media_source", "events"),
+        trace=args.replay_trace or settings.get("replay_trace"),
+        speed=args.replay_speed or settings.get("replay_speed", 1.0),
+        record=args.record_trace or settings.get("record_trace"),
+        ingest_token=args.ingest_token or settings.get("ingest_token"),
+        push_to=args.push_to or settings.get("push_to"),
+        push_token=args.push_token or settings.get("push_token"),
+        push_name=args.push_name or settings.get("push_name")
+    )
+
+    if not args.no_history and settings.get("history", True):
+        play_history = PlayHistory(args.history_file or settings.get("history_file", HISTORY_FILE))
+        atexit.register(play_history.close)
+
+    music_folders = args.music_folder or settings.get("music_folders") or []
+    if music_folders:
+        music_library = MusicLibrary(settings.get("library_file", LIBRARY_FILE), music_folders)
+        music_library.start()
+
+    export_folder = args.export_folder or settings.get("export_folder")
+    if export_folder:
+        file_exporter = FileExporter(
+            export_folder,
+            files=settings.get("export_files"),
+            position_interval=args.export_position or settings.get("export_position_interval")
+        )
+        file_exporter.start()
+        file_exporter.update(media_info)
+        add_media_listener(file_exporter.update)
+
+    if not args.headless:
+        threading.Thread(target=create_gui, daemon=True).start()
+    threading.Thread(target=probe_first_media_response, args=(args.host, args.port), daemon=True).start()
+    if server == "async":
+        # Poller and HTTP server share one event loop
+        start_async_loop(http_host=args.host, http_port=args.port)
+    else:
+        threading.Thread(target=start_async_loop, daemon=True).start()
+        create_flask_app().run(host=args.host, port=args.port, threaded=True)
 
 
 if __name__ == '__main__':
-    threading.Thread(target=start_async_loop, daemon=True).start()
-    threading.Thread(target=create_gui, daemon=True).start()
-    app.run(host='0.0.0.0', port=5000)
+    main()
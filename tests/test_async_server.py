@@ -0,0 +1,53 @@
+"""
+Request handling limits of the async HTTP server.
+
+python -m unittest discover tests
+"""
+import asyncio
+import unittest
+from unittest import mock
+
+import obs_now_playing_widget_windows_media_api as widget
+
+
+class AsyncServerTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.server = await asyncio.start_server(widget.handle_http_connection, '127.0.0.1', 0)
+        self.port = self.server.sockets[0].getsockname()[1]
+
+    async def asyncTearDown(self):
+        self.server.close()
+        await self.server.wait_closed()
+
+    async def request(self, data):
+        reader, writer = await asyncio.open_connection('127.0.0.1', self.port)
+        try:
+            writer.write(data)
+            await writer.drain()
+            return await asyncio.wait_for(reader.read(), 5)
+        finally:
+            writer.close()
+
+    async def test_metrics(self):
+        response = await self.request(b"GET /metrics HTTP/1.1\r\nHost: x\r\nConnection: close\r\n\r\n")
+        self.assertTrue(response.startswith(b"HTTP/1.1 200 "))
+
+    async def test_too_many_headers(self):
+        headers = b"".join(b"X-Header-%d: value\r\n" % i for i in range(widget.HTTP_MAX_HEADERS + 1))
+        response = await self.request(b"GET /metrics HTTP/1.1\r\n" + headers + b"\r\n")
+        self.assertTrue(response.startswith(b"HTTP/1.1 431 "))
+
+    async def test_too_large_headers(self):
+        header = b"Cookie: " + b"x" * widget.HTTP_MAX_HEADER_BYTES + b"\r\n"
+        response = await self.request(b"GET /metrics HTTP/1.1\r\n" + header + b"\r\n")
+        self.assertTrue(response.startswith(b"HTTP/1.1 431 "))
+
+    async def test_headers_too_slow(self):
+        with mock.patch.object(widget, 'HTTP_HEADER_TIMEOUT', 0.1):
+            # The blank line ending the headers never comes
+            response = await self.request(b"GET /metrics HTTP/1.1\r\nHost: x\r\n")
+        self.assertTrue(response.startswith(b"HTTP/1.1 408 "))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,68 @@
+"""
+The event driven fake media source and the poller it wakes up.
+
+python -m unittest discover tests
+"""
+import asyncio
+import time
+import unittest
+from unittest import mock
+
+import obs_now_playing_widget_windows_media_api as widget
+
+
+class FakeMediaSourceTest(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.source = widget.FakeMediaSource()
+        widget.media_source = self.source
+        widget.app_states.clear()
+        widget.session_breakers.clear()
+        widget.last_good_media = ({}, None)
+        widget.source_breaker = widget.CircuitBreaker("Media source", 'source')
+        widget.apply_media_update(widget.DEFAULT_MEDIA_INFO)
+
+    async def test_wait_for_change_times_out_without_changes(self):
+        start = time.monotonic()
+        self.assertFalse(await self.source.wait_for_change(0.1))
+        self.assertGreaterEqual(time.monotonic() - start, 0.09)
+
+    async def test_set_session_wakes_wait_for_change(self):
+        waiter = asyncio.ensure_future(self.source.wait_for_change(10))
+        await asyncio.sleep(0.05)  # the source binds to the loop on its first wait
+        start = time.monotonic()
+        self.source.set_session(title='Title')
+        self.assertTrue(await waiter)
+        self.assertLess(time.monotonic() - start, 1)
+
+    async def test_query_count_counts_get_sessions(self):
+        self.source.set_session(title='Title', artist='Artist')
+        sessions, current_app_id = await self.source.get_sessions()
+        await self.source.get_sessions()
+        self.assertEqual(self.source.query_count, 2)
+        self.assertEqual(current_app_id, widget.FakeMediaSource.DEFAULT_APP_ID)
+        self.assertEqual([session['title'] for session in sessions], ['Title'])
+
+    async def test_poller_picks_up_changes_without_polling(self):
+        # Polling alone would not see the change within the test
+        with mock.patch.multiple(widget, POLL_INTERVAL=30, POLL_MIN_INTERVAL=30, POLL_MAX_INTERVAL=30):
+            self.source.set_session(title='First', artist='Artist', playback_status=4, duration=300)
+            poller = asyncio.ensure_future(widget.update_media_info())
+            try:
+                await self.wait_for_title('First')
+                queries = self.source.query_count
+
+                self.source.set_session(title='Second', artist='Artist')
+                await self.wait_for_title('Second')
+                self.assertEqual(self.source.query_count, queries + 1)
+            finally:
+                poller.cancel()
+
+    async def wait_for_title(self, title, timeout=2):
+        deadline = time.monotonic() + timeout
+        while widget.media_info['title'] != title:
+            self.assertLess(time.monotonic(), deadline, f"{title} not picked up")
+            await asyncio.sleep(0.01)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,68 @@
+"""
+Text file export for OBS Text sources.
+
+python -m unittest discover tests
+"""
+import os
+import shutil
+import tempfile
+import time
+import unittest
+from unittest import mock
+
+import obs_now_playing_widget_windows_media_api as widget
+
+
+class FileExporterTest(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp(prefix="nowplaying_test_")
+        self.addCleanup(shutil.rmtree, self.folder, ignore_errors=True)
+        self.position_writes = []
+
+        def write_file_atomic(path, data):
+            if os.path.basename(path) == widget.EXPORT_FILES['position']:
+                self.position_writes.append(data)
+            write_file_atomic.original(path, data)
+        write_file_atomic.original = widget.write_file_atomic
+        patcher = mock.patch.multiple(widget, write_file_atomic=write_file_atomic, EXPORT_MIN_POSITION_INTERVAL=0.1)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def read(self, field):
+        with open(os.path.join(self.folder, widget.EXPORT_FILES[field]), encoding='utf-8') as f:
+            return f.read()
+
+    def wait_for(self, condition, timeout=2):
+        deadline = time.monotonic() + timeout
+        while not condition():
+            self.assertLess(time.monotonic(), deadline, "export not written")
+            time.sleep(0.01)
+
+    def test_position_is_written_on_its_interval_only(self):
+        exporter = widget.FileExporter(self.folder, files={'cover': None}, position_interval=0.2)
+        exporter.start()
+        info = {'title': 'Title', 'artist': 'Artist', 'status': "Playing", 'duration': 300, 'position': 0}
+
+        # A player that reports a new position 100 times a second
+        start = time.monotonic()
+        for position in range(60):
+            exporter.update(dict(info, position=position, position_time=time.monotonic()))
+            time.sleep(0.01)
+        elapsed = time.monotonic() - start
+        self.wait_for(lambda: self.position_writes)
+        self.assertLessEqual(len(self.position_writes), elapsed / 0.2 + 1)
+        self.assertEqual(self.read('title'), 'Title')
+
+        # Not playing: the position file is emptied on the next tick and then left alone
+        exporter.update(dict(info, status="Paused"))
+        self.wait_for(lambda: self.read('position') == '')
+        self.assertEqual(self.read('title'), '')
+
+    def test_empty_cover_matches_the_file_extension(self):
+        self.assertTrue(widget.export_cover_data('', 'cover.png').startswith(b'\x89PNG'))
+        self.assertTrue(widget.export_cover_data('', 'cover.jpg').startswith(b'\xff\xd8'))
+        self.assertTrue(widget.export_cover_data('', 'cover.JPEG').startswith(b'\xff\xd8'))
+
+
+if __name__ == '__main__':
+    unittest.main()
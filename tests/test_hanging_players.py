@@ -0,0 +1,196 @@
+"""
+Deadlines, circuit breakers and the poller watchdog, with a fake media source that hangs.
+
+python -m unittest discover tests
+"""
+import asyncio
+import json
+import os
+import shutil
+import tempfile
+import time
+import unittest
+from unittest import mock
+
+import obs_now_playing_widget_windows_media_api as widget
+
+
+def metric_value(name, **labels):
+    return widget.metrics._values.get((name, tuple(sorted(labels.items()))), 0)
+
+
+class CircuitBreakerTest(unittest.TestCase):
+    def test_opens_after_threshold_failures(self):
+        breaker = widget.CircuitBreaker("Test", 'source', threshold=3)
+        opens = metric_value('nowplaying_circuit_breaker_opens_total', scope='source')
+        breaker.record_failure(now=0)
+        breaker.record_failure(now=0)
+        self.assertTrue(breaker.allow(now=0))
+        breaker.record_failure(now=0)
+        self.assertFalse(breaker.allow(now=0))
+        self.assertTrue(breaker.allow(now=widget.BREAKER_COOLDOWN))
+        self.assertEqual(metric_value('nowplaying_circuit_breaker_opens_total', scope='source'), opens + 1)
+
+    def test_cooldown_doubles_up_to_the_maximum(self):
+        breaker = widget.CircuitBreaker("Test", 'session', threshold=1)
+        now = 0
+        cooldowns = []
+        for _ in range(8):
+            breaker.record_failure(now=now)
+            cooldowns.append(breaker.open_until - now)
+            now = breaker.open_until
+        self.assertEqual(cooldowns[:3], [widget.BREAKER_COOLDOWN, widget.BREAKER_COOLDOWN * 2, widget.BREAKER_COOLDOWN * 4])
+        self.assertEqual(cooldowns[-1], widget.BREAKER_MAX_COOLDOWN)
+
+    def test_success_closes(self):
+        breaker = widget.CircuitBreaker("Test", 'cover', threshold=1)
+        breaker.record_failure(now=0)
+        breaker.record_failure(now=widget.BREAKER_COOLDOWN)
+        breaker.record_success()
+        self.assertTrue(breaker.allow(now=0))
+        self.assertEqual(breaker.cooldown, widget.BREAKER_COOLDOWN)
+        breaker.record_failure(now=0)
+        self.assertEqual(breaker.open_until, widget.BREAKER_COOLDOWN)
+
+
+class HangingPlayerTest(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.source = widget.FakeMediaSource()
+        widget.media_source = self.source
+        widget.app_states.clear()
+        widget.session_breakers.clear()
+        widget.last_good_media = ({}, None)
+        widget.apply_media_update(widget.DEFAULT_MEDIA_INFO)
+
+        # Short deadlines and cooldowns, so a hang costs fractions of a second
+        patcher = mock.patch.multiple(widget, MEDIA_SOURCE_TIMEOUT=0.1, THUMBNAIL_TIMEOUT=0.1,
+                                      COVER_WAIT_TIMEOUT=0.02, BREAKER_COOLDOWN=0.2)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        widget.source_breaker = widget.CircuitBreaker("Media source", 'source')
+
+    async def test_with_deadline_raises_timeout_and_counts_it(self):
+        timeouts = metric_value('nowplaying_media_call_timeouts_total', call='test_call')
+        with self.assertRaises(TimeoutError):
+            await widget.with_deadline('test_call', asyncio.Event().wait(), 0.05)
+        self.assertEqual(metric_value('nowplaying_media_call_timeouts_total', call='test_call'), timeouts + 1)
+        self.assertEqual(await widget.with_deadline('test_call', asyncio.sleep(0, 'done'), 1), 'done')
+
+    async def test_hung_source_serves_stale_media_until_it_recovers(self):
+        self.source.set_session(title='Title', artist='Artist')
+        infos, current_app_key = await widget.get_all_media_info()
+        self.assertFalse(infos[current_app_key]['stale'])
+
+        self.source.hanging.add('get_sessions')
+        for _ in range(widget.BREAKER_FAILURES):
+            infos, current_app_key = await widget.get_all_media_info()
+            self.assertTrue(infos[current_app_key]['stale'])
+            self.assertEqual(infos[current_app_key]['title'], 'Title')
+        self.assertFalse(widget.source_breaker.allow())
+
+        # Open: the source is not called at all
+        queries = self.source.query_count
+        infos, current_app_key = await widget.get_all_media_info()
+        self.assertEqual(self.source.query_count, queries)
+        self.assertTrue(infos[current_app_key]['stale'])
+
+        self.source.hanging.clear()
+        self.source.set_session(title='New title')
+        await asyncio.sleep(0.2)
+        infos, current_app_key = await widget.get_all_media_info()
+        self.assertFalse(infos[current_app_key]['stale'])
+        self.assertEqual(infos[current_app_key]['title'], 'New title')
+        self.assertTrue(widget.source_breaker.allow())
+
+    async def test_hung_cover_still_publishes_fresh_media(self):
+        self.source.hanging.add('read_thumbnail')
+        self.source.set_session(title='First', artist='Artist', thumbnail=b'cover')
+        infos, current_app_key = await widget.get_all_media_info()
+        self.assertEqual((infos[current_app_key]['title'], infos[current_app_key]['cover']), ('First', ''))
+
+        await asyncio.sleep(0.15)  # the cover read times out
+        infos, current_app_key = await widget.get_all_media_info()
+        state = widget.app_states[current_app_key]
+        self.assertFalse(state['cover_breaker'].allow())
+        self.assertTrue(widget.session_breakers[current_app_key].allow())
+
+        # A track change is published right away, the cover waits for the breaker
+        start = time.monotonic()
+        self.source.set_session(title='Second')
+        infos, current_app_key = await widget.get_all_media_info()
+        self.assertLess(time.monotonic() - start, 0.1)
+        self.assertEqual(infos[current_app_key]['title'], 'Second')
+        self.assertFalse(infos[current_app_key]['stale'])
+        self.assertIsNone(state['cover_task'])
+
+        # Tried again after the cooldown
+        self.source.hanging.clear()
+        await asyncio.sleep(0.2)
+        deadline = time.monotonic() + 2
+        while not infos[current_app_key]['cover']:
+            self.assertLess(time.monotonic(), deadline, "cover not loaded after the cooldown")
+            await asyncio.sleep(0.02)
+            infos, current_app_key = await widget.get_all_media_info()
+        self.assertTrue(state['cover_breaker'].allow())
+
+    async def test_hung_thumbnail_does_not_fail_the_recorder(self):
+        folder = tempfile.mkdtemp(prefix="nowplaying_test_")
+        self.addCleanup(shutil.rmtree, folder, ignore_errors=True)
+        trace = os.path.join(folder, "trace.jsonl")
+        recorder = widget.RecordingMediaSource(self.source, trace)
+        widget.media_source = recorder
+        self.addAsyncCleanup(recorder.close)
+
+        self.source.hanging.add('read_thumbnail')
+        self.source.set_session(title='Title', artist='Artist', thumbnail=b'cover')
+        start = time.monotonic()
+        infos, current_app_key = await widget.get_all_media_info()
+        self.assertLess(time.monotonic() - start, 0.1)
+        self.assertFalse(infos[current_app_key]['stale'])
+        await asyncio.sleep(0.15)  # the widget's cover read times out
+        for _ in range(widget.BREAKER_FAILURES):
+            await widget.get_all_media_info()
+        self.assertTrue(widget.source_breaker.allow())
+
+        # The cover is read again after the cooldown, and then recorded
+        self.source.hanging.clear()
+        await asyncio.sleep(0.2)
+        deadline = time.monotonic() + 2
+        while not infos[current_app_key]['cover']:
+            self.assertLess(time.monotonic(), deadline, "cover not loaded after the cooldown")
+            await asyncio.sleep(0.02)
+            infos, current_app_key = await widget.get_all_media_info()
+        await widget.get_all_media_info()
+
+        with open(trace) as f:
+            records = [json.loads(line) for line in f]
+        thumbnails = [record['thumbnail'] for record in records if 'data' in record]
+        self.assertEqual(len(thumbnails), 1)
+        recorded = [record['sessions'][0]['thumbnail'] for record in records if 'sessions' in record]
+        self.assertEqual(recorded, [None, thumbnails[0]])
+
+    async def test_watchdog_restarts_a_stalled_poller(self):
+        stalls = metric_value('nowplaying_poller_stalls_total')
+        self.source.set_session(title='Title', artist='Artist')
+        self.source.hanging.add('get_sessions')
+        # A hang without a deadline of its own, only the watchdog ends it
+        with mock.patch.multiple(widget, MEDIA_SOURCE_TIMEOUT=60, POLL_STALL_TIMEOUT=0.2, WATCHDOG_INTERVAL=0.05):
+            watchdog = asyncio.ensure_future(widget.watch_media_poller())
+            try:
+                deadline = time.monotonic() + 2
+                while metric_value('nowplaying_poller_stalls_total') == stalls:
+                    self.assertLess(time.monotonic(), deadline, "stalled poller not restarted")
+                    await asyncio.sleep(0.02)
+                self.assertNotEqual(widget.media_info['title'], 'Title')
+
+                self.source.hanging.clear()
+                deadline = time.monotonic() + 3
+                while widget.media_info['title'] != 'Title':
+                    self.assertLess(time.monotonic(), deadline, "restarted poller did not update")
+                    await asyncio.sleep(0.02)
+            finally:
+                watchdog.cancel()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,88 @@
+"""
+Scanning music folders for cover art. Needs mutagen and Pillow.
+
+python -m unittest discover tests
+"""
+import io
+import os
+import shutil
+import tempfile
+import unittest
+import wave
+from unittest import mock
+
+import obs_now_playing_widget_windows_media_api as widget
+
+try:
+    import mutagen
+    from mutagen.id3 import APIC, TALB, TIT2, TPE1
+    from mutagen.wave import WAVE
+    from PIL import Image
+except ImportError:
+    mutagen = None
+
+
+def make_image(color, image_format):
+    output = io.BytesIO()
+    Image.new('RGB', (64, 64), color).save(output, image_format)
+    return output.getvalue()
+
+
+def make_tagged_wav(path, artist, title, album, art):
+    with wave.open(path, "wb") as f:
+        f.setnchannels(1)
+        f.setsampwidth(2)
+        f.setframerate(8000)
+        f.writeframes(b"\0\0" * 800)
+    audio = WAVE(path)
+    audio.add_tags()
+    audio.tags.add(TPE1(encoding=3, text=[artist]))
+    audio.tags.add(TIT2(encoding=3, text=[title]))
+    audio.tags.add(TALB(encoding=3, text=[album]))
+    audio.tags.add(APIC(encoding=3, mime='image/png', type=3, desc='Cover', data=art))
+    audio.save()
+
+
+@unittest.skipIf(mutagen is None, "needs mutagen and Pillow")
+class MusicLibraryTest(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp(prefix="nowplaying_test_")
+        self.addCleanup(shutil.rmtree, self.folder, ignore_errors=True)
+        self.art = make_image('red', 'PNG')
+        self.tagged = os.path.join(self.folder, "tagged.wav")
+        make_tagged_wav(self.tagged, 'Artist', 'Title', 'Album', self.art)
+
+    def test_read_audio_file_opens_the_file_once(self):
+        with mock.patch.object(mutagen, 'File', wraps=mutagen.File) as open_file:
+            artist, title, album, art = widget.read_audio_file(self.tagged)
+        self.assertEqual((artist, title, album, art), ('Artist', 'Title', 'Album', self.art))
+        self.assertEqual(open_file.call_count, 1)
+
+    def test_scan_resizes_covers_without_the_database_lock(self):
+        album_dir = os.path.join(self.folder, "Other Artist", "Other Album")
+        os.makedirs(album_dir)
+        with open(os.path.join(album_dir, "01 Song.mp3"), "wb") as f:
+            f.write(b"not really audio")
+        with open(os.path.join(album_dir, "cover.jpg"), "wb") as f:
+            f.write(make_image('blue', 'JPEG'))
+
+        library = widget.MusicLibrary(os.path.join(self.folder, "library.db"), [self.folder])
+        resize = widget.resize_library_cover
+        lock_held = []
+
+        def resize_library_cover(data):
+            lock_held.append(library._db_lock.locked())
+            return resize(data)
+
+        with mock.patch.object(widget, 'resize_library_cover', resize_library_cover):
+            library.scan()
+        self.assertEqual(lock_held, [False, False])
+
+        for artist, title in (('Artist', 'Title'), ('Other Artist', 'Song')):
+            cover_hash = library.lookup(artist, title)
+            self.assertIsNotNone(cover_hash, f"{artist} - {title}")
+            self.assertTrue(library.get_cover_data(cover_hash))
+
+
+if __name__ == '__main__':
+    unittest.main()
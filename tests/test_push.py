@@ -0,0 +1,89 @@
+"""
+Pushing media sessions to a hub, with the hub's IngestMediaSource in the same process.
+
+python -m unittest discover tests
+"""
+import asyncio
+import time
+import unittest
+
+import obs_now_playing_widget_windows_media_api as widget
+
+TOKEN = "secret"
+
+
+class InProcessHub:
+    """
+    Answers the pusher's requests like the hub's HTTP server. restart() loses all state.
+    """
+    def __init__(self):
+        self.restart()
+
+    def restart(self):
+        self.source = widget.IngestMediaSource(TOKEN)
+
+    async def request(self, method, path, body=b"", signed=True):
+        signature = widget.ingest_signature(TOKEN, method, path, body) if signed else None
+        parts = path.strip("/").split("/")
+        if method == "HEAD":
+            # /cover/<hash>/original
+            return 200 if parts[1] in self.source.covers else 404
+        if method == "PUT":
+            return self.source.ingest_cover(parts[2], body, signature)[0]
+        return self.source.ingest(body, signature)[0]
+
+
+class PushTest(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.fake = widget.FakeMediaSource()
+        self.hub = InProcessHub()
+        self.pusher = widget.PushingMediaSource(self.fake, "http://hub", TOKEN, "pc")
+        self.pusher._request = self.hub.request
+
+    async def asyncTearDown(self):
+        if self.pusher._task is not None:
+            self.pusher._task.cancel()
+
+    async def wait_for_hub(self, condition, timeout=2):
+        deadline = time.monotonic() + timeout
+        while True:
+            sessions, current_app_id = await self.hub.source.get_sessions()
+            if condition(sessions, current_app_id):
+                return sessions
+            self.assertLess(time.monotonic(), deadline, "hub not updated")
+            await asyncio.sleep(0.01)
+
+    async def test_covers_are_uploaded_again_after_a_hub_restart(self):
+        self.fake.set_session(title='Title', artist='Artist', thumbnail=b'cover bytes', position=1)
+        sessions, _ = await self.pusher.get_sessions()
+        await self.pusher.read_thumbnail(sessions[0]['thumbnail'])  # like the widget's cover loader
+        await self.pusher.get_sessions()
+        sessions = await self.wait_for_hub(lambda sessions, current: sessions and sessions[0]['thumbnail'])
+        thumbnail = sessions[0]['thumbnail']
+        self.assertEqual(await self.hub.source.read_thumbnail(thumbnail), b'cover bytes')
+
+        self.hub.restart()
+        self.fake.set_session(position=2)
+        await self.pusher.get_sessions()
+        sessions = await self.wait_for_hub(lambda sessions, current: sessions and sessions[0]['position'] == 2)
+        self.assertEqual(sessions[0]['title'], 'Title')
+        self.assertEqual(await self.hub.source.read_thumbnail(thumbnail), b'cover bytes')
+
+    async def test_thumbnails_are_pushed_once_the_widget_read_them(self):
+        self.fake.hanging.add('read_thumbnail')
+        self.fake.set_session(title='Title', artist='Artist', thumbnail=b'cover bytes')
+        start = time.monotonic()
+        sessions, _ = await self.pusher.get_sessions()
+        self.assertLess(time.monotonic() - start, 0.1)
+        await self.wait_for_hub(lambda sessions, current: sessions and sessions[0]['thumbnail'] is None)
+
+        # The widget's cover loader reads through the pusher
+        self.fake.hanging.clear()
+        self.assertEqual(await self.pusher.read_thumbnail(sessions[0]['thumbnail']), b'cover bytes')
+        await self.pusher.get_sessions()
+        sessions = await self.wait_for_hub(lambda sessions, current: sessions[0]['thumbnail'])
+        self.assertEqual(await self.hub.source.read_thumbnail(sessions[0]['thumbnail']), b'cover bytes')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,105 @@
+"""
+The Windows media sources with stand-ins for the WinRT session manager, so they run without Windows.
+
+python -m unittest discover tests
+"""
+import datetime
+import unittest
+from types import SimpleNamespace
+from unittest import mock
+
+import obs_now_playing_widget_windows_media_api as widget
+
+
+class WinSession:
+    """
+    A GlobalSystemMediaTransportControlsSession with the calls the media sources make.
+    """
+    def __init__(self, app_id, title, artist="Artist"):
+        self.source_app_user_model_id = app_id
+        self.title = title
+        self.artist = artist
+        self.handlers = {}
+
+    def copy(self):
+        # The session manager hands out a new object for the same session
+        return WinSession(self.source_app_user_model_id, self.title, self.artist)
+
+    async def _properties(self):
+        return SimpleNamespace(title=self.title, artist=self.artist, album_title="", thumbnail=None)
+
+    def try_get_media_properties_async(self):
+        return self._properties()
+
+    def get_playback_info(self):
+        return SimpleNamespace(playback_status=4, playback_rate=1.0)
+
+    def get_timeline_properties(self):
+        return SimpleNamespace(position=datetime.timedelta(seconds=10), end_time=datetime.timedelta(seconds=200),
+                               last_updated_time=datetime.datetime.now())
+
+    def __getattr__(self, name):
+        # add_*_changed returns a token, remove_*_changed takes it
+        if name.startswith("add_"):
+            return lambda handler: self.handlers.setdefault(name[4:], handler) and name
+        if name.startswith("remove_"):
+            return lambda token: self.handlers.pop(name[7:], None)
+        raise AttributeError(name)
+
+
+class WinSessionManager(WinSession):
+    def __init__(self, sessions, current):
+        super().__init__(None, None)
+        self.sessions = sessions
+        self.current = current
+
+    def get_sessions(self):
+        return list(self.sessions)
+
+    def get_current_session(self):
+        return self.current.copy() if self.current else None
+
+    def sessions_changed(self):
+        self.handlers['sessions_changed'](self, None)
+
+
+class WindowsMediaSourceTest(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.tab1 = WinSession("Chrome", "First tab")
+        self.tab2 = WinSession("Chrome", "Second tab")
+        self.spotify = WinSession("Spotify.exe", "Song")
+        self.manager = WinSessionManager([self.tab1, self.spotify, self.tab2], self.tab2)
+
+        async def request_async():
+            return self.manager
+        patcher = mock.patch.object(widget, 'MediaManager', SimpleNamespace(request_async=request_async))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def titles(self, sessions):
+        return {session['app_id']: session['title'] for session in sessions}
+
+    async def test_polling_source_keeps_every_tab(self):
+        sessions, current_app_id = await widget.WindowsMediaSource().get_sessions()
+        self.assertEqual(self.titles(sessions), {'Chrome': "First tab", 'Spotify.exe': "Song", 'Chrome~2': "Second tab"})
+        self.assertEqual(current_app_id, 'Chrome~2')
+
+    async def test_event_source_keeps_every_tab(self):
+        source = widget.WindowsEventMediaSource()
+        sessions, current_app_id = await source.get_sessions()
+        self.assertEqual(self.titles(sessions), {'Chrome': "First tab", 'Spotify.exe': "Song", 'Chrome~2': "Second tab"})
+        self.assertEqual(current_app_id, 'Chrome~2')
+
+        # Closing the first tab moves the second one to the browser's own key
+        self.manager.sessions.remove(self.tab1)
+        self.manager.sessions_changed()
+        sessions, current_app_id = await source.get_sessions()
+        self.assertEqual(self.titles(sessions), {'Chrome': "Second tab", 'Spotify.exe': "Song"})
+        self.assertEqual(current_app_id, 'Chrome')
+        self.assertFalse(self.tab1.handlers)
+        await source.close()
+        self.assertFalse(self.tab2.handlers)
+
+
+if __name__ == '__main__':
+    unittest.main()